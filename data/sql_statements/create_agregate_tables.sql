@@ -6,7 +6,9 @@ CREATE TABLE IF NOT EXISTS DIM_STATION (
     LONGITUDE FLOAT,
     LATITUDE FLOAT,
     STATUS VARCHAR,
-    CAPACITTY INTEGER
+    CAPACITTY INTEGER,
+    -- Cell of the station on the grid of GRID_CELL_DEGREES of src/data_agregation.py
+    GRID_CELL BIGINT
 );
 
 CREATE TABLE IF NOT EXISTS DIM_CITY (
@@ -15,14 +17,56 @@ CREATE TABLE IF NOT EXISTS DIM_CITY (
     NB_INHABITANTS INTEGER
 );
 
-CREATE TABLE IF NOT EXISTS FACT_STATION_STATEMENT (
+-- The facts are appended into a table per month, FACT_STATION_STATEMENT_<YYYYMM>, created like this
+-- empty table, without keys to maintain on insert. They are read through the FACT_STATION_STATEMENT view
+CREATE TABLE IF NOT EXISTS FACT_STATION_STATEMENT_PARTITION (
     STATION_ID VARCHAR NOT NULL,
     CITY_ID VARCHAR NOT NULL,
     BICYCLE_DOCKS_AVAILABLE INTEGER,
     BICYCLE_AVAILABLE INTEGER,
     LAST_STATEMENT_DATE DATETIME,
     CREATED_DATE DATE DEFAULT current_date,
-    PRIMARY KEY (STATION_ID, CITY_ID, CREATED_DATE),
-    FOREIGN KEY (STATION_ID) REFERENCES DIM_STATION (ID),
-    FOREIGN KEY (CITY_ID) REFERENCES DIM_CITY (ID)
+    SNAPSHOT_TIME TIMESTAMP NOT NULL
+);
+
+-- Rollups of the facts for each hour, day and month (GRAIN) starting at PERIOD_START : the count, the sum,
+-- the minimum and the maximum of each measure, merged from one grain into the next one by data_agregation
+CREATE TABLE IF NOT EXISTS ROLLUP_STATION_STATEMENT (
+    GRAIN VARCHAR NOT NULL,
+    PERIOD_START TIMESTAMP NOT NULL,
+    STATION_ID VARCHAR NOT NULL,
+    CITY_ID VARCHAR NOT NULL,
+    COUNT_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    SUM_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    MIN_BICYCLE_DOCKS_AVAILABLE INTEGER,
+    MAX_BICYCLE_DOCKS_AVAILABLE INTEGER,
+    COUNT_BICYCLE_AVAILABLE BIGINT,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    MIN_BICYCLE_AVAILABLE INTEGER,
+    MAX_BICYCLE_AVAILABLE INTEGER,
+    PRIMARY KEY (GRAIN, PERIOD_START, STATION_ID, CITY_ID)
+);
+
+-- The measures of a city are the totals of its stations for each snapshot
+CREATE TABLE IF NOT EXISTS ROLLUP_CITY_STATEMENT (
+    GRAIN VARCHAR NOT NULL,
+    PERIOD_START TIMESTAMP NOT NULL,
+    CITY_ID VARCHAR NOT NULL,
+    COUNT_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    SUM_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    MIN_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    MAX_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    COUNT_BICYCLE_AVAILABLE BIGINT,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    MIN_BICYCLE_AVAILABLE BIGINT,
+    MAX_BICYCLE_AVAILABLE BIGINT,
+    PRIMARY KEY (GRAIN, PERIOD_START, CITY_ID)
+);
+
+CREATE TABLE IF NOT EXISTS AGREGATE_WATERMARK (
+    TABLE_NAME VARCHAR PRIMARY KEY,
+    VERSION BIGINT,
+    SNAPSHOT_TIME TIMESTAMP,
+    CREATED_DATE DATE,
+    UPDATED_AT TIMESTAMP
 );
@@ -1,3 +1,7 @@
+CREATE SEQUENCE IF NOT EXISTS CONSOLIDATE_VERSION;
+
+-- A version of a station is written only when its attributes change : it is valid from VALID_FROM
+-- included to VALID_TO excluded, NULL while it is the current version (IS_CURRENT)
 CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION  (
     ID VARCHAR NOT NULL,
     CODE VARCHAR NOT NULL,
@@ -8,9 +12,22 @@ CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION  (
     LONGITUDE FLOAT,
     LATITUDE FLOAT,
     STATUS VARCHAR,
-    CREATED_DATE DATE,
+    VALID_FROM DATE NOT NULL,
     CAPACITTY INTEGER,
-    PRIMARY KEY (ID, CREATED_DATE)
+    CITY_ID VARCHAR,
+    VALID_TO DATE,
+    IS_CURRENT BOOLEAN NOT NULL DEFAULT TRUE,
+    PRIMARY KEY (ID, VALID_FROM)
+);
+
+ALTER TABLE CONSOLIDATE_STATION ADD COLUMN IF NOT EXISTS CITY_ID VARCHAR;
+
+-- Days the stations of each source were consolidated, by prefix of their identifiers (the city_code
+-- of the adapter). A station missing from a day of its source isn't valid that day
+CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION_LOAD (
+    ID_PREFIX VARCHAR NOT NULL,
+    CREATED_DATE DATE NOT NULL,
+    PRIMARY KEY (ID_PREFIX, CREATED_DATE)
 );
 
 CREATE TABLE IF NOT EXISTS CONSOLIDATE_CITY (
@@ -27,5 +44,55 @@ CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION_STATEMENT (
     BICYCLE_AVAILABLE INTEGER,
     LAST_STATEMENT_DATE DATE,
     CREATED_DATE VARCHAR,
-    PRIMARY KEY (STATION_ID, CREATED_DATE)
+    SNAPSHOT_TIME TIMESTAMP NOT NULL,
+    IS_REMOVED BOOLEAN DEFAULT FALSE,
+    PRIMARY KEY (STATION_ID, SNAPSHOT_TIME)
+);
+
+-- With the delta encoding, a snapshot only holds the statements that changed since the previous one, and
+-- a row IS_REMOVED for a station its source doesn't list anymore
+ALTER TABLE CONSOLIDATE_STATION_STATEMENT ADD COLUMN IF NOT EXISTS IS_REMOVED BOOLEAN DEFAULT FALSE;
+
+-- Snapshots the statements of each source were consolidated into, by prefix of the station identifiers.
+-- A station of a delta snapshot is only rebuilt when its source was consolidated into the snapshot
+CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION_STATEMENT_LOAD (
+    ID_PREFIX VARCHAR NOT NULL,
+    SNAPSHOT_TIME TIMESTAMP NOT NULL,
+    PRIMARY KEY (ID_PREFIX, SNAPSHOT_TIME)
+);
+
+CREATE TABLE IF NOT EXISTS CONSOLIDATE_QUARANTINE (
+    TABLE_NAME VARCHAR NOT NULL,
+    SOURCE_NAME VARCHAR,
+    SNAPSHOT_TIME TIMESTAMP,
+    REASON VARCHAR,
+    RECORD VARCHAR
 );
+
+CREATE TABLE IF NOT EXISTS CONSOLIDATE_SNAPSHOT (
+    SNAPSHOT_TIME TIMESTAMP PRIMARY KEY,
+    CREATED_DATE DATE,
+    VERSION BIGINT,
+    KEYFRAME_TIME TIMESTAMP
+);
+
+ALTER TABLE CONSOLIDATE_SNAPSHOT ADD COLUMN IF NOT EXISTS VERSION BIGINT;
+
+UPDATE CONSOLIDATE_SNAPSHOT SET VERSION = nextval('CONSOLIDATE_VERSION') WHERE VERSION IS NULL;
+
+-- Snapshot whose statements are all stored (keyframe) that the statements of a snapshot are rebuilt from,
+-- the snapshot itself when it is a keyframe
+ALTER TABLE CONSOLIDATE_SNAPSHOT ADD COLUMN IF NOT EXISTS KEYFRAME_TIME TIMESTAMP;
+
+UPDATE CONSOLIDATE_SNAPSHOT SET KEYFRAME_TIME = SNAPSHOT_TIME WHERE KEYFRAME_TIME IS NULL;
+
+CREATE TABLE IF NOT EXISTS CONSOLIDATE_LATEST_SNAPSHOT (
+    ID INTEGER PRIMARY KEY CHECK (ID = 1),
+    SNAPSHOT_TIME TIMESTAMP,
+    CREATED_DATE DATE,
+    CITY_CREATED_DATE VARCHAR
+);
+
+INSERT OR IGNORE INTO CONSOLIDATE_LATEST_SNAPSHOT
+SELECT 1, MAX(SNAPSHOT_TIME), MAX(CREATED_DATE), (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY)
+FROM CONSOLIDATE_SNAPSHOT;
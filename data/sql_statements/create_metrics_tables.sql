@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS PIPELINE_RUN_METRICS (
+    RUN_ID VARCHAR NOT NULL,
+    STAGE VARCHAR NOT NULL,
+    TARGET VARCHAR,
+    STATUS VARCHAR,
+    STARTED_AT TIMESTAMP,
+    ELAPSED DOUBLE,
+    ROWS_IN BIGINT,
+    ROWS_OUT BIGINT,
+    BYTES_DOWNLOADED BIGINT,
+    BYTES_READ BIGINT,
+    PEAK_RSS BIGINT,
+    ERROR VARCHAR,
+    ROWS_QUARANTINED BIGINT
+);
+
+ALTER TABLE PIPELINE_RUN_METRICS ADD COLUMN IF NOT EXISTS ROWS_QUARANTINED BIGINT;
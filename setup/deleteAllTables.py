@@ -1,12 +1,36 @@
+import json
+import os
+
 import duckdb
 
 def deleteAllTables():
     con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
 
-    tables = ["FACT_STATION_STATEMENT", "CONSOLIDATE_CITY", "CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT", "DIM_CITY", "DIM_STATION"]
+    # The facts are a view over a table per month, dropped before the other tables
+    for table_name, table_type in con.execute("""
+    SELECT table_name, table_type
+    FROM information_schema.tables
+    WHERE table_name LIKE 'FACT_STATION_STATEMENT%'
+    ORDER BY table_type = 'VIEW' DESC;
+    """).fetchall():
+        con.execute(f"DROP {'VIEW' if table_type == 'VIEW' else 'TABLE'} IF EXISTS {table_name}")
+
+    tables = ["CONSOLIDATE_CITY", "CONSOLIDATE_STATION", "CONSOLIDATE_STATION_LOAD", "CONSOLIDATE_STATION_STATEMENT", "CONSOLIDATE_STATION_STATEMENT_LOAD", "CONSOLIDATE_SNAPSHOT", "CONSOLIDATE_QUARANTINE", "CONSOLIDATE_LATEST_SNAPSHOT", "DIM_CITY", "DIM_STATION", "ROLLUP_STATION_STATEMENT", "ROLLUP_CITY_STATEMENT", "AGREGATE_WATERMARK", "PIPELINE_RUN_METRICS"]
 
     for table in tables:
         sql_statement = f"DROP TABLE IF EXISTS {table}"
         con.execute(sql_statement)
 
+    con.execute("DROP SEQUENCE IF EXISTS CONSOLIDATE_VERSION")
+
+    # The tables are empty, every source has to be consolidated again
+    if os.path.exists("data/source_state.json"):
+        with open("data/source_state.json") as fd:
+            state = json.load(fd)
+
+        state["consolidated"] = {}
+
+        with open("data/source_state.json", "w") as fd:
+            json.dump(state, fd, indent=4)
+
 deleteAllTables()
\ No newline at end of file
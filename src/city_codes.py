@@ -0,0 +1,127 @@
+import re
+import unicodedata
+
+import pandas as pd
+
+from database import get_connection
+
+# Lookup of the INSEE codes built from the latest snapshot of CONSOLIDATE_CITY, once per run
+# - "names" : INSEE code of each normalized city name
+# - "codes" : every INSEE code of the snapshot
+# Emptied by clear_city_codes once CONSOLIDATE_CITY changed
+_city_lookup = None
+
+def normalize_city_name(city_name):
+    """
+    Normalize a city name so that the spellings used by the APIs match the one of
+    the communes : case, accents, hyphens, apostrophes and spaces are ignored
+
+    Params :
+        - city_name : string, name of the city
+
+    Returns : normalized_name, string or None if city_name is None
+    """
+
+    if city_name is None or pd.isna(city_name):
+        return None
+
+    decomposed_name = unicodedata.normalize("NFKD", str(city_name))
+    unaccented_name = "".join(char for char in decomposed_name if not unicodedata.combining(char))
+
+    return re.sub(r"[\s\-'’]+", " ", unaccented_name).strip().casefold()
+
+def load_city_lookup():
+    """
+    Build the lookup of the INSEE codes from the latest snapshot of CONSOLIDATE_CITY.
+    Several communes share the same name, the most populated one is kept
+
+    Returns : city_lookup, dict with the "names" and "codes" lookups
+    """
+
+    sql_statement = """
+    SELECT ID, NAME
+    FROM CONSOLIDATE_CITY
+    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY)
+    ORDER BY NB_INHABITANTS ASC NULLS FIRST, ID DESC;
+    """
+
+    # Read through the write connection, the cities inserted by its current transaction are seen
+    rows = get_connection().execute(sql_statement).fetchall()
+
+    # The most populated commune comes last and overrides the others with the same name
+    return {
+        "names": {normalize_city_name(name): city_code for city_code, name in rows},
+        "codes": {city_code for city_code, _ in rows}
+    }
+
+def get_city_lookup():
+    """
+    Get the lookup of the INSEE codes, built on the first call
+
+    Returns : city_lookup, dict with the "names" and "codes" lookups
+    """
+
+    global _city_lookup
+
+    if _city_lookup is None:
+        _city_lookup = load_city_lookup()
+
+    return _city_lookup
+
+def set_city_lookup(city_lookup):
+    """
+    Use a lookup built by another process, for the processes that don't open the database
+
+    Params :
+        - city_lookup : dict with the "names" and "codes" lookups, as returned by get_city_lookup
+    """
+
+    global _city_lookup
+
+    _city_lookup = city_lookup
+
+def clear_city_codes():
+    """
+    Forget the lookup of the INSEE codes, it is built again on the next resolution
+    """
+
+    global _city_lookup
+
+    _city_lookup = None
+
+def get_city_code(city_name):
+    """
+    Get the INSEE code of a city
+
+    Params :
+        - city_name : string, name of the city
+
+    Returns : city_code, string or None if the city is unknown
+    """
+
+    return get_city_lookup()["names"].get(normalize_city_name(city_name))
+
+def resolve_city_codes(city_names, city_codes=None):
+    """
+    Get the INSEE codes of a whole column of cities. Each distinct name is normalized
+    once. A code given by the API is kept when it is a known INSEE code, the name is
+    used otherwise
+
+    Params :
+        - city_names : pandas series, names of the cities
+        - city_codes : pandas series, codes given by the API, None if there are none
+
+    Returns : resolved_codes, pandas series of strings, None for the unknown cities
+    """
+
+    city_lookup = get_city_lookup()
+
+    distinct_names = city_names.dropna().unique()
+    name_codes = {name: city_lookup["names"].get(normalize_city_name(name)) for name in distinct_names}
+    resolved_codes = city_names.map(name_codes).astype(object)
+
+    if city_codes is not None:
+        known_codes = city_codes.astype(str).isin(city_lookup["codes"]) & city_codes.notna()
+        resolved_codes = resolved_codes.where(~known_codes, city_codes.astype(str))
+
+    return resolved_codes.where(resolved_codes.notna(), None)
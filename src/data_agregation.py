@@ -1,19 +1,134 @@
-import duckdb
+import re
+from datetime import date, datetime
 
+from database import get_connection
+from metrics import record_stage
+from statement_deltas import get_statements_sql
+
+# Aggregation mode used by main
+# - "full" : the dimensions and the facts are computed again from the latest snapshot
+# - "incremental" : only the snapshots consolidated since the last aggregation are merged,
+#   older snapshots consolidated by a backfill included
+AGREGATION_MODE = "incremental"
+
+# The facts are appended into a table per month, named after the month of their snapshot, and read
+# through the FACT_STATION_STATEMENT view. The partitions are created like the empty template table
+FACT_VIEW = "FACT_STATION_STATEMENT"
+FACT_PARTITION_TEMPLATE = "FACT_STATION_STATEMENT_PARTITION"
+FACT_PARTITION_FORMAT = "FACT_STATION_STATEMENT_%Y%m"
+FACT_PARTITION_PATTERN = re.compile(r"FACT_STATION_STATEMENT_(\d{4})(\d{2})")
+
+# The stations are placed on a grid of cells of GRID_CELL_DEGREES of latitude and of longitude, in the
+# GRID_CELL column of DIM_STATION, so that the stations around a point are found without reading them all.
+# The cell of a point is the row of its latitude times GRID_CELL_ROW_SIZE plus the column of its longitude
+GRID_CELL_DEGREES = 0.01
+GRID_CELL_ROW_SIZE = 100_000
+GRID_CELL_SQL = f"""
+    CAST(floor(CAST(LATITUDE AS DOUBLE) / CAST({GRID_CELL_DEGREES} AS DOUBLE)) AS BIGINT) * {GRID_CELL_ROW_SIZE}
+    + CAST(floor(CAST(LONGITUDE AS DOUBLE) / CAST({GRID_CELL_DEGREES} AS DOUBLE)) AS BIGINT)
+"""
+
+# Rollups of the facts, for each grain : the hours are computed from the facts, each following
+# grain is merged from the previous one with the sums, counts, minimums and maximums of its measures
+ROLLUP_GRAINS = ["hour", "day", "month"]
+ROLLUP_MEASURES = ["BICYCLE_DOCKS_AVAILABLE", "BICYCLE_AVAILABLE"]
+
+# Key of the rows of each rollup table, besides the grain and the start of the period
+ROLLUP_KEYS = {
+    "ROLLUP_STATION_STATEMENT": ["STATION_ID", "CITY_ID"],
+    "ROLLUP_CITY_STATEMENT": ["CITY_ID"]
+}
+
+# Snapshots given a version by the consolidation since the watermark of an aggregate table
+CHANGED_SNAPSHOTS_SQL = """
+SELECT SNAPSHOT_TIME, CREATED_DATE
+FROM CONSOLIDATE_SNAPSHOT
+WHERE VERSION > $version AND VERSION <= $last_version
+"""
+
+# SQL merging the rows of one day into each dimension
+# {conflict} is "OR REPLACE" for the latest day, "OR IGNORE" for an older day : a backfill
+# only adds the rows missing from the dimension and never overwrites newer ones. The stations of a day
+# are the versions valid that day
+INCREMENTAL_DIM_SQL_STATEMENTS = {
+    "DIM_CITY": """
+    INSERT {conflict} INTO DIM_CITY
+    SELECT 
+        ID,
+        NAME,
+        NB_INHABITANTS
+    FROM CONSOLIDATE_CITY
+    WHERE CREATED_DATE = CAST($created_date AS VARCHAR);
+    """,
+    "DIM_STATION": f"""
+    INSERT {{conflict}} INTO DIM_STATION
+    SELECT 
+        ID,
+        CODE,
+        NAME,
+        ADDRESS,
+        LONGITUDE,
+        LATITUDE,
+        STATUS,
+        CAPACITTY,
+        {GRID_CELL_SQL} AS GRID_CELL
+    FROM CONSOLIDATE_STATION
+    WHERE VALID_FROM <= $created_date AND (VALID_TO IS NULL OR VALID_TO > $created_date);
+    """
+}
 
 def create_agregate_tables():
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
     with open("data/sql_statements/create_agregate_tables.sql") as fd:
         statements = fd.read()
         for statement in statements.split(";"):
             print(statement)
             con.execute(statement)
 
+    migrate_fact_table(con)
+    refresh_fact_view(con)
+    migrate_dim_station(con)
+
+
+def migrate_dim_station(con):
+    """
+    Add the GRID_CELL column to a DIM_STATION created before the grid of the stations, and place them on it
+
+    Params :
+        - con : DuckDB connection
+    """
+
+    con.execute("ALTER TABLE DIM_STATION ADD COLUMN IF NOT EXISTS GRID_CELL BIGINT;")
+    con.execute(f"UPDATE DIM_STATION SET GRID_CELL = {GRID_CELL_SQL} WHERE GRID_CELL IS NULL AND LATITUDE IS NOT NULL;")
+
+
+def get_latest_snapshot(con):
+    """
+    Get the pointer to the latest consolidated snapshot, maintained by the consolidation
+
+    Params :
+        - con : DuckDB connection
+
+    Returns : (snapshot_time, created_date, city_created_date), or None if nothing was consolidated
+    """
+
+    latest_snapshot = con.execute("""
+    SELECT SNAPSHOT_TIME, CREATED_DATE, CITY_CREATED_DATE
+    FROM CONSOLIDATE_LATEST_SNAPSHOT;
+    """).fetchone()
+
+    return latest_snapshot
+
 
 def agregate_dim_station():
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    
-    sql_statement = """
+    con = get_connection()
+    latest_snapshot = get_latest_snapshot(con)
+
+    if latest_snapshot is None:
+        return
+
+    # The versions of the stations valid on the day of the latest snapshot are the current ones
+    sql_statement = f"""
     INSERT OR REPLACE INTO DIM_STATION
     SELECT 
         ID,
@@ -23,16 +138,24 @@ def agregate_dim_station():
         LONGITUDE,
         LATITUDE,
         STATUS,
-        CAPACITTY
+        CAPACITTY,
+        {GRID_CELL_SQL} AS GRID_CELL
     FROM CONSOLIDATE_STATION
-    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION);
+    WHERE IS_CURRENT;
     """
 
-    con.execute(sql_statement)
+    with record_stage("agregate:DIM_STATION") as metrics:
+        metrics["rows_out"] = con.execute(sql_statement).fetchone()[0]
 
 
 def agregate_dim_city():
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
+    latest_snapshot = get_latest_snapshot(con)
+
+    if latest_snapshot is None:
+        return
+
+    _, _, city_created_date = latest_snapshot
     
     sql_statement = """
     INSERT OR REPLACE INTO DIM_CITY
@@ -41,25 +164,33 @@ def agregate_dim_city():
         NAME,
         NB_INHABITANTS
     FROM CONSOLIDATE_CITY
-    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+    WHERE CREATED_DATE = ?;
     """
 
-    con.execute(sql_statement)
+    with record_stage("agregate:DIM_CITY") as metrics:
+        metrics["rows_out"] = con.execute(sql_statement, [city_created_date]).fetchone()[0]
 
 
 def agregate_fact_station_statements():
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
+    latest_snapshot = get_latest_snapshot(con)
+
+    if latest_snapshot is None:
+        return
+
+    snapshot_time, created_date, _ = latest_snapshot
 
     # Aggregate using the INSEE code
-    sql_statement = """
-    INSERT OR REPLACE INTO FACT_STATION_STATEMENT
-    SELECT STATION_ID, cc.ID as CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, current_date as CREATED_DATE
-    FROM CONSOLIDATE_STATION_STATEMENT
+    # The city of each station is resolved at consolidation time into CITY_ID, and the
+    # latest snapshot comes from its pointer : the statements of one snapshot are joined
+    # to the current versions of the stations on their key
+    # The statements of the snapshot are rebuilt from its keyframe when they are stored as deltas
+    sql_statement = f"""
+    SELECT STATION_ID, CONSOLIDATE_STATION.CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, $created_date AS CREATED_DATE, SNAPSHOT_TIME
+    FROM ({get_statements_sql('SELECT $snapshot_time AS SNAPSHOT_TIME')}) AS CONSOLIDATE_STATION_STATEMENT
     JOIN CONSOLIDATE_STATION ON CONSOLIDATE_STATION.ID = CONSOLIDATE_STATION_STATEMENT.STATION_ID
-    JOIN CONSOLIDATE_CITY as cc ON LOWER(cc.NAME) = LOWER(CONSOLIDATE_STATION.CITY_NAME)
-    WHERE CONSOLIDATE_STATION_STATEMENT.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION_STATEMENT)
-        AND CONSOLIDATE_STATION.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION)
-        AND cc.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+    WHERE CONSOLIDATE_STATION.IS_CURRENT
+        AND CONSOLIDATE_STATION.CITY_ID IS NOT NULL
     """
 
     # Aggregate using the name of the city
@@ -72,8 +203,516 @@ def agregate_fact_station_statements():
     # LEFT JOIN CONSOLIDATE_CITY as cc ON cc.ID = CONSOLIDATE_STATION.CITY_CODE
     # WHERE CITY_CODE != 0 
     #     AND CONSOLIDATE_STATION_STATEMENT.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION_STATEMENT)
-    #     AND CONSOLIDATE_STATION.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION)
+    #     AND CONSOLIDATE_STATION.IS_CURRENT
     #     AND cc.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
     # """
         
-    con.execute(sql_statement)
+    with record_stage("agregate:FACT_STATION_STATEMENT") as metrics:
+        metrics["rows_out"] = append_facts(
+            con,
+            "SELECT $snapshot_time AS SNAPSHOT_TIME",
+            sql_statement,
+            {"snapshot_time": snapshot_time, "created_date": created_date}
+        )
+
+
+def agregate_rollups():
+    con = get_connection()
+    latest_snapshot = get_latest_snapshot(con)
+
+    if latest_snapshot is None:
+        return
+
+    snapshot_time, _, _ = latest_snapshot
+
+    for table_name in ROLLUP_KEYS:
+        with record_stage(f"agregate:{table_name}") as metrics:
+            _, metrics["rows_out"] = update_rollup(con, table_name, "SELECT $snapshot_time AS SNAPSHOT_TIME", {"snapshot_time": snapshot_time})
+
+
+def agregate_incremental_data():
+    """
+    Merge into DIM_CITY, DIM_STATION, FACT_STATION_STATEMENT and the rollups the snapshots
+    consolidated since the last aggregation, inside one transaction. Each table keeps the last version
+    of CONSOLIDATE_SNAPSHOT it processed inside AGREGATE_WATERMARK
+
+    Returns : merged, dict, number of days, snapshots or hours merged into each table
+    """
+
+    con = get_connection()
+
+    # Versions given after this point are left to the next aggregation
+    last_version = con.execute("SELECT COALESCE(MAX(VERSION), 0) FROM CONSOLIDATE_SNAPSHOT;").fetchone()[0]
+
+    con.begin()
+
+    try:
+        # The dimensions first, the facts reference them
+        merged = {
+            "DIM_CITY": agregate_incremental_dim(con, "DIM_CITY", last_version),
+            "DIM_STATION": agregate_incremental_dim(con, "DIM_STATION", last_version),
+            "FACT_STATION_STATEMENT": agregate_incremental_fact(con, last_version)
+        }
+
+        # The rollups are computed from the facts
+        for table_name in ROLLUP_KEYS:
+            merged[table_name] = agregate_incremental_rollup(con, table_name, last_version)
+
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+
+    return merged
+
+
+def agregate_incremental_dim(con, table_name, last_version):
+    """
+    Merge into a dimension the days whose snapshots changed since its watermark, oldest first
+
+    Params :
+        - con : DuckDB connection, inside a transaction
+        - table_name : string, "DIM_CITY" or "DIM_STATION"
+        - last_version : int, last version of CONSOLIDATE_SNAPSHOT to process
+
+    Returns : nb_days, int, number of days merged
+    """
+
+    with record_stage(f"agregate:{table_name}") as metrics:
+        version, _, dim_date = get_watermark(con, table_name)
+
+        changed_dates = con.execute("""
+        SELECT DISTINCT CREATED_DATE
+        FROM CONSOLIDATE_SNAPSHOT
+        WHERE VERSION > ? AND VERSION <= ?
+        ORDER BY CREATED_DATE;
+        """, [version, last_version]).fetchall()
+
+        metrics["rows_out"] = 0
+
+        for (created_date,) in changed_dates:
+            if dim_date is None or created_date >= dim_date:
+                nb_rows = con.execute(INCREMENTAL_DIM_SQL_STATEMENTS[table_name].format(conflict="OR REPLACE"), {"created_date": created_date}).fetchone()[0]
+
+                # A day without rows (no city file that day) doesn't become the day of the dimension
+                if nb_rows:
+                    dim_date = created_date
+            else:
+                nb_rows = con.execute(INCREMENTAL_DIM_SQL_STATEMENTS[table_name].format(conflict="OR IGNORE"), {"created_date": created_date}).fetchone()[0]
+
+            metrics["rows_out"] += nb_rows
+
+        set_watermark(con, table_name, last_version, dim_date)
+
+    return len(changed_dates)
+
+
+def agregate_incremental_fact(con, last_version):
+    """
+    Merge into FACT_STATION_STATEMENT the snapshots whose version is above its watermark.
+    The facts of a snapshot merged again are replaced by append_facts, a station whose city
+    changed doesn't keep a fact with its former city
+
+    Params :
+        - con : DuckDB connection, inside a transaction
+        - last_version : int, last version of CONSOLIDATE_SNAPSHOT to process
+
+    Returns : nb_snapshots, int, number of snapshots merged
+    """
+
+    with record_stage("agregate:FACT_STATION_STATEMENT") as metrics:
+        version, _, _ = get_watermark(con, "FACT_STATION_STATEMENT")
+
+        parameters = {"version": version, "last_version": last_version}
+
+        nb_snapshots, last_snapshot_time = con.execute(f"""
+        SELECT COUNT(*), MAX(SNAPSHOT_TIME) FROM ({CHANGED_SNAPSHOTS_SQL});
+        """, parameters).fetchone()
+
+        if nb_snapshots:
+            # Same join as agregate_fact_station_statements, over every changed snapshot at once,
+            # to the versions of the stations valid on the day of each snapshot
+            metrics["rows_out"] = append_facts(con, CHANGED_SNAPSHOTS_SQL, f"""
+            SELECT STATION_ID, CONSOLIDATE_STATION.CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, changed.CREATED_DATE, changed.SNAPSHOT_TIME
+            FROM ({CHANGED_SNAPSHOTS_SQL}) AS changed
+            JOIN ({get_statements_sql(CHANGED_SNAPSHOTS_SQL)}) AS CONSOLIDATE_STATION_STATEMENT ON CONSOLIDATE_STATION_STATEMENT.SNAPSHOT_TIME = changed.SNAPSHOT_TIME
+            JOIN CONSOLIDATE_STATION ON CONSOLIDATE_STATION.ID = CONSOLIDATE_STATION_STATEMENT.STATION_ID
+                AND CONSOLIDATE_STATION.VALID_FROM <= changed.CREATED_DATE
+                AND (CONSOLIDATE_STATION.VALID_TO IS NULL OR CONSOLIDATE_STATION.VALID_TO > changed.CREATED_DATE)
+            WHERE CONSOLIDATE_STATION.CITY_ID IS NOT NULL
+            """, parameters)
+
+        set_watermark(con, "FACT_STATION_STATEMENT", last_version, snapshot_time=last_snapshot_time)
+
+    return nb_snapshots
+
+
+def agregate_incremental_rollup(con, table_name, last_version):
+    """
+    Update the rollups of the hours, days and months of the snapshots whose version is above the watermark of a rollup table
+
+    Params :
+        - con : DuckDB connection, inside a transaction
+        - table_name : string, "ROLLUP_STATION_STATEMENT" or "ROLLUP_CITY_STATEMENT"
+        - last_version : int, last version of CONSOLIDATE_SNAPSHOT to process
+
+    Returns : nb_hours, int, number of hours rolled up
+    """
+
+    with record_stage(f"agregate:{table_name}") as metrics:
+        version, _, _ = get_watermark(con, table_name)
+        parameters = {"version": version, "last_version": last_version}
+
+        nb_hours, metrics["rows_out"] = update_rollup(con, table_name, CHANGED_SNAPSHOTS_SQL, parameters)
+        last_snapshot_time = con.execute(f"SELECT MAX(SNAPSHOT_TIME) FROM ({CHANGED_SNAPSHOTS_SQL});", parameters).fetchone()[0]
+
+        set_watermark(con, table_name, last_version, snapshot_time=last_snapshot_time)
+
+    return nb_hours
+
+
+def update_rollup(con, table_name, snapshots_sql, parameters):
+    """
+    Compute again the rollups of the periods holding some snapshots, once their facts are written.
+    The hours are computed from their facts, then the days from their hours and the months from
+    their days : a snapshot only costs the rows of its hour, day and month
+
+    Params :
+        - con : DuckDB connection
+        - table_name : string, "ROLLUP_STATION_STATEMENT" or "ROLLUP_CITY_STATEMENT"
+        - snapshots_sql : string, SELECT of the SNAPSHOT_TIME of the snapshots
+        - parameters : dict, named parameters of snapshots_sql
+
+    Returns : (nb_hours, nb_rows), number of hours rolled up and of rows written for all the grains
+    """
+
+    parameters = {name: value for name, value in parameters.items() if f"${name}" in snapshots_sql}
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE ROLLUP_HOURS AS
+    SELECT DISTINCT date_trunc('hour', SNAPSHOT_TIME) AS PERIOD_START
+    FROM ({snapshots_sql});
+    """, parameters)
+
+    nb_hours, first_hour, last_hour = con.execute("SELECT COUNT(*), MIN(PERIOD_START), MAX(PERIOD_START) FROM ROLLUP_HOURS;").fetchone()
+    hours = {"first_hour": first_hour, "last_hour": last_hour}
+    nb_rows = 0
+
+    if nb_hours:
+        for index, grain in enumerate(ROLLUP_GRAINS):
+            periods_sql = f"SELECT DISTINCT date_trunc('{grain}', PERIOD_START) FROM ROLLUP_HOURS"
+
+            con.execute(f"""
+            DELETE FROM {table_name}
+            WHERE GRAIN = '{grain}' AND {get_rollup_range_sql("PERIOD_START", grain)}
+                AND PERIOD_START IN ({periods_sql});
+            """, hours)
+
+            if index == 0:
+                sql_statement = build_rollup_hour_sql(con, table_name, first_hour, last_hour)
+            else:
+                sql_statement = build_rollup_merge_sql(table_name, ROLLUP_GRAINS[index - 1], grain)
+
+            nb_rows += con.execute(sql_statement.format(periods=periods_sql), hours).fetchone()[0]
+
+    con.execute("DROP TABLE ROLLUP_HOURS;")
+
+    return nb_hours, nb_rows
+
+
+def get_rollup_range_sql(column, grain):
+    """
+    Get the condition on the range of the periods of a grain holding the hours of ROLLUP_HOURS.
+    A range on the column itself lets DuckDB skip the row groups of the other periods
+
+    Params :
+        - column : string, column of the periods or of the snapshots
+        - grain : string, grain of the periods
+
+    Returns : sql, string, $first_hour and $last_hour are the first and the last hour of ROLLUP_HOURS
+    """
+
+    return f"{column} >= date_trunc('{grain}', $first_hour) AND {column} < date_trunc('{grain}', $last_hour) + INTERVAL 1 {grain}"
+
+
+def build_rollup_hour_sql(con, table_name, first_hour, last_hour):
+    """
+    Build the INSERT of the rollups of the hours of ROLLUP_HOURS, from the facts of their partitions.
+    A station has one fact per snapshot, a city the total of its stations for each snapshot
+
+    Params :
+        - con : DuckDB connection
+        - table_name : string, "ROLLUP_STATION_STATEMENT" or "ROLLUP_CITY_STATEMENT"
+        - first_hour : datetime, first hour of ROLLUP_HOURS
+        - last_hour : datetime, last hour of ROLLUP_HOURS
+
+    Returns : sql_statement, string, {periods} is replaced by the SELECT of the hours
+    """
+
+    keys = ", ".join(ROLLUP_KEYS[table_name])
+    aggregates = ", ".join(
+        f"COUNT({measure}), SUM({measure}), MIN({measure}), MAX({measure})"
+        for measure in ROLLUP_MEASURES
+    )
+    facts_sql = f"""
+        SELECT *
+        FROM ({get_fact_sql(con, first_hour, last_hour)}) AS facts
+        WHERE {get_rollup_range_sql("SNAPSHOT_TIME", "hour")}
+            AND date_trunc('hour', SNAPSHOT_TIME) IN ({{periods}})
+    """
+
+    if table_name == "ROLLUP_CITY_STATEMENT":
+        totals = ", ".join(f"SUM({measure}) AS {measure}" for measure in ROLLUP_MEASURES)
+        facts_sql = f"""
+        SELECT {keys}, SNAPSHOT_TIME, {totals}
+        FROM ({facts_sql}) AS facts
+        GROUP BY {keys}, SNAPSHOT_TIME
+        """
+
+    return f"""
+    INSERT INTO {table_name}
+    SELECT 'hour', date_trunc('hour', SNAPSHOT_TIME) AS PERIOD_START, {keys}, {aggregates}
+    FROM ({facts_sql}) AS facts
+    GROUP BY PERIOD_START, {keys};
+    """
+
+
+def build_rollup_merge_sql(table_name, source_grain, grain):
+    """
+    Build the INSERT of the rollups of a grain merged from the rollups of the previous grain
+
+    Params :
+        - table_name : string, "ROLLUP_STATION_STATEMENT" or "ROLLUP_CITY_STATEMENT"
+        - source_grain : string, grain merged
+        - grain : string, grain written
+
+    Returns : sql_statement, string, {periods} is replaced by the SELECT of the periods of the grain
+    """
+
+    keys = ", ".join(ROLLUP_KEYS[table_name])
+    aggregates = ", ".join(
+        f"SUM(COUNT_{measure}), SUM(SUM_{measure}), MIN(MIN_{measure}), MAX(MAX_{measure})"
+        for measure in ROLLUP_MEASURES
+    )
+
+    return f"""
+    INSERT INTO {table_name}
+    SELECT '{grain}', date_trunc('{grain}', PERIOD_START) AS GRAIN_START, {keys}, {aggregates}
+    FROM {table_name}
+    WHERE GRAIN = '{source_grain}' AND {get_rollup_range_sql("PERIOD_START", grain)}
+        AND date_trunc('{grain}', PERIOD_START) IN ({{periods}})
+    GROUP BY GRAIN_START, {keys};
+    """
+
+
+def get_watermark(con, table_name):
+    """
+    Get the watermark of an aggregate table
+
+    Params :
+        - con : DuckDB connection
+        - table_name : string, name of the aggregate table
+
+    Returns : (version, snapshot_time, created_date), version is 0 if the table was never aggregated
+    """
+
+    watermark = con.execute("""
+    SELECT VERSION, SNAPSHOT_TIME, CREATED_DATE
+    FROM AGREGATE_WATERMARK
+    WHERE TABLE_NAME = ?;
+    """, [table_name]).fetchone()
+
+    return watermark or (0, None, None)
+
+
+def set_watermark(con, table_name, version, created_date=None, snapshot_time=None):
+    """
+    Record the last version of CONSOLIDATE_SNAPSHOT processed by an aggregate table.
+    The snapshot and the day only move forward, a backfill doesn't bring them back
+
+    Params :
+        - con : DuckDB connection
+        - table_name : string, name of the aggregate table
+        - version : int, last version processed
+        - created_date : date, latest day merged into a dimension
+        - snapshot_time : datetime, latest snapshot merged into the facts
+    """
+
+    con.execute("""
+    INSERT INTO AGREGATE_WATERMARK VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (TABLE_NAME) DO UPDATE SET
+        VERSION = excluded.VERSION,
+        SNAPSHOT_TIME = GREATEST(excluded.SNAPSHOT_TIME, AGREGATE_WATERMARK.SNAPSHOT_TIME),
+        CREATED_DATE = GREATEST(excluded.CREATED_DATE, AGREGATE_WATERMARK.CREATED_DATE),
+        UPDATED_AT = excluded.UPDATED_AT;
+    """, [table_name, version, snapshot_time, created_date, datetime.now()])
+
+
+def append_facts(con, snapshots_sql, facts_sql, parameters):
+    """
+    Append facts into the partitions of their month. The partitions have no key : the facts
+    are deduplicated at write time, the former facts of the snapshots written again are deleted
+    first. The statements of CONSOLIDATE_STATION_STATEMENT and the stations of a day are keyed,
+    the facts of a snapshot have no duplicate
+
+    Params :
+        - con : DuckDB connection, inside a transaction
+        - snapshots_sql : string, SELECT of the SNAPSHOT_TIME of the snapshots written
+        - facts_sql : string, SELECT of the facts of these snapshots, in the order of the columns of the partitions
+        - parameters : dict, named parameters of the statements
+
+    Returns : nb_rows, int, number of facts appended
+    """
+
+    for table_name, sql_statement in [("WRITTEN_SNAPSHOTS", snapshots_sql), ("NEW_FACTS", facts_sql)]:
+        # Only the parameters used by the statement can be bound
+        statement_parameters = {name: value for name, value in parameters.items() if f"${name}" in sql_statement}
+        con.execute(f"CREATE OR REPLACE TEMP TABLE {table_name} AS {sql_statement};", statement_parameters)
+
+    partitions = get_fact_partitions(con)
+    months = con.execute("""
+    SELECT DISTINCT date_trunc('month', SNAPSHOT_TIME) AS MONTH
+    FROM WRITTEN_SNAPSHOTS
+    ORDER BY MONTH;
+    """).fetchall()
+    nb_rows = 0
+
+    for (month,) in months:
+        partition = month.strftime(FACT_PARTITION_FORMAT)
+        next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+        if partition in partitions:
+            # The range lets DuckDB skip the row groups of the other snapshots of the month
+            con.execute(f"""
+            DELETE FROM {partition}
+            WHERE SNAPSHOT_TIME BETWEEN (SELECT MIN(SNAPSHOT_TIME) FROM WRITTEN_SNAPSHOTS) AND (SELECT MAX(SNAPSHOT_TIME) FROM WRITTEN_SNAPSHOTS)
+                AND SNAPSHOT_TIME IN (SELECT SNAPSHOT_TIME FROM WRITTEN_SNAPSHOTS);
+            """)
+        else:
+            con.execute(f"CREATE TABLE {partition} AS SELECT * FROM {FACT_PARTITION_TEMPLATE} LIMIT 0;")
+
+        nb_rows += con.execute(f"""
+        INSERT INTO {partition}
+        SELECT * FROM NEW_FACTS
+        WHERE SNAPSHOT_TIME >= ? AND SNAPSHOT_TIME < ?;
+        """, [month, next_month]).fetchone()[0]
+
+    con.execute("DROP TABLE WRITTEN_SNAPSHOTS;")
+    con.execute("DROP TABLE NEW_FACTS;")
+
+    if any(month.strftime(FACT_PARTITION_FORMAT) not in partitions for (month,) in months):
+        refresh_fact_view(con)
+
+    return nb_rows
+
+
+def get_fact_partitions(con, start_time=None, end_time=None):
+    """
+    Get the monthly partitions of the facts, those of the months overlapping a range of snapshots
+    when it is given, so that a query over a period doesn't scan the other months
+
+    Params :
+        - con : DuckDB connection
+        - start_time : datetime, first snapshot of the range, None for no lower bound
+        - end_time : datetime, last snapshot of the range, None for no upper bound
+
+    Returns : partitions, list of table names, oldest month first
+    """
+
+    partitions = []
+
+    for (table_name,) in con.execute("""
+    SELECT table_name
+    FROM information_schema.tables
+    WHERE table_type = 'BASE TABLE' AND table_name LIKE 'FACT_STATION_STATEMENT_%'
+    ORDER BY table_name;
+    """).fetchall():
+        match = FACT_PARTITION_PATTERN.fullmatch(table_name)
+
+        if match is None:
+            continue
+
+        month = (int(match.group(1)), int(match.group(2)))
+
+        if start_time is not None and month < (start_time.year, start_time.month):
+            continue
+
+        if end_time is not None and month > (end_time.year, end_time.month):
+            continue
+
+        partitions.append(table_name)
+
+    return partitions
+
+
+def get_fact_sql(con, start_time=None, end_time=None):
+    """
+    Get the SELECT of the facts of a range of snapshots, over their partitions only.
+    The rows of the first and the last month outside the range still have to be filtered out
+
+    Params :
+        - con : DuckDB connection
+        - start_time : datetime, first snapshot of the range, None for no lower bound
+        - end_time : datetime, last snapshot of the range, None for no upper bound
+
+    Returns : sql_statement, string, to be used as a subquery
+    """
+
+    # The template keeps the columns of the view when there is no partition yet
+    partitions = get_fact_partitions(con, start_time, end_time) or [FACT_PARTITION_TEMPLATE]
+
+    return " UNION ALL ".join(f"SELECT * FROM {partition}" for partition in partitions)
+
+
+def refresh_fact_view(con):
+    """
+    Create the FACT_STATION_STATEMENT view again over every partition, once a month is added
+
+    Params :
+        - con : DuckDB connection
+    """
+
+    con.execute(f"CREATE OR REPLACE VIEW {FACT_VIEW} AS {get_fact_sql(con)};")
+
+
+def migrate_fact_table(con):
+    """
+    Move the facts of a database created before the monthly partitions, when FACT_STATION_STATEMENT
+    was a table with a primary key, into their partitions. The facts of a database created before
+    the snapshots, without SNAPSHOT_TIME, are the snapshot of midnight of their CREATED_DATE, as the
+    raw files of the former one-file-per-day layout
+
+    Params :
+        - con : DuckDB connection
+    """
+
+    is_table = con.execute("""
+    SELECT COUNT(*)
+    FROM information_schema.tables
+    WHERE table_type = 'BASE TABLE' AND table_name = ?;
+    """, [FACT_VIEW]).fetchone()[0]
+
+    if not is_table:
+        return
+
+    has_snapshot_time = con.execute("""
+    SELECT COUNT(*)
+    FROM information_schema.columns
+    WHERE table_name = ? AND column_name = 'SNAPSHOT_TIME';
+    """, [FACT_VIEW]).fetchone()[0]
+
+    snapshot_time_sql = "SNAPSHOT_TIME" if has_snapshot_time else "CAST(CREATED_DATE AS TIMESTAMP) AS SNAPSHOT_TIME"
+    con.begin()
+
+    try:
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE FORMER_FACTS AS
+        SELECT STATION_ID, CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, CREATED_DATE, {snapshot_time_sql}
+        FROM {FACT_VIEW};
+        """)
+        con.execute(f"DROP TABLE {FACT_VIEW};")
+        append_facts(con, "SELECT SNAPSHOT_TIME FROM FORMER_FACTS", "SELECT * FROM FORMER_FACTS", {})
+        con.execute("DROP TABLE FORMER_FACTS;")
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
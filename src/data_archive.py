@@ -0,0 +1,138 @@
+import argparse
+import os
+from datetime import datetime
+
+import duckdb
+
+from data_ingestion import SOURCES
+from raw_data import (
+    RAW_DATA_DIRECTORY,
+    SNAPSHOT_DATE_FORMAT,
+    find_snapshot_file,
+    get_archive_path,
+    list_snapshot_times,
+    quote_sql_string
+)
+from source_state import get_file_hash
+
+def archive_raw_data(snapshot_date, delete_json=False):
+    """
+    Convert the raw JSON files of a day into one Parquet file compressed with zstd
+    per source. Snapshots already archived for the day are kept, so a day can be
+    archived again after new snapshots were ingested
+
+    Params :
+        - snapshot_date : string, day formatted as YYYY-MM-DD
+        - delete_json : bool, delete the JSON files once they are archived
+
+    Returns : archived_snapshots, dict, number of JSON snapshots archived for each source
+    """
+
+    archived_snapshots = {}
+    snapshot_times = list_snapshot_times(snapshot_date)
+
+    for source_name, source in SOURCES.items():
+        snapshot_files = []
+
+        for snapshot_time in snapshot_times:
+            file_path = find_snapshot_file(source_name, source["file_name"], snapshot_time)
+            if file_path is not None:
+                snapshot_files.append((file_path, snapshot_time, get_file_hash(file_path)))
+
+        if not snapshot_files:
+            continue
+
+        archive_path = get_archive_path(source_name, snapshot_date)
+        tmp_archive_path = f"{archive_path}.tmp"
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+
+        with duckdb.connect() as con:
+            con.execute("CREATE TEMP TABLE snapshot_files (filename VARCHAR, snapshot_time TIMESTAMP, content_hash VARCHAR);")
+            con.executemany("INSERT INTO snapshot_files VALUES (?, ?, ?);", snapshot_files)
+
+            # Each record keeps the snapshot it comes from, the files are matched through their name
+            sql_statement = """
+            SELECT raw.* EXCLUDE (filename), sf.snapshot_time, sf.content_hash
+            FROM read_json($files, union_by_name = true, filename = true) AS raw
+            JOIN snapshot_files AS sf ON sf.filename = raw.filename
+            """
+
+            # Snapshots archived before and whose JSON file is gone are carried over
+            if os.path.exists(archive_path):
+                sql_statement += """
+                UNION ALL BY NAME
+                SELECT *
+                FROM read_parquet($archive, hive_partitioning = false)
+                WHERE snapshot_time NOT IN (SELECT snapshot_time FROM snapshot_files)
+                """
+
+            parameters = {"files": [file_path for file_path, _, _ in snapshot_files]}
+            if os.path.exists(archive_path):
+                parameters["archive"] = archive_path
+
+            con.execute(f"""
+            COPY ({sql_statement} ORDER BY snapshot_time)
+            TO {quote_sql_string(tmp_archive_path)} (FORMAT PARQUET, COMPRESSION ZSTD);
+            """, parameters)
+
+        os.replace(tmp_archive_path, archive_path)
+        archived_snapshots[source_name] = len(snapshot_files)
+
+        if delete_json:
+            for file_path, _, _ in snapshot_files:
+                os.remove(file_path)
+
+    if delete_json:
+        remove_empty_directories(f"{RAW_DATA_DIRECTORY}/{snapshot_date}")
+
+    return archived_snapshots
+
+def archive_all_raw_data(delete_json=False):
+    """
+    Archive every day of raw data, except today's which is still being ingested
+
+    Params :
+        - delete_json : bool, delete the JSON files once they are archived
+
+    Returns : archived_days, dict, archived snapshots of each source for each day
+    """
+
+    today_date = datetime.now().strftime(SNAPSHOT_DATE_FORMAT)
+    archived_days = {}
+
+    for snapshot_date in sorted(os.listdir(RAW_DATA_DIRECTORY)):
+        if snapshot_date >= today_date or not os.path.isdir(f"{RAW_DATA_DIRECTORY}/{snapshot_date}"):
+            continue
+
+        archived_days[snapshot_date] = archive_raw_data(snapshot_date, delete_json)
+
+    return archived_days
+
+def remove_empty_directories(directory):
+    """
+    Remove a directory tree, keeping the directories that still contain files
+
+    Params :
+        - directory : string, root of the tree
+    """
+
+    if not os.path.isdir(directory):
+        return
+
+    for root, _, _ in sorted(os.walk(directory), key=lambda entry: len(entry[0]), reverse=True):
+        if not os.listdir(root):
+            os.rmdir(root)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive the raw JSON data as compressed Parquet files")
+    parser.add_argument("dates", nargs="*", help="days to archive (YYYY-MM-DD), every day before today by default")
+    parser.add_argument("--delete-json", action="store_true", help="delete the JSON files once they are archived")
+    args = parser.parse_args()
+
+    if args.dates:
+        archived_days = {snapshot_date: archive_raw_data(snapshot_date, args.delete_json) for snapshot_date in args.dates}
+    else:
+        archived_days = archive_all_raw_data(args.delete_json)
+
+    for snapshot_date, archived_snapshots in archived_days.items():
+        print(f"{snapshot_date} archived : {archived_snapshots}")
@@ -0,0 +1,147 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import duckdb
+
+from city_codes import get_city_lookup, set_city_lookup
+from data_agregation import create_agregate_tables, agregate_incremental_data
+from data_consolidation import (
+    create_consolidate_tables,
+    clear_raw_data_cache,
+    transform_snapshot,
+    write_snapshots
+)
+from metrics import extend_run_metrics, format_run_report, get_run_id, get_run_metrics, save_run_metrics, start_run
+from raw_data import SNAPSHOT_DATE_FORMAT, list_snapshot_times
+
+# Number of days transformed at once, one process per day
+MAX_WORKERS = os.cpu_count() or 1
+
+def list_backfill_dates(start_date, end_date):
+    """
+    List the days of a range that have raw data, as JSON files or inside the archive
+
+    Params :
+        - start_date : string, first day formatted as YYYY-MM-DD
+        - end_date : string, last day formatted as YYYY-MM-DD, included
+
+    Returns : snapshot_dates, list of strings
+    """
+
+    current_date = datetime.strptime(start_date, SNAPSHOT_DATE_FORMAT)
+    last_date = datetime.strptime(end_date, SNAPSHOT_DATE_FORMAT)
+    snapshot_dates = []
+
+    while current_date <= last_date:
+        snapshot_date = current_date.strftime(SNAPSHOT_DATE_FORMAT)
+
+        if list_snapshot_times(snapshot_date):
+            snapshot_dates.append(snapshot_date)
+
+        current_date += timedelta(days=1)
+
+    return snapshot_dates
+
+def init_worker(city_lookup, run_id):
+    """
+    Prepare a worker process : the lookup of the INSEE codes and the run its metrics belong to
+
+    Params :
+        - city_lookup : dict, lookup of the INSEE codes, as returned by get_city_lookup
+        - run_id : string, identifier of the run of the main process
+    """
+
+    set_city_lookup(city_lookup)
+    start_run(run_id)
+
+def transform_day(snapshot_date, engine=None):
+    """
+    Transform every snapshot of a day, without opening the database : run inside a
+    worker process, the data frames are sent back to the process writing the database.
+    The duckdb engine maps the raw data with an in-memory database of the worker
+
+    Params :
+        - snapshot_date : string, day formatted as YYYY-MM-DD
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+
+    Returns : (snapshots, run_metrics), list of (snapshot_time, transformed) as written by
+    write_snapshots, and the metrics of the transforms of the day
+    """
+
+    snapshots = []
+
+    # The metrics of the worker are sent back with each day, those of the previous day were already sent
+    start_run(get_run_id())
+
+    with duckdb.connect() as con:
+        for snapshot_time in list_snapshot_times(snapshot_date):
+            snapshots.append((snapshot_time, transform_snapshot(con, snapshot_time, engine)))
+            clear_raw_data_cache()
+
+    return snapshots, get_run_metrics()
+
+def backfill_data(start_date, end_date, max_workers=MAX_WORKERS, engine=None, agregate=False):
+    """
+    Consolidate every day of a range of data/raw_data. The days are transformed in parallel
+    by a pool of processes and written in order by this process, one transaction per day.
+    Cities or commune files missing from a day are skipped
+
+    Params :
+        - start_date : string, first day formatted as YYYY-MM-DD
+        - end_date : string, last day formatted as YYYY-MM-DD, included
+        - max_workers : int, number of processes transforming the days
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+        - agregate : bool, merge the backfilled days into the aggregate tables once they are written
+
+    Returns : backfilled_days, dict, number of rows written into each consolidate table for each day
+    """
+
+    run_id = start_run()
+    create_consolidate_tables()
+    snapshot_dates = list_backfill_dates(start_date, end_date)
+    backfilled_days = {}
+
+    # The workers resolve the INSEE codes with the lookup of this process, they never open the database.
+    # They are spawned, not forked, so that they don't inherit the open DuckDB connection
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(get_city_lookup(), run_id)
+    ) as executor:
+        # The days come back in order, a day is written while the next ones are transformed
+        for snapshot_date, (snapshots, run_metrics) in zip(snapshot_dates, executor.map(transform_day, snapshot_dates, [engine] * len(snapshot_dates))):
+            extend_run_metrics(run_metrics)
+            backfilled_days[snapshot_date] = write_snapshots(snapshots)
+
+    if agregate:
+        create_agregate_tables()
+        agregate_incremental_data()
+
+    save_run_metrics()
+
+    return backfilled_days
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidate a range of days of data/raw_data")
+    parser.add_argument("start_date", help="first day to backfill (YYYY-MM-DD)")
+    parser.add_argument("end_date", nargs="?", help="last day to backfill (YYYY-MM-DD), the first day by default")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="number of days transformed at once")
+    parser.add_argument("--engine", choices=["pandas", "duckdb", "arrow"], help="consolidation engine, CONSOLIDATION_ENGINE by default")
+    parser.add_argument("--agregate", action="store_true", help="merge the backfilled days into the aggregate tables")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    backfilled_days = backfill_data(args.start_date, args.end_date or args.start_date, args.workers, args.engine, args.agregate)
+
+    for snapshot_date, nb_rows in backfilled_days.items():
+        print(f"{snapshot_date} backfilled : {nb_rows}")
+
+    print(f"{len(backfilled_days)} days backfilled in {time.perf_counter() - start:.2f}s")
+
+    for line in format_run_report():
+        print(line)
@@ -1,79 +1,742 @@
-import json
-from datetime import datetime, date
+from datetime import datetime
+from functools import partial
 
 import duckdb
 import pandas as pd
-
-today_date = datetime.now().strftime("%Y-%m-%d")
-
-# Const for each city used
-PARIS_CITY_CODE = 1
-NANTES_CITY_CODE = 2
-TOULOUSE_CITY_CODE = 3
-STRASBOURG_CITY_CODE = 4
-MONTPELLIER_CITY_CODE = 5
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from city_codes import clear_city_codes, get_city_code, resolve_city_codes
+from database import get_connection
+from metrics import record_stage
+from raw_data import get_latest_snapshot_time, get_snapshot_hash, get_snapshot_relation_sql, load_snapshot_data
+from source_state import get_source_state, update_source_state
+from sources import SOURCES, get_station_sources
+from statement_deltas import get_statements_sql, reset_statement_state, write_statement_deltas, write_statement_keyframe
+
+# Consolidation engine used by default
+# - "pandas" : the raw data is loaded with json.load and flattened with pd.json_normalize
+# - "duckdb" : the raw data is read and mapped by DuckDB SQL, it never goes through Python objects
+# - "arrow" : the fields read by the adapters are copied from json.load into Arrow columns and mapped
+#   by pyarrow.compute, the tables are scanned by DuckDB without conversion
+CONSOLIDATION_ENGINE = "pandas"
+
+# Encoding of the statements written into CONSOLIDATE_STATION_STATEMENT
+# - "full" : every statement of every snapshot is stored
+# - "delta" : a snapshot only stores the statements that changed since the previous snapshot, and the removed
+#   stations, the statements are stored in full every STATEMENT_KEYFRAME_INTERVAL (keyframe). The statements
+#   of a snapshot are rebuilt by the SQL of statement_deltas.get_statements_sql whatever their encoding
+STATEMENT_ENCODING = "full"
+
+# Normalized raw data of the city sources, shared by the station and the statement consolidations
+# Keyed by snapshot, source and content hash, emptied by clear_raw_data_cache
+_raw_data_cache = {}
+
+# Consolidate tables written for a snapshot, in order : the cities first, the stations are resolved against them
+CONSOLIDATE_TABLES = ["CONSOLIDATE_CITY", "CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+
+# Consolidate tables partitioned by snapshot : the rows of a source whose raw data is the same as in the
+# partition it was last consolidated into are copied from that partition instead of being parsed again
+REUSED_TABLES = ["CONSOLIDATE_STATION_STATEMENT"]
+
+# Columns of the consolidated data frames of the cities, in the order of their table
+STATION_COLUMNS = ["id", "code", "name", "city_name", "city_code", "address", "longitude", "latitude", "status", "created_date", "capacity"]
+STATION_STATEMENT_COLUMNS = ["station_id", "bicycle_docks_available", "bicycle_available", "last_statement_date", "created_date", "snapshot_time"]
+
+# Columns of a handful of distinct values, dictionary encoded by the arrow engine
+DICTIONARY_COLUMNS = ["city_name", "city_code", "status"]
+
+# Column of the consolidate table of each column of the consolidated data frames. The frames are cast to the
+# types of create_consolidate_tables.sql by validate_consolidated_data, then inserted with these explicit column lists
+CONSOLIDATE_COLUMNS = {
+    "CONSOLIDATE_CITY": {
+        "id": "ID",
+        "name": "NAME",
+        "nb_inhabitants": "NB_INHABITANTS",
+        "created_date": "CREATED_DATE"
+    },
+    "CONSOLIDATE_STATION": dict(zip(STATION_COLUMNS, [
+        "ID", "CODE", "NAME", "CITY_NAME", "CITY_CODE", "ADDRESS", "LONGITUDE", "LATITUDE", "STATUS", "VALID_FROM", "CAPACITTY"
+    ])),
+    "CONSOLIDATE_STATION_STATEMENT": dict(zip(STATION_STATEMENT_COLUMNS, [
+        "STATION_ID", "BICYCLE_DOCKS_AVAILABLE", "BICYCLE_AVAILABLE", "LAST_STATEMENT_DATE", "CREATED_DATE", "SNAPSHOT_TIME"
+    ]))
+}
+
+# Type and nullability of the columns of the consolidate tables, read once by get_consolidate_schema
+_consolidate_schema = None
+
+# Attributes of the stations, CONSOLIDATE_STATION only keeps a new version of a station when one of them changes
+STATION_ATTRIBUTES = ["CODE", "NAME", "CITY_NAME", "CITY_CODE", "ADDRESS", "LONGITUDE", "LATITUDE", "STATUS", "CAPACITTY", "CITY_ID"]
+
+# Stations of CHANGED_STATION observed on each day their source was consolidated : the version valid that day,
+# except on $created_date, where the stations of STATION_OBSERVATION replace it
+STATION_OBSERVED_DAYS_SQL = """
+SELECT cs.ID, load.CREATED_DATE, {attributes}
+FROM CONSOLIDATE_STATION cs
+JOIN CHANGED_STATION changed ON changed.ID = cs.ID
+JOIN CONSOLIDATE_STATION_LOAD load ON load.ID_PREFIX = split_part(cs.ID, '-', 1)
+    AND load.CREATED_DATE >= cs.VALID_FROM
+    AND (cs.VALID_TO IS NULL OR load.CREATED_DATE < cs.VALID_TO)
+WHERE load.CREATED_DATE IS DISTINCT FROM $created_date
+"""
+
+STATION_OBSERVATION_SQL = """
+UNION ALL
+SELECT observation.ID, $created_date, {attributes}
+FROM STATION_OBSERVATION observation
+JOIN CHANGED_STATION changed ON changed.ID = observation.ID
+"""
+
+# Versions of the stations of CHANGED_STATION built from the days they were observed : a version is a run of
+# days of the source with the same attributes, valid until the first day the station is observed otherwise or missing
+STATION_VERSIONS_SQL = """
+WITH observed_days AS (
+    {observed_days}
+), days AS (
+    SELECT changed.ID, load.CREATED_DATE, observed_days.ID IS NOT NULL AS IS_OBSERVED, {observed_attributes}
+    FROM CHANGED_STATION changed
+    JOIN CONSOLIDATE_STATION_LOAD load ON load.ID_PREFIX = split_part(changed.ID, '-', 1)
+    LEFT JOIN observed_days ON observed_days.ID = changed.ID AND observed_days.CREATED_DATE = load.CREATED_DATE
+), changes AS (
+    SELECT *, CASE WHEN {changes} THEN 1 ELSE 0 END AS IS_CHANGE
+    FROM days
+    WINDOW previous_day AS (PARTITION BY ID ORDER BY CREATED_DATE)
+), runs AS (
+    SELECT *, SUM(IS_CHANGE) OVER (PARTITION BY ID ORDER BY CREATED_DATE) AS RUN
+    FROM changes
+), versions AS (
+    SELECT ID, IS_OBSERVED, {attributes}, MIN(CREATED_DATE) AS VALID_FROM,
+        lead(MIN(CREATED_DATE)) OVER (PARTITION BY ID ORDER BY RUN) AS VALID_TO
+    FROM runs
+    GROUP BY ID, RUN, IS_OBSERVED, {attributes}
+)
+SELECT ID, {attributes}, VALID_FROM, VALID_TO, VALID_TO IS NULL AS IS_CURRENT
+FROM versions
+WHERE IS_OBSERVED
+"""
 
 def create_consolidate_tables():
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
     with open("data/sql_statements/create_consolidate_tables.sql") as fd:
         statements = fd.read()
         for statement in statements.split(";"):
             print(statement)
             con.execute(statement)
 
-def consolidate_station_data():
+    migrate_station_table(con)
+
+def migrate_station_table(con):
+    """
+    Turn the daily copies of the stations of a database created before their versions, when
+    CONSOLIDATE_STATION kept every station for every CREATED_DATE, into versions
+
+    Params :
+        - con : DuckDB connection
+    """
+
+    has_daily_copies = con.execute("""
+    SELECT COUNT(*)
+    FROM information_schema.columns
+    WHERE table_name = 'CONSOLIDATE_STATION' AND column_name = 'CREATED_DATE';
+    """).fetchone()[0]
+
+    if not has_daily_copies:
+        return
+
+    attributes = ", ".join(STATION_ATTRIBUTES)
+    con.begin()
+
+    try:
+        # The statements create the table of the versions again
+        con.execute("ALTER TABLE CONSOLIDATE_STATION RENAME TO FORMER_CONSOLIDATE_STATION;")
+        create_consolidate_tables()
+
+        con.execute("""
+        INSERT OR IGNORE INTO CONSOLIDATE_STATION_LOAD
+        SELECT DISTINCT split_part(ID, '-', 1), CREATED_DATE
+        FROM FORMER_CONSOLIDATE_STATION;
+        """)
+
+        # Each copy becomes a version valid until the next day of its source, then the days
+        # with the same attributes are merged into one version
+        con.execute(f"""
+        INSERT INTO CONSOLIDATE_STATION (ID, {attributes}, VALID_FROM, VALID_TO, IS_CURRENT)
+        SELECT former.ID, {", ".join(f"former.{column}" for column in STATION_ATTRIBUTES)}, former.CREATED_DATE, loads.NEXT_DATE, loads.NEXT_DATE IS NULL
+        FROM FORMER_CONSOLIDATE_STATION former
+        JOIN (
+            SELECT ID_PREFIX, CREATED_DATE, lead(CREATED_DATE) OVER (PARTITION BY ID_PREFIX ORDER BY CREATED_DATE) AS NEXT_DATE
+            FROM CONSOLIDATE_STATION_LOAD
+        ) AS loads ON loads.ID_PREFIX = split_part(former.ID, '-', 1) AND loads.CREATED_DATE = former.CREATED_DATE;
+        """)
+        con.execute("CREATE OR REPLACE TEMP TABLE CHANGED_STATION AS SELECT DISTINCT ID FROM CONSOLIDATE_STATION;")
+        rebuild_station_versions(con)
+
+        con.execute("DROP TABLE FORMER_CONSOLIDATE_STATION;")
+        con.commit()
+    except BaseException:
+        con.rollback()
+        # The statements compared with the next snapshot may not have been committed
+        reset_statement_state()
+        raise
+
+def consolidate_station_data(snapshot_time=None, engine=None):
     """
     Call each function for each city that will provide data for the CONSOLIDATE_STATION table
+
+    Params :
+        - snapshot_time : datetime, snapshot to consolidate, the latest one of today by default
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
     """
 
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
+    snapshot_time = resolve_snapshot_time(snapshot_time)
+
+    # Stations are kept once per day, retrieve the data of the cities whose data
+    # changed since they were last consolidated for this day
+    all_data, quarantined_data, consolidated_states = consolidate_changed_sources(con, "CONSOLIDATE_STATION", snapshot_time, snapshot_time.date(), get_station_consolidations(con, engine))
 
-    # Retrieve all data frames
-    paris_data = consolidate_station_paris_data()
-    nantes_data = consolidate_station_nantes_data()
-    toulouse_data = consolidate_station_toulouse_data()
-    strasbourg_data = consolidate_station_strasbourg_data()
-    montpellier_data = consolidate_station_montpellier_data()
+    if all_data is None:
+        return
 
-    # Merge the data frames
-    all_data = [paris_data, nantes_data, toulouse_data, strasbourg_data, montpellier_data]
-    all_data = pd.concat(all_data)
+    write_station_data(con, snapshot_time, all_data)
+    write_quarantined_data(con, "CONSOLIDATE_STATION", snapshot_time, quarantined_data)
 
-    # Push the merged data frame into the CONSOLIDATE_STATION table
-    con.execute("INSERT OR REPLACE INTO CONSOLIDATE_STATION SELECT * FROM all_data;")
+    mark_sources_consolidated("CONSOLIDATE_STATION", consolidated_states)
 
-def consolidate_station_statement_data():
+def consolidate_station_statement_data(snapshot_time=None, engine=None):
     """
-    Call each function for each city that will provide data for the CONSOLIDATE_STATION_STATEMENT table
+    Call each function for each city that will provide data for the CONSOLIDATE_STATION_STATEMENT table,
+    then register the snapshot inside the CONSOLIDATE_SNAPSHOT table
+
+    Params :
+        - snapshot_time : datetime, snapshot to consolidate, the latest one of today by default
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
     """
 
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    con = get_connection()
+    snapshot_time = resolve_snapshot_time(snapshot_time)
+
+    # Statements are kept for every snapshot, retrieve the data of the cities
+    # that were not consolidated yet for this snapshot
+    all_data, quarantined_data, consolidated_states = consolidate_changed_sources(con, "CONSOLIDATE_STATION_STATEMENT", snapshot_time, snapshot_time, get_station_statement_consolidations(con, engine))
+    all_data = add_reused_statements(con, snapshot_time, all_data, consolidated_states)
 
-    # Retrieve all data frames
-    paris_data = consolidate_paris_station_statement_data()
-    nantes_data = consolidate_nantes_station_statement_data()
-    toulouse_data = consolidate_toulouse_station_statement_data()
-    strasbourg_data = consolidate_strasbourg_station_statement_data()
-    montpellier_data = consolidate_montpellier_station_statement_data()
+    if all_data is None:
+        return
 
-    # Merge the data frames
-    all_data = [paris_data, nantes_data, toulouse_data, strasbourg_data, montpellier_data]
-    all_data = pd.concat(all_data)
+    write_station_statement_data(con, snapshot_time, all_data)
+    write_quarantined_data(con, "CONSOLIDATE_STATION_STATEMENT", snapshot_time, quarantined_data)
 
-    # Push the merged data frame into the CONSOLIDATE_STATION_STATEMENT table
-    con.execute("INSERT OR REPLACE INTO CONSOLIDATE_STATION_STATEMENT SELECT * FROM all_data;") 
+    mark_sources_consolidated("CONSOLIDATE_STATION_STATEMENT", consolidated_states)
 
-def consolidate_city_data():
+def consolidate_city_data(snapshot_time=None):
     """
     Retrieve city data and insert it inside the CONSOLIDATE_CITY table
+
+    Params :
+        - snapshot_time : datetime, snapshot to consolidate, the latest one of today by default
+    """
+
+    con = get_connection()
+    snapshot_time = resolve_snapshot_time(snapshot_time)
+
+    city_data, quarantined_data, consolidated_states = consolidate_changed_sources(con, "CONSOLIDATE_CITY", snapshot_time, snapshot_time.date(), get_city_consolidations())
+
+    if city_data is None:
+        return
+
+    write_city_data(con, snapshot_time, city_data)
+    write_quarantined_data(con, "CONSOLIDATE_CITY", snapshot_time, quarantined_data)
+
+    mark_sources_consolidated("CONSOLIDATE_CITY", consolidated_states)
+
+def transform_snapshot(con, snapshot_time, engine=None, source_names=None, table_names=CONSOLIDATE_TABLES):
+    """
+    Run the consolidation functions of a snapshot without writing anything, so that the
+    transforms can run in another thread or process than the writes
+
+    Params :
+        - con : DuckDB connection the relations are built with, for the duckdb engine
+        - snapshot_time : datetime, snapshot to consolidate
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+        - source_names : list of the sources to consolidate, all the sources by default
+        - table_names : list of the consolidate tables to transform
+
+    Returns : transformed, dict holding for each consolidate table the typed data of the
+    changed sources and their quarantined rows (Arrow tables, or None) and their consolidation state
+    """
+
+    consolidations = {
+        "CONSOLIDATE_CITY": (snapshot_time.date(), get_city_consolidations()),
+        "CONSOLIDATE_STATION": (snapshot_time.date(), get_station_consolidations(con, engine)),
+        "CONSOLIDATE_STATION_STATEMENT": (snapshot_time, get_station_statement_consolidations(con, engine))
+    }
+    transformed = {}
+
+    for table_name in table_names:
+        partition, table_consolidations = consolidations[table_name]
+
+        if source_names is not None:
+            table_consolidations = {
+                source_name: consolidation
+                for source_name, consolidation in table_consolidations.items()
+                if source_name in source_names
+            }
+
+        # The Arrow tables hold no reference to the connection, they can be sent to another thread or process
+        transformed[table_name] = consolidate_changed_sources(con, table_name, snapshot_time, partition, table_consolidations)
+
+    return transformed
+
+def write_snapshots(snapshots):
     """
+    Write transformed snapshots inside one transaction, the sources are marked as
+    consolidated once it is committed
+
+    Params :
+        - snapshots : list of (snapshot_time, transformed), transformed as returned by transform_snapshot
 
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
+    Returns : nb_rows, dict, number of rows written into each consolidate table
+    """
+
+    writers = {
+        "CONSOLIDATE_CITY": write_city_data,
+        "CONSOLIDATE_STATION": write_station_data,
+        "CONSOLIDATE_STATION_STATEMENT": write_station_statement_data
+    }
+    nb_rows = {table_name: 0 for table_name in CONSOLIDATE_TABLES}
+
+    con = get_connection()
+    con.begin()
+
+    try:
+        for snapshot_time, transformed in snapshots:
+            for table_name in CONSOLIDATE_TABLES:
+                all_data, quarantined_data, consolidated_states = transformed.get(table_name, (None, None, {}))
+
+                if table_name == "CONSOLIDATE_STATION_STATEMENT":
+                    all_data = add_reused_statements(con, snapshot_time, all_data, consolidated_states)
+
+                if all_data is not None:
+                    writers[table_name](con, snapshot_time, all_data)
+                    write_quarantined_data(con, table_name, snapshot_time, quarantined_data)
+                    nb_rows[table_name] += len(all_data)
+
+        con.commit()
+    except BaseException:
+        con.rollback()
+        # The statements compared with the next snapshot may not have been committed
+        reset_statement_state()
+        raise
+
+    for _, transformed in snapshots:
+        for table_name, (_, _, consolidated_states) in transformed.items():
+            mark_sources_consolidated(table_name, consolidated_states)
+
+    return nb_rows
+
+def get_station_consolidations(con, engine=None):
+    """
+    Get the consolidation function of each city for the CONSOLIDATE_STATION table
+
+    Params :
+        - con : DuckDB connection the relations are built with, for the duckdb engine
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+
+    Returns : consolidations, dict, consolidation function of each source
+    """
+
+    if (engine or CONSOLIDATION_ENGINE) == "duckdb":
+        return {
+            source_name: partial(consolidate_sql_data, con, source_name, build_station_sql(SOURCES[source_name]["adapter"]))
+            for source_name in get_station_sources()
+        }
+
+    if (engine or CONSOLIDATION_ENGINE) == "arrow":
+        return {source_name: partial(consolidate_arrow_station_data, source_name) for source_name in get_station_sources()}
+
+    return {source_name: partial(consolidate_adapter_station_data, source_name) for source_name in get_station_sources()}
+
+def get_station_statement_consolidations(con, engine=None):
+    """
+    Get the consolidation function of each city for the CONSOLIDATE_STATION_STATEMENT table
+
+    Params :
+        - con : DuckDB connection the relations are built with, for the duckdb engine
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+
+    Returns : consolidations, dict, consolidation function of each source
+    """
+
+    if (engine or CONSOLIDATION_ENGINE) == "duckdb":
+        return {
+            source_name: partial(consolidate_sql_data, con, source_name, build_station_statement_sql(SOURCES[source_name]["adapter"]))
+            for source_name in get_station_sources()
+        }
+
+    if (engine or CONSOLIDATION_ENGINE) == "arrow":
+        return {source_name: partial(consolidate_arrow_station_statement_data, source_name) for source_name in get_station_sources()}
+
+    return {source_name: partial(consolidate_adapter_station_statement_data, source_name) for source_name in get_station_sources()}
+
+def get_city_consolidations():
+    """
+    Get the consolidation function of the source of the CONSOLIDATE_CITY table
 
-    # Get data from the JSON file
-    with open(f"data/raw_data/{today_date}/commune_data.json") as fd:
-        data = json.load(fd)
+    Returns : consolidations, dict, consolidation function of each source
+    """
+
+    return {"commune": consolidate_commune_data}
+
+def write_station_data(con, snapshot_time, all_data):
+    """
+    Merge the stations of a snapshot into the CONSOLIDATE_STATION table, only the stations whose
+    attributes changed since the version valid that day, or missing that day, get new versions
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the stations come from
+        - all_data : Arrow table, stations of every city, as typed by validate_consolidated_data
+    """
+
+    columns = get_insert_columns("CONSOLIDATE_STATION")
+    created_date = snapshot_time.date()
+
+    with record_stage("write:CONSOLIDATE_STATION") as metrics:
+        metrics["rows_in"] = len(all_data)
+
+        # The stations observed that day, with the INSEE code of their city, are compared to their versions
+        con.execute(f"CREATE OR REPLACE TEMP TABLE STATION_OBSERVATION AS SELECT {columns}, CAST(NULL AS VARCHAR) AS CITY_ID FROM all_data;")
+
+        station_cities_df = get_station_cities(con, "SELECT CITY_NAME, CITY_CODE FROM STATION_OBSERVATION")
+        con.execute("""
+        UPDATE STATION_OBSERVATION
+        SET CITY_ID = CAST(sc.CITY_ID AS VARCHAR),
+            CITY_CODE = COALESCE(STATION_OBSERVATION.CITY_CODE, CAST(sc.CITY_ID AS VARCHAR))
+        FROM station_cities_df AS sc
+        WHERE sc.CITY_NAME IS NOT DISTINCT FROM STATION_OBSERVATION.CITY_NAME
+            AND sc.CITY_CODE IS NOT DISTINCT FROM STATION_OBSERVATION.CITY_CODE;
+        """)
+
+        # A day after every day already loaded by the sources of the snapshot only appends versions
+        is_new_day = con.execute("""
+        SELECT COUNT(*) = 0
+        FROM CONSOLIDATE_STATION_LOAD
+        WHERE CREATED_DATE >= ? AND ID_PREFIX IN (SELECT DISTINCT split_part(ID, '-', 1) FROM STATION_OBSERVATION);
+        """, [created_date]).fetchone()[0]
+
+        # Every source of the snapshot lists all its stations, the ones it doesn't list anymore are closed
+        con.execute("""
+        INSERT OR IGNORE INTO CONSOLIDATE_STATION_LOAD
+        SELECT DISTINCT split_part(ID, '-', 1), ?
+        FROM STATION_OBSERVATION;
+        """, [created_date])
+
+        changes = " OR ".join(f"observation.{column} IS DISTINCT FROM cs.{column}" for column in STATION_ATTRIBUTES)
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE CHANGED_STATION AS
+        SELECT COALESCE(observation.ID, cs.ID) AS ID
+        FROM STATION_OBSERVATION observation
+        FULL OUTER JOIN (
+            SELECT *
+            FROM CONSOLIDATE_STATION
+            WHERE VALID_FROM <= $created_date AND (VALID_TO IS NULL OR VALID_TO > $created_date)
+                AND split_part(ID, '-', 1) IN (SELECT DISTINCT split_part(ID, '-', 1) FROM STATION_OBSERVATION)
+        ) AS cs ON cs.ID = observation.ID
+        WHERE observation.ID IS NULL OR cs.ID IS NULL OR {changes};
+        """, {"created_date": created_date})
+
+        if is_new_day:
+            metrics["rows_out"] = append_station_versions(con, created_date)
+        else:
+            metrics["rows_out"] = rebuild_station_versions(con, created_date)
+
+        bump_snapshot_versions(con, created_date)
+
+def append_station_versions(con, created_date):
+    """
+    Close the current versions of the stations of CHANGED_STATION and open the versions observed in
+    STATION_OBSERVATION, when created_date comes after every day loaded by their sources
+
+    Params :
+        - con : DuckDB connection
+        - created_date : date, day of the observed stations
+
+    Returns : nb_rows, int, number of versions inserted
+    """
+
+    attributes = ", ".join(STATION_ATTRIBUTES)
+
+    con.execute("""
+    UPDATE CONSOLIDATE_STATION
+    SET VALID_TO = ?, IS_CURRENT = FALSE
+    WHERE IS_CURRENT AND ID IN (SELECT ID FROM CHANGED_STATION);
+    """, [created_date])
+
+    return con.execute(f"""
+    INSERT INTO CONSOLIDATE_STATION (ID, {attributes}, VALID_FROM, VALID_TO, IS_CURRENT)
+    SELECT ID, {attributes}, ?, NULL, TRUE
+    FROM STATION_OBSERVATION
+    WHERE ID IN (SELECT ID FROM CHANGED_STATION);
+    """, [created_date]).fetchone()[0]
+
+def write_station_statement_data(con, snapshot_time, all_data):
+    """
+    Insert the statements of a snapshot inside the CONSOLIDATE_STATION_STATEMENT table, encoded
+    as STATEMENT_ENCODING, and register the snapshot with its keyframe
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the statements come from
+        - all_data : Arrow table, statements of every city, as typed by validate_consolidated_data
+    """
+
+    columns = get_insert_columns("CONSOLIDATE_STATION_STATEMENT")
+
+    with record_stage("write:CONSOLIDATE_STATION_STATEMENT") as metrics:
+        metrics["rows_in"] = len(all_data)
+
+        # Push the typed statements into the CONSOLIDATE_STATION_STATEMENT table, all of them or only the changed ones
+        if STATEMENT_ENCODING == "delta":
+            metrics["rows_out"], keyframe_time = write_statement_deltas(con, snapshot_time, all_data, columns)
+        else:
+            metrics["rows_out"], keyframe_time = write_statement_keyframe(con, snapshot_time, all_data, columns), snapshot_time
+
+        # The sources consolidated into the snapshot, a delta snapshot only rebuilds their stations
+        con.execute("""
+        INSERT OR IGNORE INTO CONSOLIDATE_STATION_STATEMENT_LOAD
+        SELECT DISTINCT split_part(STATION_ID, '-', 1), ?
+        FROM all_data;
+        """, [snapshot_time])
+
+        # The snapshot table is small, looking up the latest snapshot doesn't scan the statements
+        # A snapshot whose statements changed takes a new version, for the incremental aggregation
+        con.execute("""
+        INSERT INTO CONSOLIDATE_SNAPSHOT (SNAPSHOT_TIME, CREATED_DATE, VERSION, KEYFRAME_TIME) VALUES (?, ?, nextval('CONSOLIDATE_VERSION'), ?)
+        ON CONFLICT (SNAPSHOT_TIME) DO UPDATE SET VERSION = excluded.VERSION, KEYFRAME_TIME = excluded.KEYFRAME_TIME;
+        """, [snapshot_time, snapshot_time.date(), keyframe_time])
+        update_latest_snapshot(con, snapshot_time=snapshot_time)
+
+def write_city_data(con, snapshot_time, city_data):
+    """
+    Insert the cities of a snapshot inside the CONSOLIDATE_CITY table
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the cities come from
+        - city_data : Arrow table, cities, as typed by validate_consolidated_data
+    """
+
+    columns = get_insert_columns("CONSOLIDATE_CITY")
+
+    with record_stage("write:CONSOLIDATE_CITY") as metrics:
+        metrics["rows_in"] = len(city_data)
+        metrics["rows_out"] = con.execute(f"INSERT OR REPLACE INTO CONSOLIDATE_CITY ({columns}) SELECT {columns} FROM city_data;").fetchone()[0]
+
+        # The INSEE codes are resolved from the latest snapshot of the cities, which just changed
+        clear_city_codes()
+        update_latest_snapshot(con, city_created_date=str(snapshot_time.date()))
+        bump_snapshot_versions(con, snapshot_time.date())
+
+        # The versions valid that day are valid on other days too
+        for created_date in resolve_station_city_ids(con, snapshot_time.date()):
+            bump_snapshot_versions(con, created_date)
+
+        # Stations of other days consolidated while their city was unknown (a backfill without commune files)
+        for created_date in resolve_station_city_ids(con):
+            bump_snapshot_versions(con, created_date)
+
+def write_quarantined_data(con, table_name, snapshot_time, quarantined_data):
+    """
+    Keep the malformed rows of a snapshot inside the CONSOLIDATE_QUARANTINE table, with the
+    reason they were set aside and the row as consolidated, formatted as JSON
+
+    Params :
+        - con : DuckDB connection
+        - table_name : string, name of the consolidate table the rows were meant for
+        - snapshot_time : datetime, snapshot the rows come from
+        - quarantined_data : Arrow table, as returned by validate_consolidated_data
+    """
+
+    if quarantined_data is None or len(quarantined_data) == 0:
+        return
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_QUARANTINE (TABLE_NAME, SOURCE_NAME, SNAPSHOT_TIME, REASON, RECORD)
+    SELECT ?, SOURCE_NAME, ?, REASON, RECORD
+    FROM quarantined_data;
+    """, [table_name, snapshot_time])
+
+def rebuild_station_versions(con, created_date=None):
+    """
+    Write again the versions of the stations of the CHANGED_STATION table from the days they were
+    observed, so that the versions don't depend on the order the days are consolidated in
+
+    Params :
+        - con : DuckDB connection
+        - created_date : date, day whose observations are replaced by the stations of the STATION_OBSERVATION
+        table, None to keep the observations of every day
+
+    Returns : nb_rows, int, number of versions written
+    """
+
+    attributes = ", ".join(STATION_ATTRIBUTES)
+    observed_days_sql = STATION_OBSERVED_DAYS_SQL.format(attributes=attributes)
+
+    if created_date is not None:
+        observed_days_sql += STATION_OBSERVATION_SQL.format(attributes=", ".join(f"observation.{column}" for column in STATION_ATTRIBUTES))
+
+    changes = " OR ".join(
+        ["lag(CREATED_DATE) OVER previous_day IS NULL"]
+        + [f"{column} IS DISTINCT FROM lag({column}) OVER previous_day" for column in ["IS_OBSERVED"] + STATION_ATTRIBUTES]
+    )
+
+    versions_sql = STATION_VERSIONS_SQL.format(
+        observed_days=observed_days_sql,
+        observed_attributes=", ".join(f"observed_days.{column}" for column in STATION_ATTRIBUTES),
+        attributes=attributes,
+        changes=changes
+    )
+    con.execute(f"CREATE OR REPLACE TEMP TABLE STATION_VERSION AS {versions_sql};", {"created_date": created_date})
+
+    con.execute("DELETE FROM CONSOLIDATE_STATION WHERE ID IN (SELECT ID FROM CHANGED_STATION);")
+
+    return con.execute(f"""
+    INSERT INTO CONSOLIDATE_STATION (ID, {attributes}, VALID_FROM, VALID_TO, IS_CURRENT)
+    SELECT ID, {attributes}, VALID_FROM, VALID_TO, IS_CURRENT
+    FROM STATION_VERSION;
+    """).fetchone()[0]
+
+def get_station_cities(con, sql_statement, parameters=None):
+    """
+    Resolve the INSEE code of each distinct city of stations, once per city
+
+    Params :
+        - con : DuckDB connection
+        - sql_statement : string, SELECT of the CITY_NAME and CITY_CODE of the stations
+        - parameters : list, parameters of the statement, None if there are none
+
+    Returns : station_cities_df, pandas data frame of the CITY_NAME, CITY_CODE and CITY_ID of the cities found
+    """
+
+    station_cities_df = con.execute(f"SELECT DISTINCT CITY_NAME, CITY_CODE FROM ({sql_statement});", parameters or []).df()
+
+    if station_cities_df.empty:
+        return station_cities_df.assign(CITY_ID=None)
+
+    station_cities_df["CITY_ID"] = resolve_city_codes(station_cities_df["CITY_NAME"], station_cities_df["CITY_CODE"])
+
+    return station_cities_df[station_cities_df["CITY_ID"].notna()]
+
+def resolve_station_city_ids(con, created_date=None):
+    """
+    Store the INSEE code of the city of the stations inside CONSOLIDATE_STATION.CITY_ID, so that
+    the aggregation joins on a precomputed key. The stations consolidated before their cities
+    were known also get their CITY_CODE. The versions whose city changed are built again
+
+    Params :
+        - con : DuckDB connection
+        - created_date : date, day whose valid stations are resolved again, None for the versions
+        of every day whose city is not resolved yet
+
+    Returns : created_dates, list of the days whose stations changed city
+    """
+
+    if created_date is None:
+        condition, parameters = "CONSOLIDATE_STATION.CITY_ID IS NULL", []
+    else:
+        condition = "CONSOLIDATE_STATION.VALID_FROM <= ? AND (CONSOLIDATE_STATION.VALID_TO IS NULL OR CONSOLIDATE_STATION.VALID_TO > ?)"
+        parameters = [created_date, created_date]
+
+    station_cities_df = get_station_cities(con, f"SELECT CITY_NAME, CITY_CODE FROM CONSOLIDATE_STATION WHERE {condition}", parameters)
+
+    if station_cities_df.empty:
+        return []
+
+    match_condition = f"""
+        {condition}
+        AND sc.CITY_NAME IS NOT DISTINCT FROM CONSOLIDATE_STATION.CITY_NAME
+        AND sc.CITY_CODE IS NOT DISTINCT FROM CONSOLIDATE_STATION.CITY_CODE
+        AND CAST(sc.CITY_ID AS VARCHAR) IS DISTINCT FROM CONSOLIDATE_STATION.CITY_ID
+    """
+
+    # The days the versions are valid, their facts are aggregated again
+    created_dates = con.execute(f"""
+    SELECT DISTINCT load.CREATED_DATE
+    FROM CONSOLIDATE_STATION
+    JOIN station_cities_df AS sc ON {match_condition}
+    JOIN CONSOLIDATE_STATION_LOAD load ON load.ID_PREFIX = split_part(CONSOLIDATE_STATION.ID, '-', 1)
+        AND load.CREATED_DATE >= CONSOLIDATE_STATION.VALID_FROM
+        AND (CONSOLIDATE_STATION.VALID_TO IS NULL OR load.CREATED_DATE < CONSOLIDATE_STATION.VALID_TO)
+    ORDER BY load.CREATED_DATE;
+    """, parameters).fetchall()
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE CHANGED_STATION AS
+    SELECT DISTINCT CONSOLIDATE_STATION.ID
+    FROM CONSOLIDATE_STATION
+    JOIN station_cities_df AS sc ON {match_condition};
+    """, parameters)
+
+    con.execute(f"""
+    UPDATE CONSOLIDATE_STATION
+    SET CITY_ID = CAST(sc.CITY_ID AS VARCHAR),
+        CITY_CODE = COALESCE(CONSOLIDATE_STATION.CITY_CODE, CAST(sc.CITY_ID AS VARCHAR))
+    FROM station_cities_df AS sc
+    WHERE {match_condition};
+    """, parameters)
+
+    # A version may now have the attributes of the next one
+    rebuild_station_versions(con)
+
+    return [created_date for (created_date,) in created_dates]
+
+def bump_snapshot_versions(con, created_date):
+    """
+    Give a new version to the snapshots of a day whose stations or cities changed, the
+    incremental aggregation merges again every snapshot with a version it didn't process
+
+    Params :
+        - con : DuckDB connection
+        - created_date : date, day whose snapshots changed
+    """
+
+    con.execute("UPDATE CONSOLIDATE_SNAPSHOT SET VERSION = nextval('CONSOLIDATE_VERSION') WHERE CREATED_DATE = ?;", [created_date])
+
+def update_latest_snapshot(con, snapshot_time=None, city_created_date=None):
+    """
+    Move the pointer of CONSOLIDATE_LATEST_SNAPSHOT forward, the aggregation reads the
+    latest snapshot and the latest day of the cities from it instead of scanning the tables.
+    A pointer never goes back when an older day is consolidated again
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot of the statements just consolidated, None to keep the pointer
+        - city_created_date : string, day of the cities just consolidated, None to keep the pointer
+    """
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_LATEST_SNAPSHOT VALUES (1, ?, ?, ?)
+    ON CONFLICT (ID) DO UPDATE SET
+        SNAPSHOT_TIME = GREATEST(SNAPSHOT_TIME, excluded.SNAPSHOT_TIME),
+        CREATED_DATE = GREATEST(CREATED_DATE, excluded.CREATED_DATE),
+        CITY_CREATED_DATE = GREATEST(CITY_CREATED_DATE, excluded.CITY_CREATED_DATE);
+    """, [snapshot_time, snapshot_time.date() if snapshot_time else None, city_created_date])
+
+def consolidate_commune_data(snapshot_time):
+    """
+    Retrieve data from the JSON file of the cities and processes it to match the
+    format and the constraints of the CONSOLIDATE_CITY table
+
+    Params :
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : city_data_df, a pandas data frame containing the consolidated data
+    """
+
+    # Get the raw data, from the JSON file or from the archive
+    data = load_raw_data("commune", snapshot_time)
 
 
     raw_data_df = pd.json_normalize(data)
@@ -82,491 +745,539 @@ def consolidate_city_data():
         "code",
         "nom",
         "population"
-    ]]
-
-    city_data_df.rename(columns={
+    ]].rename(columns={
         "code": "id",
         "nom": "name",
         "population": "nb_inhabitants"
-    }, inplace=True)
+    })
+
+    city_data_df["created_date"] = snapshot_time.date()
+
+    return city_data_df
+
+def resolve_snapshot_time(snapshot_time):
+    """
+    Get the snapshot to consolidate
+
+    Params :
+        - snapshot_time : datetime, snapshot to consolidate or None for the latest one of today
+
+    Returns : snapshot_time, datetime
+    """
 
-    city_data_df["created_date"] = date.today()
+    if snapshot_time is not None:
+        return snapshot_time
 
-    con.execute("INSERT OR REPLACE INTO CONSOLIDATE_CITY SELECT * FROM city_data_df;")
+    snapshot_time = get_latest_snapshot_time()
 
-""" The functions below are used by consolidate_station_data """
+    if snapshot_time is None:
+        raise FileNotFoundError("No raw data snapshot found for today")
 
-def consolidate_station_paris_data():
+    return snapshot_time
+
+def load_raw_data(source_name, snapshot_time):
     """
-    Retrieve data from the JSON file for Paris and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATION 
+    Load the raw data of a source for a snapshot, from its JSON file or from the archive
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, time of the snapshot
 
-    Returns : paris_station_data_df, a pandas data frame containing the consolidated data
+    Returns : data, list of records of the source
     """
 
-    # Get data from the JSON file
-    data = {}
+    data = load_snapshot_data(source_name, SOURCES[source_name]["file_name"], snapshot_time)
 
-    with open(f"data/raw_data/{today_date}/paris_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-    
-    # Format the data
-    paris_raw_data_df = pd.json_normalize(data)
-    paris_raw_data_df = consolidate_format_df(paris_raw_data_df, "stationcode", PARIS_CITY_CODE)
+    if data is None:
+        raise FileNotFoundError(f"No raw data for {source_name} in the snapshot of {snapshot_time}")
 
-    # Standardization of the status between all APIs
-    paris_raw_data_df["is_installed"] = paris_raw_data_df["is_installed"].apply(lambda x: "OPEN" if x == "OUI" else "CLOSED")
-
-    paris_station_data_df = paris_raw_data_df[[
-        "id",
-        "stationcode",
-        "name",
-        "nom_arrondissement_communes",
-        "code_insee_commune",
-        "address",
-        "coordonnees_geo.lon",
-        "coordonnees_geo.lat",
-        "is_installed",
-        "created_date",
-        "capacity"
-    ]]
-
-    # Rename the columns of the data frame
-    paris_station_data_df.rename(columns={
-        "stationcode": "code",
-        "name": "name",
-        "coordonnees_geo.lon": "longitude",
-        "coordonnees_geo.lat": "latitude",
-        "is_installed": "status",
-        "nom_arrondissement_communes": "city_name",
-        "code_insee_commune": "city_code"
-    }, inplace=True)
-
-    return paris_station_data_df
-
-def consolidate_station_nantes_data():
-    """
-    Retrieve data from the JSON file for Nantes and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATION 
-
-    Returns : nantes_station_data_df, a pandas data frame containing the consolidated data
-    """
-    
-    # Get data from the JSON file
-    data = {}
-
-    with open(f"data/raw_data/{today_date}/nantes_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-    
-    # Format the data
-    nantes_raw_data_df = pd.json_normalize(data)
-    nantes_raw_data_df = consolidate_format_df(nantes_raw_data_df, "number", NANTES_CITY_CODE)
-    nantes_raw_data_df["code_insee_commune"] = get_insee_code("Nantes")
-
-    nantes_station_data_df = nantes_raw_data_df[[
-        "id",
-        "number",
-        "name",
-        "contract_name",
-        "address",
-        "position.lon",
-        "position.lat",
-        "status",
-        "created_date",
-        "bike_stands",
-        "code_insee_commune"
-    ]]
-
-    # Rename the columns of the data frame
-    nantes_station_data_df.rename(columns={
-        "number": "code",
-        "position.lon": "longitude",
-        "position.lat": "latitude",
-        "contract_name": "city_name",
-        "code_insee_commune": "city_code",
-        "bike_stands": "capacity"
-    }, inplace=True)
-
-    return nantes_station_data_df
-
-def consolidate_station_toulouse_data():
-    """
-    Retrieve data from the JSON file for Toulouse and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATION 
-
-    Returns : toulouse_station_data_df, a pandas data frame containing the consolidated data
-    """
-    
-    # Get data from the JSON file
-    data = {}
-    
-    with open(f"data/raw_data/{today_date}/toulouse_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-    
-    # Format the data
-    toulouse_raw_data_df = pd.json_normalize(data)
-    toulouse_raw_data_df = consolidate_format_df(toulouse_raw_data_df, "number", TOULOUSE_CITY_CODE)
-    toulouse_raw_data_df["code_insee_commune"] = get_insee_code("Toulouse")
-
-    toulouse_station_data_df = toulouse_raw_data_df[[
-        "id",
-        "number",
-        "name",
-        "contract_name",
-        "address",
-        "position.lon",
-        "position.lat",
-        "status",
-        "created_date",
-        "bike_stands",
-        "code_insee_commune"
-    ]]
-
-    # Rename the columns of the data frame
-    toulouse_station_data_df.rename(columns={
-        "number": "code",
-        "position.lon": "longitude",
-        "position.lat": "latitude",
-        "contract_name": "city_name",
-        "code_insee_commune": "city_code",
-        "bike_stands": "capacity"
-    }, inplace=True)
-
-    return toulouse_station_data_df
-
-def consolidate_station_strasbourg_data():
-    """
-    Retrieve data from the JSON file for Strasbourg and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATION 
-
-    Returns : strasbourg_station_data_df, a pandas data frame containing the consolidated data
-    """
-    
-    # Get data from the JSON file
-    data = {}
-    
-    with open(f"data/raw_data/{today_date}/strasbourg_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-    
-    # Format the data
-    strasbourg_raw_data_df = pd.json_normalize(data)
-    strasbourg_raw_data_df["number"] = strasbourg_raw_data_df["id"]
-    strasbourg_raw_data_df = consolidate_format_df(strasbourg_raw_data_df, "id", STRASBOURG_CITY_CODE)
-    strasbourg_raw_data_df["code_insee_commune"] = get_insee_code("Strasbourg")
+    return data
 
-    # Standardization of the status between all APIs
-    strasbourg_raw_data_df["is_installed"] = strasbourg_raw_data_df["is_installed"].apply(lambda x: "OPEN" if x == "1" else "CLOSED")
-
-    # There's no information about the name of the city inside the dataset. Therefore, city_name is forced
-    strasbourg_raw_data_df["city_name"] = "strasbourg"
-
-    strasbourg_station_data_df = strasbourg_raw_data_df[[
-        "id",
-        "number",
-        "na",
-        "city_name",
-        "address",
-        "lon",
-        "lat",
-        "is_installed",
-        "created_date",
-        "to",
-        "code_insee_commune"
-    ]]
-
-    # Rename the columns of the data frame
-    strasbourg_station_data_df.rename(columns={
-        "number": "code",
-        "is_installed": "status",
-        "lon": "longitude",
-        "lat": "latitude",
-        "code_insee_commune": "city_code",
-        "na": "name",
-        "to": "capacity"
-    }, inplace=True)
-
-    return strasbourg_station_data_df
-
-def consolidate_station_montpellier_data():
-    """
-    Retrieve data from the JSON file for Montpellier and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATION 
-
-    Returns : montpellier_station_data_df, a pandas data frame containing the consolidated data
-    """
-    
-    # Get data from the JSON file
-    data = {}
-    
-    with open(f"data/raw_data/{today_date}/montpellier_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-    
-    montpellier_raw_data_df = pd.json_normalize(data)
-    montpellier_raw_data_df["number"] = montpellier_raw_data_df["id"].str[-3:]
-    montpellier_raw_data_df = consolidate_format_df(montpellier_raw_data_df, "number", MONTPELLIER_CITY_CODE)
-    montpellier_raw_data_df["code_insee_commune"] = get_insee_code("Montpellier")
+def load_raw_data_frame(source_name, snapshot_time):
+    """
+    Load the raw data of a city source for a snapshot as a normalized data frame.
+    The station and the statement consolidations both read every city, the frame is
+    parsed on the first call and kept in a cache until clear_raw_data_cache is called
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : raw_data_df, a pandas data frame, a shallow copy that the caller can modify
+    """
+
+    cache_key = (snapshot_time, source_name, get_raw_content_hash(source_name, snapshot_time))
+
+    if cache_key not in _raw_data_cache:
+        _raw_data_cache[cache_key] = pd.json_normalize(load_raw_data(source_name, snapshot_time))
+
+    return _raw_data_cache[cache_key].copy(deep=False)
+
+def clear_raw_data_cache():
+    """
+    Free the normalized raw data kept by load_raw_data_frame, once the consolidation is done
+    """
+
+    _raw_data_cache.clear()
+
+def get_raw_content_hash(source_name, snapshot_time):
+    """
+    Get the content hash of the raw data of a source for a snapshot
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : content_hash, string
+    """
+
+    content_hash = get_snapshot_hash(source_name, SOURCES[source_name]["file_name"], snapshot_time)
+
+    if content_hash is None:
+        raise FileNotFoundError(f"No raw data for {source_name} in the snapshot of {snapshot_time}")
+
+    return content_hash
+
+def consolidate_changed_sources(con, table_name, snapshot_time, partition, consolidations):
+    """
+    Run the consolidation of each source whose raw file changed since it was last
+    consolidated into the partition of table_name, then validate their data against the
+    table. A source with the same content hash as the last one consolidated into the same
+    partition is already inside the table, it is not parsed again. For a table of REUSED_TABLES,
+    a source with the same content hash as in another partition isn't parsed either, its state
+    holds that "reused_partition" for add_reused_statements. A source without raw data for the
+    snapshot is skipped
+
+    Params :
+        - con : DuckDB connection the data is validated with
+        - table_name : string, name of the consolidate table
+        - snapshot_time : datetime, snapshot to consolidate
+        - partition : date or datetime, key of the rows written into the table (day or snapshot)
+        - consolidations : dict, consolidation function of each source
+
+    Returns : (all_data, quarantined_data, consolidated_states), the typed data of the changed
+    sources and their malformed rows, as Arrow tables (None when no source changed), and their
+    new consolidation state, to record with mark_sources_consolidated
+    """
+
+    sources_data = {}
+    consolidated_states = {}
+
+    for source_name, consolidation in consolidations.items():
+        content_hash = get_snapshot_hash(source_name, SOURCES[source_name]["file_name"], snapshot_time)
+
+        # A city can be missing from a snapshot (old days, failed ingestion), the other ones are still consolidated
+        if content_hash is None:
+            print(f"No raw data for {source_name} in the snapshot of {snapshot_time}, skipped.")
+            continue
+
+        consolidated_state = {"partition": str(partition), "content_hash": content_hash}
+        previous_state = get_source_state(table_name, source_name)
+
+        if previous_state == consolidated_state:
+            print(f"Source {source_name} unchanged since its last consolidation into {table_name}, skipped.")
+            continue
+
+        # An unchanged source polled again gives the same rows as in its previous snapshot
+        if table_name in REUSED_TABLES and previous_state is not None and previous_state["content_hash"] == content_hash:
+            print(f"Source {source_name} unchanged since the snapshot of {previous_state['partition']}, its rows are copied.")
+            consolidated_states[source_name] = {**consolidated_state, "reused_partition": previous_state["partition"]}
+            continue
+
+        with record_stage(f"consolidate:{table_name}", source_name) as metrics:
+            data = consolidation(snapshot_time)
+
+            # A DuckDB relation is only counted once it is validated
+            if isinstance(data, (pd.DataFrame, pa.Table)):
+                metrics["rows_out"] = len(data)
+
+        sources_data[source_name] = data
+        consolidated_states[source_name] = consolidated_state
+
+    if not sources_data:
+        return None, None, consolidated_states
+
+    # The sources are validated at once, a query per source would cost more than the casts themselves
+    with record_stage(f"validate:{table_name}") as metrics:
+        all_data, quarantined_data = validate_consolidated_data(con, table_name, sources_data)
+        metrics["rows_out"] = len(all_data)
+        metrics["rows_quarantined"] = len(quarantined_data)
+
+    if len(quarantined_data):
+        print(f"{len(quarantined_data)} malformed rows quarantined instead of being written into {table_name}.")
+
+    return all_data, quarantined_data, consolidated_states
+
+def get_consolidate_schema():
+    """
+    Get the type and the nullability of each column of the consolidate tables, as created by
+    create_consolidate_tables.sql. The statements are run once inside an in-memory database,
+    so that the schema is known without the database of the project, e.g. by a backfill worker
+
+    Returns : schema, dict, for each table a dict of (type, nullable) by column
+    """
+
+    global _consolidate_schema
+
+    if _consolidate_schema is None:
+        schema = {}
+
+        with duckdb.connect() as con:
+            with open("data/sql_statements/create_consolidate_tables.sql") as fd:
+                for statement in fd.read().split(";"):
+                    con.execute(statement)
+
+            for table_name, column_name, data_type, is_nullable in con.execute("""
+            SELECT table_name, column_name, data_type, is_nullable
+            FROM information_schema.columns
+            ORDER BY table_name, ordinal_position;
+            """).fetchall():
+                schema.setdefault(table_name, {})[column_name] = (data_type, is_nullable == "YES")
+
+        _consolidate_schema = schema
+
+    return _consolidate_schema
+
+def get_insert_columns(table_name):
+    """
+    Get the explicit column list the typed data of a consolidate table is inserted with
+
+    Params :
+        - table_name : string, name of the consolidate table
+
+    Returns : columns, string, columns separated by commas
+    """
+
+    return ", ".join(CONSOLIDATE_COLUMNS[table_name].values())
+
+def validate_consolidated_data(con, table_name, sources_data):
+    """
+    Cast the consolidated data of the sources to the types of their consolidate table, with the
+    casts DuckDB applies on insert. The rows holding a value that can't be cast, or no value
+    for a NOT NULL column, are set aside instead of failing the whole insert
+
+    Params :
+        - con : DuckDB connection the data is cast with
+        - table_name : string, name of the consolidate table
+        - sources_data : dict, pandas data frame, Arrow table or DuckDB relation of each source
+
+    Returns : (valid_data, quarantined_data), Arrow tables : the rows typed as the columns of the
+    table, and the SOURCE_NAME, REASON and RECORD (the row as JSON) of each malformed row
+    """
+
+    relation = None
+
+    for source_name, data in sources_data.items():
+        source_relation = get_consolidated_relation(con, data).project(f"*, {get_sql_literal(source_name)} AS _SOURCE_NAME")
+        relation = source_relation if relation is None else relation.union(source_relation)
+
+    schema = get_consolidate_schema()[table_name]
+    source_types = dict(zip(relation.columns, (str(source_type) for source_type in relation.types)))
+    casts = []
+    checks = []
+    fields = []
+
+    for column, table_column in CONSOLIDATE_COLUMNS[table_name].items():
+        data_type, nullable = schema[table_column]
+        casts.append(f'TRY_CAST("{column}" AS {data_type}) AS {table_column}')
+        fields.append(f"'{column}': \"{column}\"")
+
+        # Every value can be cast to a string, and a value of the right type is already valid
+        if data_type != "VARCHAR" and source_types[column] != data_type:
+            checks.append(f"WHEN \"{column}\" IS NOT NULL AND TRY_CAST(\"{column}\" AS {data_type}) IS NULL THEN 'invalid {table_column}'")
+
+        if not nullable:
+            checks.append(f"WHEN \"{column}\" IS NULL THEN 'missing {table_column}'")
+
+    reason_sql = f"CASE {' '.join(checks)} END" if checks else "NULL"
+
+    typed_data = relation.project(f"*, {reason_sql} AS _REASON").project(f"""
+        {", ".join(casts)},
+        _SOURCE_NAME AS SOURCE_NAME,
+        _REASON AS REASON,
+        CASE WHEN _REASON IS NOT NULL THEN CAST(to_json({{{", ".join(fields)}}}) AS VARCHAR) END AS RECORD
+    """).to_arrow_table()
+
+    reasons = typed_data["REASON"]
+    valid_data = typed_data.drop_columns(["SOURCE_NAME", "REASON", "RECORD"])
+    quarantined_data = typed_data.select(["SOURCE_NAME", "REASON", "RECORD"]).filter(pc.is_valid(reasons))
+
+    # Most snapshots have no malformed row, the typed columns are then kept without a copy
+    if len(quarantined_data):
+        valid_data = valid_data.filter(pc.is_null(reasons))
+
+    return valid_data, quarantined_data
+
+def get_consolidated_relation(con, data):
+    """
+    Get the consolidated data of a source as a DuckDB relation. A data frame is converted to
+    Arrow first, which is much faster than the scan of a data frame of object columns by DuckDB.
+    The columns mixing several types can't be converted, such frames are scanned by DuckDB.
+    An Arrow table is scanned as it is, without any copy
+
+    Params :
+        - con : DuckDB connection
+        - data : pandas data frame, Arrow table or DuckDB relation
+
+    Returns : relation, a DuckDB relation
+    """
+
+    if isinstance(data, pa.Table):
+        return con.from_arrow(data)
+
+    if not isinstance(data, pd.DataFrame):
+        return data
+
+    try:
+        return con.from_arrow(pa.Table.from_pandas(data, preserve_index=False))
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return con.from_df(data)
+
+def add_reused_statements(con, snapshot_time, all_data, consolidated_states):
+    """
+    Add the statements of the sources unchanged since a previous snapshot, as found by
+    consolidate_changed_sources, to the statements of the changed sources. They are rebuilt
+    from the previous snapshot of each source, whatever their encoding, and moved to this snapshot
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the statements are written into
+        - all_data : Arrow table, statements of the changed sources, None when no source changed
+        - consolidated_states : dict, consolidation state of each source
+
+    Returns : all_data, Arrow table of the statements of every source, None when there isn't any
+    """
+
+    reused_data = [] if all_data is None else [all_data]
+
+    for source_name, consolidated_state in consolidated_states.items():
+        if "reused_partition" not in consolidated_state:
+            continue
+
+        with record_stage("reuse:CONSOLIDATE_STATION_STATEMENT", source_name) as metrics:
+            data = con.execute(f"""
+            SELECT STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE,
+                CAST($created_date AS VARCHAR) AS CREATED_DATE, $snapshot_time AS SNAPSHOT_TIME
+            FROM ({get_statements_sql("SELECT CAST($reused_partition AS TIMESTAMP) AS SNAPSHOT_TIME")})
+            WHERE split_part(STATION_ID, '-', 1) = $prefix;
+            """, {
+                "created_date": snapshot_time.date(),
+                "snapshot_time": snapshot_time,
+                "reused_partition": consolidated_state["reused_partition"],
+                "prefix": str(SOURCES[source_name]["adapter"]["city_code"])
+            }).to_arrow_table()
+            metrics["rows_out"] = len(data)
+
+        reused_data.append(data if not reused_data else data.cast(reused_data[0].schema))
+
+    if not reused_data:
+        return None
+
+    return pa.concat_tables(reused_data)
+
+def mark_sources_consolidated(table_name, consolidated_states):
+    """
+    Record the sources consolidated into table_name, once they are inserted
+
+    Params :
+        - table_name : string, name of the consolidate table
+        - consolidated_states : dict, consolidation state of each source
+    """
+
+    # The partition the rows of a source were copied from only matters to their write
+    for source_name, consolidated_state in consolidated_states.items():
+        update_source_state(table_name, source_name, {
+            "partition": consolidated_state["partition"],
+            "content_hash": consolidated_state["content_hash"]
+        })
+
+""" The functions below are the generic consolidation engine, driven by the adapter of each source of SOURCES """
+
+def consolidate_adapter_station_data(source_name, snapshot_time):
+    """
+    Retrieve the raw data of a city and map it with the adapter of the source to match the
+    format and the constraints of the CONSOLIDATE_STATION
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : station_data_df, a pandas data frame containing the consolidated data
+    """
+
+    adapter = SOURCES[source_name]["adapter"]
+
+    # Get the normalized raw data, parsed once for both the station and the statement consolidations
+    raw_data_df = load_raw_data_frame(source_name, snapshot_time)
+    code = get_adapter_field(raw_data_df, adapter["station_code"])
+
+    columns = {
+        "id": build_station_id(code, adapter["city_code"]),
+        "code": code,
+        "address": None,
+        "created_date": snapshot_time.date()
+    }
+
+    # The sources without INSEE code get the one of their city
+    if "city_code" not in adapter["station_fields"]:
+        columns["city_code"] = get_insee_code(adapter["city"])
+
+    for column, field in adapter["station_fields"].items():
+        columns[column] = get_adapter_field(raw_data_df, field)
+
+    # The constants are repeated along the columns taken from the raw data
+    return pd.DataFrame({column: columns[column] for column in STATION_COLUMNS})
+
+def consolidate_adapter_station_statement_data(source_name, snapshot_time):
+    """
+    Retrieve the raw data of a city and map it with the adapter of the source to match the
+    format and the constraints of the CONSOLIDATE_STATION_STATEMENT
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : station_statement_data_df, a pandas data frame containing the consolidated data
+    """
+
+    adapter = SOURCES[source_name]["adapter"]
+
+    # Get the normalized raw data, parsed once for both the station and the statement consolidations
+    raw_data_df = load_raw_data_frame(source_name, snapshot_time)
+
+    columns = {
+        "station_id": build_station_id(get_adapter_field(raw_data_df, adapter["station_code"]), adapter["city_code"]),
+        "created_date": snapshot_time.date(),
+        "snapshot_time": snapshot_time
+    }
+
+    for column, field in adapter["statement_fields"].items():
+        columns[column] = get_adapter_field(raw_data_df, field)
+
+    return pd.DataFrame({column: columns[column] for column in STATION_STATEMENT_COLUMNS})
+
+def get_adapter_field(raw_data_df, field):
+    """
+    Get the values of a field of an adapter from the raw data of a city
+
+    Params :
+        - raw_data_df : pandas data frame, normalized raw data of the city
+        - field : string or dict, field as described in SOURCES
+
+    Returns : values, pandas series, or the constant of the field
+    """
+
+    if isinstance(field, str):
+        field = {"field": field}
+
+    if "value" in field:
+        return field["value"]
+
+    values = raw_data_df[field["field"]]
+
+    if "item" in field:
+        values = split_list_column(values, list(range(field["item"] + 1)))[field["item"]]
+
+    if "suffix" in field:
+        values = values.str[-field["suffix"]:]
+
+    if field.get("epoch"):
+        values = convert_epoch_to_datetime(values)
 
     # Standardization of the status between all APIs
-    montpellier_raw_data_df["status.value"] = montpellier_raw_data_df["status.value"].apply(lambda x: "OPEN" if x == "working" else "CLOSED")
-
-    # The coordinates are formatted inside a list. Unwind it to get only the longitude and the latitude
-    montpellier_raw_data_df["longitude"] = montpellier_raw_data_df["location.value.coordinates"].apply(lambda x: x[0])
-    montpellier_raw_data_df["latitude"] = montpellier_raw_data_df["location.value.coordinates"].apply(lambda x: x[1])
-
-    montpellier_station_data_df = montpellier_raw_data_df[[
-        "id",
-        "number",
-        "address.value.streetAddress",
-        "address.value.addressLocality",
-        "address",
-        "longitude",
-        "latitude",
-        "status.value",
-        "created_date",
-        "totalSlotNumber.value",
-        "code_insee_commune"
-    ]]
-
-    # Rename the columns of the data frame
-    montpellier_station_data_df.rename(columns={
-        "number": "code",
-        "status.value": "status",
-        "address.value.addressLocality": "city_name",
-        "code_insee_commune": "city_code",
-        "address.value.streetAddress": "name",
-        "totalSlotNumber.value": "capacity"
-    }, inplace=True)
-
-    return montpellier_station_data_df
-
-""" The functions below are used by consolidate_station_statement_data """
-
-def consolidate_paris_station_statement_data():
-    """
-    Retrieve data from the JSON file for Paris and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATEMENT_STATION 
-
-    Returns : paris_station_data_df, a pandas data frame containing the consolidated data
-    """
-    
-    # Get data from the JSON file
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
-
-    with open(f"data/raw_data/{today_date}/paris_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-
-    # Format the data
-    paris_raw_data_df = pd.json_normalize(data)
-    paris_raw_data_df = consolidate_statement_city_data(paris_raw_data_df, "stationcode", PARIS_CITY_CODE)
-
-    paris_station_statement_data_df = paris_raw_data_df[[
-        "station_id",
-        "numdocksavailable",
-        "numbikesavailable",
-        "duedate",
-        "created_date"
-    ]]
-    
-    # Rename the columns of the data frame
-    paris_station_statement_data_df.rename(columns={
-        "numdocksavailable": "bicycle_docks_available",
-        "numbikesavailable": "bicycle_available",
-        "duedate": "last_statement_date",
-    }, inplace=True)
-
-    return paris_station_statement_data_df
-
-def consolidate_nantes_station_statement_data():
-    """
-    Retrieve data from the JSON file for Nantes and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATEMENT_STATION 
-
-    Returns : nantes_station_data_df, a pandas data frame containing the consolidated data
-    """
-
-    # Get data from the JSON file
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
-
-    with open(f"data/raw_data/{today_date}/nantes_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-
-    # Format the data
-    nantes_raw_data_df = pd.json_normalize(data)
-    nantes_raw_data_df = consolidate_statement_city_data(nantes_raw_data_df, "number", NANTES_CITY_CODE)
-    
-    nantes_station_statement_data_df = nantes_raw_data_df[[
-        "station_id",
-        "available_bike_stands",
-        "available_bikes",
-        "last_update",
-        "created_date"
-    ]]
-    
-    # Rename columns of the data frame
-    nantes_station_statement_data_df.rename(columns={
-        "available_bike_stands": "bicycle_docks_available",
-        "available_bikes": "bicycle_available",
-        "last_update": "last_statement_date",
-    }, inplace=True)
-
-    return nantes_station_statement_data_df
-
-def consolidate_toulouse_station_statement_data():
-    """
-    Retrieve data from the JSON file for Toulouse and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATEMENT_STATION 
-
-    Returns : toulouse_station_data_df, a pandas data frame containing the consolidated data
-    """
-
-    # Get data from the JSON file
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
-
-    with open(f"data/raw_data/{today_date}/toulouse_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-
-    # Format the data
-    toulouse_raw_data_df = pd.json_normalize(data)
-    toulouse_raw_data_df = consolidate_statement_city_data(toulouse_raw_data_df, "number", TOULOUSE_CITY_CODE)
+    if "open_value" in field:
+        values = normalize_status(values, field["open_value"])
+
+    return values
+
+""" The functions below transform whole columns at once, they are used instead of row by row lambdas """
+
+def build_station_id(series, code):
+    """
+    Build the station identifiers of a city, formatted as <city code>-<station code>
 
-    toulouse_station_statement_data_df = toulouse_raw_data_df[[
-        "station_id",
-        "available_bike_stands",
-        "available_bikes",
-        "last_update",
-        "created_date"
-    ]]
-    
-    # Rename columns of the data frame
-    toulouse_station_statement_data_df.rename(columns={
-        "available_bike_stands": "bicycle_docks_available",
-        "available_bikes": "bicycle_available",
-        "last_update": "last_statement_date",
-    }, inplace=True)
-
-    return toulouse_station_statement_data_df
-
-def consolidate_strasbourg_station_statement_data():
-    """
-    Retrieve data from the JSON file for Strasbourg and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATEMENT_STATION 
-
-    Returns : strasbourg_station_data_df, a pandas data frame containing the consolidated data
-    """
-
-    # Get data from the JSON file
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
-
-    with open(f"data/raw_data/{today_date}/strasbourg_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
-
-    # Format the data
-    strasbourg_raw_data_df = pd.json_normalize(data)
-    strasbourg_raw_data_df = consolidate_statement_city_data(strasbourg_raw_data_df, "id", STRASBOURG_CITY_CODE)
+    Params :
+        - series : pandas series, station codes
+        - code : const, city code used
 
-    # The date is a timestamp, need to convert it to a datetime
-    strasbourg_raw_data_df["last_reported"] = strasbourg_raw_data_df["last_reported"].apply(lambda x: datetime.fromtimestamp(int(x)))
+    Returns : station_ids, pandas series of strings, missing where the station code is missing
+    """
 
-    strasbourg_station_statement_data_df = strasbourg_raw_data_df[[
-        "station_id",
-        "av",
-        "to",
-        "last_reported",
-        "created_date"
-    ]]
-    
-    # Rename the columns of the data frame
-    strasbourg_station_statement_data_df.rename(columns={
-        "av": "bicycle_docks_available",
-        "to": "bicycle_available",
-        "last_reported": "last_statement_date",
-    }, inplace=True)
-
-    return strasbourg_station_statement_data_df
-
-def consolidate_montpellier_station_statement_data():
-    """
-    Retrieve data from the JSON file for Montpellier and processes it to match the 
-    format and the constraints of the CONSOLIDATE_STATEMENT_STATION 
-
-    Returns : montpellier_station_data_df, a pandas data frame containing the consolidated data
-    """
-
-    # Get data from the JSON file
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
-    data = {}
+    station_ids = f"{code}-" + series.astype(str)
 
-    with open(f"data/raw_data/{today_date}/montpellier_realtime_bicycle_data.json") as fd:
-        data = json.load(fd)
+    # A missing code would give "<city code>-None", the row is quarantined by the validation instead
+    if series.hasnans:
+        station_ids = station_ids.where(series.notna())
 
-    # Format the data
-    montpellier_raw_data_df = pd.json_normalize(data)
-    montpellier_raw_data_df["id"] = montpellier_raw_data_df["id"].str[-3:]
+    return station_ids
 
-    montpellier_raw_data_df = consolidate_statement_city_data(montpellier_raw_data_df, "id", MONTPELLIER_CITY_CODE)
 
-    montpellier_station_statement_data_df = montpellier_raw_data_df[[
-        "station_id",
-        "availableBikeNumber.value",
-        "totalSlotNumber.value",
-        "availableBikeNumber.metadata.timestamp.value",
-        "created_date"
-    ]]
-    
-    # Rename the columns of the date frame
-    montpellier_station_statement_data_df.rename(columns={
-        "availableBikeNumber.value": "bicycle_docks_available",
-        "totalSlotNumber.value": "bicycle_available",
-        "availableBikeNumber.metadata.timestamp.value": "last_statement_date",
-    }, inplace=True)
+def normalize_status(series, open_value):
+    """
+    Standardize the status of the stations between all APIs, the only values kept are "OPEN" and "CLOSED"
 
-    return montpellier_station_statement_data_df
-    
+    Params :
+        - series : pandas series, status as given by the API
+        - open_value : string, value of an open station, compared to the string form of the status
 
-def consolidate_format_df(df, column_source, code):
+    Returns : status, pandas series of strings
     """
-    Format a data frame that will be used for the table CONSOLIDATE_STATION
 
-    Params : 
-        - df : pandas data frame, containing the data
-        - column_source : string, name of the column where the station code is
-        - code : const, city code used 
+    status = pd.Series("CLOSED", index=series.index, dtype=object)
+    status[series.astype(str) == open_value] = "OPEN"
+
+    return status
+
+
+def split_list_column(series, names):
+    """
+    Split a column of lists into one column per position, all the positions at once
+
+    Params :
+        - series : pandas series, lists
+        - names : list of the names of the columns, one per position kept
 
-    Returns : df, pandas data frame modified
+    Returns : items, pandas data frame
     """
-    
-    df["id"] = df[column_source].apply(lambda x: f"{code}-{x}")
-    df["address"] = None
-    df["created_date"] = date.today()
 
-    return df
+    items = pd.DataFrame(series.tolist(), index=series.index)
 
+    return items.iloc[:, :len(names)].set_axis(names, axis=1)
 
-def consolidate_statement_city_data(df, column_source, code):
+
+def convert_epoch_to_datetime(series):
     """
-    Format a data frame that will be used for the table CONSOLIDATE_STATION_STATEMENT
+    Convert Unix timestamps (in seconds) to local naive datetimes, as datetime.fromtimestamp does.
+    The stations of an export share a handful of report times, each distinct timestamp
+    is converted once and the column is mapped on the result. A missing timestamp stays missing,
+    a value that isn't a number is kept as it is, so that validate_consolidated_data quarantines its row
 
-    Params : 
-        - df : pandas data frame, containing the data
-        - column_source : string, name of the column where the station code is
-        - code : const, city code used 
+    Params :
+        - series : pandas series, timestamps as integers or strings
 
-    Returns : df, pandas data frame modified
+    Returns : datetimes, pandas series of datetimes, or of strings when a value isn't a number
     """
 
-    df["station_id"] = df[column_source].apply(lambda x: f"{code}-{x}")
-    df["created_date"] = date.today()
+    raw_values = pd.Series(series.unique())
+    epochs = pd.to_numeric(raw_values, errors="coerce")
+    local_datetimes = {
+        raw_value: datetime.fromtimestamp(epoch)
+        for raw_value, epoch in zip(raw_values, epochs) if not pd.isna(epoch)
+    }
+    datetimes = pd.to_datetime(series.map(local_datetimes))
 
-    return df
+    is_invalid = series.notna() & datetimes.isna()
+
+    if is_invalid.any():
+        return datetimes.dt.strftime("%Y-%m-%d %H:%M:%S").where(~is_invalid, series.astype(str))
+
+    return datetimes
 
 
 def get_insee_code(city_name):
     """
-    Get the INSEE code of a city based on table CONSOLIDATE_STATION
+    Get the INSEE code of a city based on the latest snapshot of table CONSOLIDATE_CITY,
+    through the lookup built once per run by city_codes
 
     Params : 
         - city_name : name of the city that we want to know the INSEE code
@@ -574,15 +1285,406 @@ def get_insee_code(city_name):
     Returns : insee_code, string, code INSEE of city_name
     """
 
-    data = {}
-    con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = False)
+    return get_city_code(city_name)
+
+
+""" The functions below are used by the arrow consolidation engine """
+
+def load_raw_data_table(source_name, snapshot_time):
+    """
+    Load the raw data of a city source for a snapshot as an Arrow table holding only the fields
+    read by its adapter, one column per field. Only these values are copied out of the parsed
+    JSON, which is freed once the table is built, instead of a frame of object columns of every field.
+    The table is kept in the cache of load_raw_data_frame until clear_raw_data_cache is called
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : raw_data_table, an Arrow table whose columns are named after the fields
+    """
+
+    cache_key = (snapshot_time, source_name, get_raw_content_hash(source_name, snapshot_time), "arrow")
+
+    if cache_key not in _raw_data_cache:
+        data = load_raw_data(source_name, snapshot_time)
+
+        _raw_data_cache[cache_key] = pa.table({
+            field: get_raw_column(data, field)
+            for field in get_adapter_raw_fields(SOURCES[source_name]["adapter"])
+        })
+
+    return _raw_data_cache[cache_key]
+
+def get_adapter_raw_fields(adapter):
+    """
+    Get the fields of the raw data read by an adapter, for the station and the statement consolidations
+
+    Params :
+        - adapter : dict, adapter of the source as found in SOURCES
+
+    Returns : fields, list of strings, without duplicates
+    """
+
+    fields = [adapter["station_code"], *adapter["station_fields"].values(), *adapter["statement_fields"].values()]
+    fields = [{"field": field} if isinstance(field, str) else field for field in fields]
+
+    return list(dict.fromkeys(field["field"] for field in fields if "field" in field))
+
+def get_raw_column(data, field):
+    """
+    Get the values of a field of the raw records as an Arrow array, missing where a record doesn't
+    have it. A field holding values of several types is kept as strings, as DuckDB reads it
+
+    Params :
+        - data : list of records, as loaded from the JSON file
+        - field : string, name of the field, nested keys joined by "."
+
+    Returns : values, Arrow array
+    """
+
+    values = data
+
+    for key in field.split("."):
+        values = [value.get(key) if isinstance(value, dict) else None for value in values]
+
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+
+def consolidate_arrow_station_data(source_name, snapshot_time):
+    """
+    Retrieve the raw data of a city and map it with the adapter of the source to match the
+    format and the constraints of the CONSOLIDATE_STATION, as Arrow columns
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : station_data, an Arrow table containing the consolidated data
+    """
+
+    adapter = SOURCES[source_name]["adapter"]
+
+    # Get the raw data, extracted once for both the station and the statement consolidations
+    raw_data_table = load_raw_data_table(source_name, snapshot_time)
+    code = get_adapter_array(raw_data_table, adapter["station_code"])
+
+    columns = {
+        "id": build_station_id_array(code, adapter["city_code"]),
+        "code": code,
+        "address": None,
+        "created_date": snapshot_time.date()
+    }
+
+    # The sources without INSEE code get the one of their city
+    if "city_code" not in adapter["station_fields"]:
+        columns["city_code"] = get_insee_code(adapter["city"])
+
+    for column, field in adapter["station_fields"].items():
+        columns[column] = get_adapter_array(raw_data_table, field)
+
+    return build_arrow_table(columns, STATION_COLUMNS, raw_data_table.num_rows)
+
+def consolidate_arrow_station_statement_data(source_name, snapshot_time):
+    """
+    Retrieve the raw data of a city and map it with the adapter of the source to match the
+    format and the constraints of the CONSOLIDATE_STATION_STATEMENT, as Arrow columns
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : station_statement_data, an Arrow table containing the consolidated data
+    """
+
+    adapter = SOURCES[source_name]["adapter"]
+
+    # Get the raw data, extracted once for both the station and the statement consolidations
+    raw_data_table = load_raw_data_table(source_name, snapshot_time)
+
+    columns = {
+        "station_id": build_station_id_array(get_adapter_array(raw_data_table, adapter["station_code"]), adapter["city_code"]),
+        "created_date": snapshot_time.date(),
+        "snapshot_time": snapshot_time
+    }
+
+    for column, field in adapter["statement_fields"].items():
+        columns[column] = get_adapter_array(raw_data_table, field)
+
+    return build_arrow_table(columns, STATION_STATEMENT_COLUMNS, raw_data_table.num_rows)
+
+def build_arrow_table(columns, column_names, nb_rows):
+    """
+    Build the Arrow table of a consolidation, the constants are repeated along the columns taken
+    from the raw data and the columns of DICTIONARY_COLUMNS are dictionary encoded
+
+    Params :
+        - columns : dict, Arrow array or constant of each column
+        - column_names : list of the columns, in the order of their table
+        - nb_rows : int, number of rows of the raw data
+
+    Returns : table, an Arrow table
+    """
+
+    arrays = []
+
+    for column in column_names:
+        values = columns[column]
+
+        if values is None:
+            values = pa.nulls(nb_rows, pa.string())
+        elif not isinstance(values, (pa.Array, pa.ChunkedArray)):
+            values = pa.repeat(values, nb_rows)
+
+        if column in DICTIONARY_COLUMNS:
+            values = pc.dictionary_encode(values)
+
+        arrays.append(values)
+
+    return pa.table(arrays, names=column_names)
+
+def get_adapter_array(raw_data_table, field):
+    """
+    Get the values of a field of an adapter from the raw data of a city, the same mapping as get_adapter_field
+
+    Params :
+        - raw_data_table : Arrow table, raw data of the city as loaded by load_raw_data_table
+        - field : string or dict, field as described in SOURCES
+
+    Returns : values, Arrow array, or the constant of the field
+    """
+
+    if isinstance(field, str):
+        field = {"field": field}
+
+    if "value" in field:
+        return field["value"]
+
+    values = raw_data_table[field["field"]]
+
+    if "item" in field:
+        values = pc.list_element(values, field["item"])
+
+    if "suffix" in field:
+        values = pc.utf8_slice_codeunits(pc.cast(values, pa.string()), -field["suffix"])
+
+    if field.get("epoch"):
+        values = convert_epoch_array(values)
+
+    # Standardization of the status between all APIs
+    if "open_value" in field:
+        values = normalize_status_array(values, field["open_value"])
+
+    return values
+
+def build_station_id_array(values, code):
+    """
+    Build the station identifiers of a city, formatted as <city code>-<station code>
+
+    Params :
+        - values : Arrow array, station codes
+        - code : const, city code used
+
+    Returns : station_ids, Arrow array of strings, missing where the station code is missing
+    """
+
+    return pc.binary_join_element_wise(str(code), pc.cast(values, pa.string()), "-")
+
+def normalize_status_array(values, open_value):
+    """
+    Standardize the status of the stations between all APIs, the only values kept are "OPEN" and "CLOSED"
+
+    Params :
+        - values : Arrow array, status as given by the API
+        - open_value : string, value of an open station, compared to the string form of the status
+
+    Returns : status, Arrow array of strings
+    """
+
+    is_open = pc.fill_null(pc.equal(pc.cast(values, pa.string()), open_value), False)
+
+    return pc.if_else(is_open, "OPEN", "CLOSED")
+
+def convert_epoch_array(values):
+    """
+    Convert Unix timestamps (in seconds) to local naive datetimes, as convert_epoch_to_datetime does,
+    each distinct timestamp is converted once and the array is mapped on the result. A value that
+    isn't a number is kept as it is, so that validate_consolidated_data quarantines its row
+
+    Params :
+        - values : Arrow array, timestamps as integers or strings
+
+    Returns : datetimes, Arrow array of timestamps, or of strings when a value isn't a number
+    """
+
+    # A cast of strings fails on the first value that isn't a number, those values are left out before
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        is_number = pc.match_substring_regex(values, r"^\s*-?\d+(\.\d*)?\s*$")
+        epochs = pc.cast(pc.if_else(is_number, pc.utf8_trim_whitespace(values), pa.scalar(None, values.type)), pa.float64())
+    else:
+        epochs = pc.cast(values, pa.float64())
+
+    epochs = pc.cast(epochs, pa.int64(), safe=False)
+    unique_epochs = pc.unique(epochs)
+    local_datetimes = pa.array(
+        [None if epoch is None else datetime.fromtimestamp(epoch) for epoch in unique_epochs.to_pylist()],
+        pa.timestamp("us")
+    )
+    datetimes = pc.take(local_datetimes, pc.index_in(epochs, unique_epochs))
+
+    is_invalid = pc.and_(pc.is_valid(values), pc.is_null(epochs))
+
+    if pc.any(is_invalid).as_py():
+        return pc.if_else(is_invalid, pc.cast(values, pa.string()), pc.strftime(datetimes, "%Y-%m-%d %H:%M:%S"))
+
+    return datetimes
+
+
+""" The functions below are used by the duckdb consolidation engine """
+
+def build_station_sql(adapter):
+    """
+    Build the SQL mapping of a city for the CONSOLIDATE_STATION table from the adapter of its source.
+    {source} is replaced by the relation of the raw data of the snapshot, $created_date is the day
+    of the snapshot and $city_code the INSEE code of the city of the adapter
+
+    Params :
+        - adapter : dict, adapter of the source as found in SOURCES
+
+    Returns : sql_statement, string
+    """
+
+    code_sql = get_adapter_field_sql(adapter["station_code"])
+
+    columns = {
+        "id": f"'{adapter['city_code']}-' || {code_sql}",
+        "code": code_sql,
+        "city_code": "$city_code",
+        "address": "NULL",
+        "created_date": "$created_date"
+    }
+
+    for column, field in adapter["station_fields"].items():
+        columns[column] = get_adapter_field_sql(field)
+
+    return build_select_sql(columns, STATION_COLUMNS)
+
+def build_station_statement_sql(adapter):
+    """
+    Build the SQL mapping of a city for the CONSOLIDATE_STATION_STATEMENT table from the adapter of its source.
+    {source} is replaced by the relation of the raw data of the snapshot, $created_date and $snapshot_time identify the snapshot
+
+    Params :
+        - adapter : dict, adapter of the source as found in SOURCES
+
+    Returns : sql_statement, string
+    """
+
+    columns = {
+        "station_id": f"'{adapter['city_code']}-' || {get_adapter_field_sql(adapter['station_code'])}",
+        "created_date": "$created_date",
+        "snapshot_time": "$snapshot_time"
+    }
+
+    for column, field in adapter["statement_fields"].items():
+        columns[column] = get_adapter_field_sql(field)
+
+    return build_select_sql(columns, STATION_STATEMENT_COLUMNS)
+
+def build_select_sql(columns, column_names):
+    """
+    Build the SELECT statement of a mapping, over the raw data relation
+
+    Params :
+        - columns : dict, SQL expression of each column
+        - column_names : list of the columns, in the order of their table
+
+    Returns : sql_statement, string
+    """
+
+    expressions = ",\n        ".join(f"{columns[column]} AS {column}" for column in column_names)
+
+    return f"""
+    SELECT
+        {expressions}
+    FROM {{source}}
+    """
+
+def get_adapter_field_sql(field):
+    """
+    Get the SQL expression of a field of an adapter, the same mapping as get_adapter_field
+
+    Params :
+        - field : string or dict, field as described in SOURCES
+
+    Returns : sql, string
+    """
+
+    if isinstance(field, str):
+        field = {"field": field}
+
+    if "value" in field:
+        return get_sql_literal(field["value"])
 
-    sql_statement = f"""
-    SELECT DISTINCT id 
-    FROM CONSOLIDATE_CITY
-    WHERE name = ?;
+    # Nested keys are struct fields, every name is quoted as some are keywords, e.g. "to"
+    sql = ".".join(f'"{name}"' for name in field["field"].split("."))
+
+    if "item" in field:
+        sql = f"{sql}[{field['item'] + 1}]"
+
+    if "suffix" in field:
+        sql = f"right({sql}, {field['suffix']})"
+
+    # A value that isn't a number is kept as it is, validate_consolidated_data quarantines its row
+    if field.get("epoch"):
+        sql = f"COALESCE(CAST(to_timestamp(TRY_CAST({sql} AS BIGINT)) AS VARCHAR), CAST({sql} AS VARCHAR))"
+
+    if "open_value" in field:
+        sql = f"CASE WHEN CAST({sql} AS VARCHAR) = {get_sql_literal(field['open_value'])} THEN 'OPEN' ELSE 'CLOSED' END"
+
+    return sql
+
+def get_sql_literal(value):
     """
+    Quote a constant of an adapter as a SQL string
+
+    Params :
+        - value : constant of the field
+
+    Returns : sql, string
+    """
+
+    value = str(value).replace("'", "''")
+
+    return f"'{value}'"
+
+def consolidate_sql_data(con, source_name, sql_statement, snapshot_time):
+    """
+    Map the raw data of a city with its SQL statement
+
+    Params :
+        - con : DuckDB connection the data will be inserted with
+        - source_name : string, name of the source as found in SOURCES
+        - sql_statement : string, SQL mapping of the city
+        - snapshot_time : datetime, snapshot to consolidate
+
+    Returns : relation, a DuckDB relation containing the consolidated data
+    """
+
+    relation_sql = get_snapshot_relation_sql(source_name, SOURCES[source_name]["file_name"], snapshot_time)
+
+    if relation_sql is None:
+        raise FileNotFoundError(f"No raw data for {source_name} in the snapshot of {snapshot_time}")
+
+    sql_statement = sql_statement.format(source=relation_sql)
+    parameters = {"created_date": snapshot_time.date(), "snapshot_time": snapshot_time}
+
+    if "$city_code" in sql_statement:
+        parameters["city_code"] = get_insee_code(SOURCES[source_name]["adapter"]["city"])
 
-    insee_code = con.execute(sql_statement, [city_name]).fetchone()
+    # Only the parameters used by the statement can be bound
+    parameters = {name: value for name, value in parameters.items() if f"${name}" in sql_statement}
 
-    return insee_code[0] if insee_code else None
+    return con.sql(sql_statement, params=parameters)
@@ -1,81 +1,283 @@
+import hashlib
 import os
-from datetime import datetime
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import add_metric, record_stage
+from raw_data import get_snapshot_path, get_snapshot_time
+from source_state import get_source_state, update_source_state
+from sources import SOURCES
+
+# Settings of the ingestion engine
+MAX_WORKERS = len(SOURCES)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 64 * 1024
+
+# HTTP session shared by every fetch so that connections are kept alive between calls
+_session = None
+
+def get_session():
+    """
+    Get the HTTP session shared by the ingestion engine, create it on first call
+
+    Returns : session, requests session with a connection pool sized for MAX_WORKERS
+    """
+
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+
+    return _session
+
+def download_source(source, file_path, previous_state=None, session=None, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+    Stream a source to disk, retrying with an exponential backoff on network errors,
+    on interrupted downloads and on the status codes listed in RETRY_STATUS_CODES.
+    When the state of the previous download is given, the request is conditional
+    and an unchanged source is not downloaded again
+
+    Params :
+        - source : dict, source description as found in SOURCES
+        - file_path : string, path of the raw file to write
+        - previous_state : dict, state of the previous download of the source
+        - session : requests session to use, the shared one by default
+        - max_retries : int, number of retries after the first attempt
+        - backoff_factor : float, the n-th retry waits backoff_factor * 2 ** n seconds
+
+    Returns : state, dict, ETag, Last-Modified, content hash and file of the download,
+    "unchanged" is True when the content is the same as the previous download
+    """
+
+    session = session or get_session()
+    headers = dict(source["headers"])
+
+    if previous_state:
+        if previous_state.get("etag"):
+            headers["If-None-Match"] = previous_state["etag"]
+        if previous_state.get("last_modified"):
+            headers["If-Modified-Since"] = previous_state["last_modified"]
+
+    for attempt in range(max_retries + 1):
+        try:
+            with session.get(source["url"], headers=headers, timeout=source["timeout"], stream=True) as response:
+                if previous_state and response.status_code == 304:
+                    serialize_previous_data(previous_state["file_path"], file_path)
+                    return {**previous_state, "file_path": file_path, "unchanged": True}
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    content_hash = serialize_data(response.iter_content(chunk_size=CHUNK_SIZE), file_path)
+
+                    return {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "content_hash": content_hash,
+                        "file_path": file_path,
+                        "unchanged": previous_state is not None and previous_state.get("content_hash") == content_hash
+                    }
+
+                error = requests.HTTPError(f"{response.status_code} for url {source['url']}", response=response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as exception:
+            error = exception
+
+        if attempt < max_retries:
+            time.sleep(backoff_factor * 2 ** attempt)
+
+    raise error
+
+def ingest_source(source_name, sources=SOURCES, snapshot_time=None):
+    """
+    Download a source into the raw data directory and record its new state
+
+    Params :
+        - source_name : string, key of the source inside sources
+        - sources : dict, sources description
+        - snapshot_time : datetime, time of the snapshot, now by default
+
+    Returns : elapsed, float, time spent (in seconds) to ingest the source
+    """
+
+    start = time.perf_counter()
+
+    with record_stage("ingest", source_name):
+        # The previous download is only reused if its file is still there
+        previous_state = get_source_state("sources", source_name)
+        if previous_state and not os.path.exists(previous_state["file_path"]):
+            previous_state = None
+
+        file_path = get_snapshot_path(source_name, snapshot_time or get_snapshot_time())
+        state = download_source(sources[source_name], file_path, previous_state)
+
+        # "unchanged" only tells about this download, it isn't part of the state of the source
+        update_source_state("sources", source_name, {key: value for key, value in state.items() if key != "unchanged"})
+
+    if state["unchanged"]:
+        print(f"Source {source_name} unchanged since its last download.")
+
+    return time.perf_counter() - start
+
+def ingest_all_data(source_names=None, sources=SOURCES, max_workers=MAX_WORKERS, snapshot_time=None):
+    """
+    Ingest the sources concurrently on a bounded thread pool, all of them into the
+    same snapshot. Every source is ingested even if another one fails, the first
+    error is raised once all are done
+
+    Params :
+        - source_names : list of the sources to ingest, all the sources by default
+        - sources : dict, sources description
+        - max_workers : int, size of the thread pool
+        - snapshot_time : datetime, time of the snapshot, now by default
+
+    Returns : elapsed_times, dict, time spent (in seconds) to ingest each source
+    """
+
+    source_names = source_names or list(sources)
+    snapshot_time = snapshot_time or get_snapshot_time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            source_name: executor.submit(ingest_source, source_name, sources, snapshot_time)
+            for source_name in source_names
+        }
+
+    errors = {}
+    elapsed_times = {}
+
+    for source_name, future in futures.items():
+        if future.exception() is not None:
+            errors[source_name] = future.exception()
+        else:
+            elapsed_times[source_name] = future.result()
+
+    for source_name, error in errors.items():
+        print(f"Ingestion for {source_name} failed : {error}")
+
+    if errors:
+        raise next(iter(errors.values()))
+
+    return elapsed_times
 
 def get_paris_realtime_bicycle_data():
     """
     Ingestion for data for Paris
     """
 
-    url = "https://opendata.paris.fr/api/explore/v2.1/catalog/datasets/velib-disponibilite-en-temps-reel/exports/json"
-    
-    response = requests.request("GET", url)
-    
-    serialize_data(response.text, "paris_realtime_bicycle_data.json")
+    ingest_source("paris")
 
 def get_nantes_realtime_bicycle_data():
     """
     Ingestion for data for Nantes
     """
-    
-    url = "https://data.nantesmetropole.fr/api/explore/v2.1/catalog/datasets/244400404_stations-velos-libre-service-nantes-metropole-disponibilites/exports/json"
 
-    response = requests.request("GET", url)
-
-    serialize_data(response.text, "nantes_realtime_bicycle_data.json")
+    ingest_source("nantes")
 
 def get_toulouse_realtime_bicycle_data():
     """
     Ingestion for data for Toulouse
     """
-    
-    url = "https://data.toulouse-metropole.fr/api/explore/v2.1/catalog/datasets/api-velo-toulouse-temps-reel/exports/json"
-
-    response = requests.request("GET", url)
 
-    serialize_data(response.text, "toulouse_realtime_bicycle_data.json")
+    ingest_source("toulouse")
 
 def get_strasbourg_realtime_bicycle_data():
     """
     Ingestion for data for Strasbourg
     """
-    
-    url = "https://data.strasbourg.eu/api/explore/v2.1/catalog/datasets/stations-velhop/exports/json"
 
-    response = requests.request("GET", url)
-
-    serialize_data(response.text, "strasbourg_realtime_bicycle_data.json")
+    ingest_source("strasbourg")
 
 def get_montpellier_realtime_bicycle_data():
     """
     Ingestion for data for Montpellier
     """
-    
-    url = "https://portail-api-data.montpellier3m.fr/bikestation"
-    header = {"accept": "application/json"}
-
-    response = requests.get(url, headers=header)
 
-    serialize_data(response.text, "montpellier_realtime_bicycle_data.json")
+    ingest_source("montpellier")
 
 def get_commune_data():
     """
     Ingestion for data of cities
     """
-    
-    url = "https://geo.api.gouv.fr/communes"
 
-    response = requests.request("GET", url)
+    ingest_source("commune")
+
+def serialize_data(chunks, file_path):
+    """
+    Write a raw file of a source. The content is streamed into a temporary file of
+    the same directory, then renamed, so that a crashed run never leaves a truncated
+    file behind
+
+    Params :
+        - chunks : iterable of bytes, content of the source (a str or bytes is accepted too)
+        - file_path : string, path of the file to write
+
+    Returns : content_hash, string, SHA-256 of the content
+    """
+
+    if isinstance(chunks, str):
+        chunks = [chunks.encode("utf-8")]
+    elif isinstance(chunks, bytes):
+        chunks = [chunks]
+
+    directory, file_name = os.path.split(file_path)
+    content_hash = hashlib.sha256()
+
+    # Sources are serialized concurrently, the directory may be created by another thread
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{file_name}.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for chunk in chunks:
+                tmp_file.write(chunk)
+                content_hash.update(chunk)
+                add_metric("bytes_downloaded", len(chunk))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return content_hash.hexdigest()
+
+def serialize_previous_data(previous_file_path, file_path):
+    """
+    Make a previous download of an unchanged source available as the raw file of a
+    new snapshot, as a hard link when possible and as a copy otherwise
+
+    Params :
+        - previous_file_path : string, path of the previous download
+        - file_path : string, path of the file to write
+    """
+
+    directory, file_name = os.path.split(file_path)
+
+    if os.path.exists(file_path) and os.path.samefile(previous_file_path, file_path):
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{directory}/.{file_name}.{os.getpid()}.link.tmp"
 
-    serialize_data(response.text, "commune_data.json")
-    
-def serialize_data(raw_json: str, file_name: str):
+    try:
+        try:
+            os.link(previous_file_path, tmp_path)
+        except OSError:
+            shutil.copyfile(previous_file_path, tmp_path)
 
-    today_date = datetime.now().strftime("%Y-%m-%d")
-    
-    if not os.path.exists(f"data/raw_data/{today_date}"):
-        os.makedirs(f"data/raw_data/{today_date}")
-    
-    with open(f"data/raw_data/{today_date}/{file_name}", "w") as fd:
-        fd.write(raw_json)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
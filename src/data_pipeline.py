@@ -0,0 +1,306 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from functools import partial
+
+import duckdb
+
+from city_codes import get_city_lookup
+from data_agregation import (
+    AGREGATION_MODE,
+    create_agregate_tables,
+    agregate_dim_city,
+    agregate_dim_station,
+    agregate_fact_station_statements,
+    agregate_rollups,
+    agregate_incremental_data
+)
+from data_consolidation import create_consolidate_tables, transform_snapshot, write_snapshots
+from data_ingestion import SOURCES, ingest_source
+from database import write_lock
+from metrics import create_metrics_tables, save_run_metrics, start_run
+from raw_data import get_snapshot_time
+
+# Status of each node of the last run, to resume it from its failed nodes
+# - "run_id" : identifier of the run inside PIPELINE_RUN_METRICS
+# - "snapshot_time" : snapshot of the run, a resumed run writes into the same one
+# - "nodes" : for each node, its status ("success", "failed" or "blocked"), its elapsed time and its error
+PIPELINE_STATE_PATH = "data/pipeline_state.json"
+
+# Number of nodes run at once, the ingestions of every source are independent
+MAX_WORKERS = len(SOURCES)
+
+# Source of the CONSOLIDATE_CITY table, the other sources are cities of stations
+COMMUNE_SOURCE = "commune"
+
+def build_pipeline(snapshot_time, engine=None):
+    """
+    Describe the stages of a run as a graph : each source is ingested then consolidated,
+    the aggregation comes once every consolidation is done. A node runs once the nodes
+    of "requires" succeeded and the nodes of "after" are done, whatever their status
+
+    Params :
+        - snapshot_time : datetime, snapshot of the run
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+
+    Returns : nodes, dict, for each node name its "function", "requires" and "after" lists
+    """
+
+    nodes = {
+        "create_tables": {"function": create_tables, "requires": [], "after": []}
+    }
+
+    for source_name in SOURCES:
+        nodes[f"ingest:{source_name}"] = {
+            "function": partial(ingest_source, source_name, snapshot_time=snapshot_time),
+            "requires": [],
+            "after": []
+        }
+
+        # The stations are resolved against the cities, they wait for the communes but don't need them
+        nodes[f"consolidate:{source_name}"] = {
+            "function": partial(consolidate_source, source_name, snapshot_time, engine),
+            "requires": [f"ingest:{source_name}", "create_tables"],
+            "after": [] if source_name == COMMUNE_SOURCE else [f"consolidate:{COMMUNE_SOURCE}"]
+        }
+
+    # A failed city is left out of the aggregation, the other ones are still aggregated
+    nodes["agregate"] = {
+        "function": agregate_data,
+        "requires": ["create_tables"],
+        "after": [f"consolidate:{source_name}" for source_name in SOURCES]
+    }
+
+    return nodes
+
+def create_tables():
+    """
+    Create the consolidate, aggregate and metrics tables if they don't exist
+    """
+
+    with write_lock:
+        create_consolidate_tables()
+        create_agregate_tables()
+        create_metrics_tables()
+
+def consolidate_source(source_name, snapshot_time, engine=None):
+    """
+    Consolidate one source of a snapshot. The raw data is transformed without the
+    database, so that the sources are transformed in parallel, then written in a
+    transaction of its own
+
+    Params :
+        - source_name : string, name of the source as found in SOURCES
+        - snapshot_time : datetime, snapshot to consolidate
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+
+    Returns : nb_rows, dict, number of rows written into each consolidate table
+    """
+
+    if source_name == COMMUNE_SOURCE:
+        table_names = ["CONSOLIDATE_CITY"]
+    else:
+        table_names = ["CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+
+        # The lookup of the INSEE codes is read from the database before the transform
+        with write_lock:
+            get_city_lookup()
+
+    with duckdb.connect() as con:
+        transformed = transform_snapshot(con, snapshot_time, engine, [source_name], table_names)
+
+    with write_lock:
+        return write_snapshots([(snapshot_time, transformed)])
+
+def agregate_data():
+    """
+    Aggregate the consolidated data, with the mode set by AGREGATION_MODE
+
+    Returns : merged, dict, number of rows merged into each aggregate table, None in full mode
+    """
+
+    with write_lock:
+        if AGREGATION_MODE == "incremental":
+            return agregate_incremental_data()
+
+        agregate_dim_city()
+        agregate_dim_station()
+        agregate_fact_station_statements()
+        agregate_rollups()
+
+def load_pipeline_state(path=PIPELINE_STATE_PATH):
+    """
+    Load the status of the last run
+
+    Params :
+        - path : string, path of the state file
+
+    Returns : state, dict with the "snapshot_time" and "nodes" sections, None if no run was saved
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fd:
+        return json.load(fd)
+
+def save_pipeline_state(state, path=PIPELINE_STATE_PATH):
+    """
+    Save the status of the run through a temporary file and a rename, so that the
+    state file is never left half written
+
+    Params :
+        - state : dict, state to save
+        - path : string, path of the state file
+    """
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".pipeline_state.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(state, tmp_file, indent=4)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def list_nodes_to_run(nodes, previous_statuses):
+    """
+    List the nodes a resumed run has to run again : the nodes that didn't succeed
+    and every node that comes after them
+
+    Params :
+        - nodes : dict, nodes of the pipeline as returned by build_pipeline
+        - previous_statuses : dict, status of each node of the last run
+
+    Returns : node_names, set of the nodes to run
+    """
+
+    node_names = {
+        node_name for node_name in nodes
+        if previous_statuses.get(node_name, {}).get("status") != "success"
+    }
+
+    # The descendants are added until nothing changes, the graph is small
+    changed = True
+    while changed:
+        changed = False
+
+        for node_name, node in nodes.items():
+            if node_name not in node_names and node_names.intersection(node["requires"] + node["after"]):
+                node_names.add(node_name)
+                changed = True
+
+    return node_names
+
+def run_node(node_name, function):
+    """
+    Run the function of a node and catch its error, so that the other nodes go on
+
+    Params :
+        - node_name : string, name of the node
+        - function : callable, stage run by the node
+
+    Returns : status, dict with the "status", "elapsed" and "error" of the node
+    """
+
+    start = time.perf_counter()
+
+    try:
+        function()
+    except Exception as error:
+        print(f"Node {node_name} failed : {error}")
+        return {"status": "failed", "elapsed": time.perf_counter() - start, "error": repr(error)}
+
+    elapsed = time.perf_counter() - start
+    print(f"Node {node_name} done in {elapsed:.2f}s !")
+
+    return {"status": "success", "elapsed": elapsed, "error": None}
+
+def run_pipeline(snapshot_time=None, resume=False, max_workers=MAX_WORKERS, engine=None, path=PIPELINE_STATE_PATH):
+    """
+    Run the nodes of the pipeline on a thread pool, each one as soon as the nodes it
+    waits for are done. A failed node blocks the nodes that require it, the other
+    ones go on. The status of each node is saved once it is done
+
+    Params :
+        - snapshot_time : datetime, snapshot of the run, now by default
+        - resume : bool, run again the failed and blocked nodes of the last run, in its snapshot
+        - max_workers : int, size of the thread pool
+        - engine : string, "pandas", "duckdb" or "arrow", CONSOLIDATION_ENGINE by default
+        - path : string, path of the state file
+
+    Returns : state, dict with the "run_id", the "snapshot_time" and the "nodes" statuses of the run
+    """
+
+    run_id = start_run()
+    previous_state = load_pipeline_state(path) if resume else None
+
+    if previous_state is not None:
+        snapshot_time = datetime.fromisoformat(previous_state["snapshot_time"])
+
+    snapshot_time = snapshot_time or get_snapshot_time()
+    nodes = build_pipeline(snapshot_time, engine)
+
+    previous_statuses = previous_state["nodes"] if previous_state is not None else {}
+    pending = list_nodes_to_run(nodes, previous_statuses)
+
+    # The succeeded nodes of a resumed run are kept as they are
+    state = {
+        "run_id": run_id,
+        "snapshot_time": snapshot_time.isoformat(),
+        "nodes": {node_name: status for node_name, status in previous_statuses.items() if node_name in nodes and node_name not in pending}
+    }
+    save_pipeline_state(state, path)
+
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # A blocked node can make other nodes ready, nodes are scheduled until none is
+            ready = True
+            while ready:
+                ready = False
+
+                for node_name in sorted(pending):
+                    node = nodes[node_name]
+
+                    if any(dependency not in state["nodes"] for dependency in node["requires"] + node["after"]):
+                        continue
+
+                    pending.remove(node_name)
+                    ready = True
+                    failed_requirements = [
+                        dependency for dependency in node["requires"]
+                        if state["nodes"][dependency]["status"] != "success"
+                    ]
+
+                    if failed_requirements:
+                        print(f"Node {node_name} blocked by {', '.join(failed_requirements)}.")
+                        state["nodes"][node_name] = {"status": "blocked", "elapsed": 0.0, "error": f"blocked by {', '.join(failed_requirements)}"}
+                        save_pipeline_state(state, path)
+                    else:
+                        running[executor.submit(run_node, node_name, node["function"])] = node_name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                state["nodes"][running.pop(future)] = future.result()
+
+            save_pipeline_state(state, path)
+
+    # The metrics are inserted once the run is done, a failed node doesn't roll them back
+    with write_lock:
+        save_run_metrics()
+
+    return state
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import duckdb
+
+# Database of the pipeline, every stage goes through the connection opened below
+# The path and the DuckDB settings can be set with environment variables or with configure_database
+DATABASE_PATH = os.environ.get("MOBILITY_DUCKDB_PATH", "data/duckdb/mobility_analysis.duckdb")
+
+# DuckDB settings of the connection, None keeps the default of DuckDB
+# - memory limit : e.g. "2GB"
+# - threads : number of threads used by a query
+DATABASE_MEMORY_LIMIT = os.environ.get("MOBILITY_DUCKDB_MEMORY_LIMIT")
+DATABASE_THREADS = os.environ.get("MOBILITY_DUCKDB_THREADS")
+
+# Seconds the write connection waits for the file held by read-only processes, e.g. the query service
+# A process can't open the file for writing while another one reads it
+DATABASE_LOCK_TIMEOUT = float(os.environ.get("MOBILITY_DUCKDB_LOCK_TIMEOUT", 30))
+
+# Write connection shared by the whole run, opened on first use
+_connection = None
+_lock = threading.Lock()
+
+# Threads sharing the connection write one at a time : a transaction is run while holding this lock
+write_lock = threading.RLock()
+
+def configure_database(path=None, memory_limit=None, threads=None):
+    """
+    Change the database or the settings used by the pipeline. The shared connection
+    is closed, the next call to get_connection opens it with the new configuration
+
+    Params :
+        - path : string, path of the DuckDB file, unchanged if None
+        - memory_limit : string, DuckDB memory limit, unchanged if None
+        - threads : int, number of DuckDB threads, unchanged if None
+    """
+
+    global DATABASE_PATH, DATABASE_MEMORY_LIMIT, DATABASE_THREADS
+
+    close_connection()
+
+    DATABASE_PATH = path or DATABASE_PATH
+    DATABASE_MEMORY_LIMIT = memory_limit or DATABASE_MEMORY_LIMIT
+    DATABASE_THREADS = threads or DATABASE_THREADS
+
+def get_database_config():
+    """
+    Get the DuckDB settings given when a connection is opened
+
+    Returns : config, dict of the settings that were set
+    """
+
+    config = {}
+
+    if DATABASE_MEMORY_LIMIT:
+        config["memory_limit"] = str(DATABASE_MEMORY_LIMIT)
+
+    if DATABASE_THREADS:
+        config["threads"] = int(DATABASE_THREADS)
+
+    return config
+
+def get_connection():
+    """
+    Get the write connection shared by the stages of the pipeline. Opening the file
+    replays its WAL and loads its catalog, it is done once per run instead of once per function
+
+    Returns : con, DuckDB connection
+    """
+
+    global _connection
+
+    with _lock:
+        if _connection is None:
+            os.makedirs(os.path.dirname(DATABASE_PATH) or ".", exist_ok=True)
+            deadline = time.monotonic() + DATABASE_LOCK_TIMEOUT
+
+            while _connection is None:
+                try:
+                    _connection = duckdb.connect(database = DATABASE_PATH, read_only = False, config = get_database_config())
+                except duckdb.IOException as error:
+                    # The readers release the file between their queries
+                    if "lock" not in str(error).lower() or time.monotonic() > deadline:
+                        raise
+
+                    time.sleep(0.1)
+
+    return _connection
+
+def get_cursor():
+    """
+    Get a cursor on the shared connection, for the queries. A cursor is cheap to
+    create, sees the same database and can be used by another thread than the connection
+
+    Returns : cursor, DuckDB connection
+    """
+
+    return get_connection().cursor()
+
+def connect_read_only():
+    """
+    Open a read-only connection, for the processes that only query the database
+    (several of them can read it at once, but not while the pipeline writes it)
+
+    Returns : con, DuckDB connection, to close by the caller
+    """
+
+    return duckdb.connect(database = DATABASE_PATH, read_only = True, config = get_database_config())
+
+def close_connection():
+    """
+    Close the shared connection, the database is checkpointed and its file released
+    """
+
+    global _connection
+
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -1,80 +1,45 @@
-from data_agregation import (
-    create_agregate_tables,
-    agregate_dim_city,
-    agregate_dim_station,
-    agregate_fact_station_statements
-)
-from data_consolidation import (
-    create_consolidate_tables,
-    consolidate_city_data,
-    consolidate_station_data,
-    consolidate_station_statement_data,
-)
-from data_ingestion import (
-    get_paris_realtime_bicycle_data,
-    get_nantes_realtime_bicycle_data,
-    get_toulouse_realtime_bicycle_data,
-    get_strasbourg_realtime_bicycle_data,
-    get_montpellier_realtime_bicycle_data,
-    get_commune_data
-)
+import argparse
+import sys
 
-def main():
+from data_consolidation import clear_raw_data_cache
+from data_pipeline import PIPELINE_STATE_PATH, run_pipeline
+from database import close_connection
+from metrics import METRICS_LOG_PATH, format_run_report
+
+def main(resume=False):
     print("Process start.")
 
-    # data ingestion
+    # Every source is ingested, consolidated then aggregated as a graph of nodes : the cities
+    # are run in parallel and a failed city doesn't stop the others
+    state = run_pipeline(resume=resume)
+    print(f"Snapshot of {state['snapshot_time']}.")
     print("------------------------------------")
-    print("Data ingestion started.")
 
-    # For Paris
-    print("Starting ingestion for Paris...")
-    get_paris_realtime_bicycle_data()
-    print("Ingestion for Paris done !")
+    for node_name, status in state["nodes"].items():
+        print(f"{node_name} : {status['status']} ({status['elapsed']:.2f}s)")
 
-    # For Nantes
-    print("Starting ingestion for Nantes...")
-    get_nantes_realtime_bicycle_data()
-    print("Ingestion for Nantes done !")
+    # Time, rows, bytes and memory of each stage, also found in PIPELINE_RUN_METRICS and in the JSON lines file
+    print("------------------------------------")
+    print(f"Run report ({state['run_id']}, see {METRICS_LOG_PATH}) :")
+    for line in format_run_report():
+        print(line)
 
-    # For Toulouse
-    print("Starting ingestion for Toulouse...")
-    get_toulouse_realtime_bicycle_data()
-    print("Ingestion for Toulouse done !")
+    clear_raw_data_cache()
 
-    # For Strasbourg
-    print("Starting ingestion for Strasbourg...")
-    get_strasbourg_realtime_bicycle_data()
-    print("Ingestion for Strasbourg done !")
+    # Every stage used the same connection, the database file is released once the run is done
+    close_connection()
 
-    # For Montpellier
-    print("Starting ingestion for Montpellier...")
-    get_montpellier_realtime_bicycle_data()
-    print("Ingestion for Montpellier done !")
+    failed_nodes = [node_name for node_name, status in state["nodes"].items() if status["status"] != "success"]
 
-    # Towns data ingestion
-    print("Starting towns ingestion...")
-    get_commune_data()
-    print("Towns' ingestion done !")
+    if failed_nodes:
+        print(f"{len(failed_nodes)} nodes not done, see {PIPELINE_STATE_PATH} and run again with --resume.")
+        sys.exit(1)
 
-    print("Data ingestion done !")
-    print("------------------------------------")
-
-    # data consolidation
-    print("Consolidation data started.")
-    create_consolidate_tables()
-    consolidate_city_data()
-    consolidate_station_data()
-    consolidate_station_statement_data()
-    print("Consolidation data ended.")
-    print("------------------------------------")
-
-    # data agregation
-    print("Agregate data started.")
-    create_agregate_tables()
-    agregate_dim_city()
-    agregate_dim_station()
-    agregate_fact_station_statements()
-    print("Agregate data ended.")
+    print("Process done.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ingest, consolidate and aggregate a snapshot of every source")
+    parser.add_argument("--resume", action="store_true", help="run again the failed nodes of the last run, in its snapshot")
+    args = parser.parse_args()
+
+    main(resume=args.resume)
@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module, the peak RSS is not recorded there
+    resource = None
+
+from database import get_connection
+
+# Metrics of every stage, one JSON object per line, appended run after run
+METRICS_LOG_PATH = "data/metrics/pipeline_metrics.jsonl"
+
+# Counters a stage can record, None when the stage doesn't know them
+# - rows_in / rows_out : rows read by the stage and rows it produced or wrote
+# - bytes_downloaded : bytes fetched from a source
+# - bytes_read : bytes of raw files read
+# - rows_quarantined : malformed rows set aside by the validation of the consolidated data
+METRIC_NAMES = ["rows_in", "rows_out", "bytes_downloaded", "bytes_read", "rows_quarantined"]
+
+# Metrics of the current run, written into PIPELINE_RUN_METRICS by save_run_metrics
+_run_id = None
+_run_metrics = []
+_lock = threading.Lock()
+
+# Stages open in each thread, add_metric counts into the innermost one
+_stages = threading.local()
+
+def start_run(run_id=None):
+    """
+    Start recording the metrics of a new run, the metrics of the previous run are forgotten
+
+    Params :
+        - run_id : string, identifier of the run, a new one by default
+
+    Returns : run_id, string
+    """
+
+    global _run_id
+
+    with _lock:
+        _run_id = run_id or uuid.uuid4().hex
+        _run_metrics.clear()
+
+    return _run_id
+
+def get_run_id():
+    """
+    Get the identifier of the current run, a run is started on the first call
+
+    Returns : run_id, string
+    """
+
+    return _run_id or start_run()
+
+def get_peak_rss():
+    """
+    Get the peak resident memory of the process. Stages run concurrently, the peak
+    is the one of the whole process when the stage ends, not of the stage alone
+
+    Returns : peak_rss, int, in bytes, None if it can't be read on this platform
+    """
+
+    if resource is None:
+        return None
+
+    # Linux gives kilobytes, macOS bytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss if os.uname().sysname == "Darwin" else peak_rss * 1024
+
+@contextmanager
+def record_stage(stage, target=None):
+    """
+    Measure a stage of the pipeline : its wall time, the peak RSS of the process and
+    the counters set by the stage, or added by the functions it calls with add_metric.
+    The metrics are recorded when the stage ends, failed or not
+
+    Params :
+        - stage : string, name of the stage, e.g. "ingest" or "write:CONSOLIDATE_STATION"
+        - target : string, source or table the stage works on
+
+    Returns : metrics, dict of the counters of METRIC_NAMES, to fill by the stage
+    """
+
+    metrics = {name: None for name in METRIC_NAMES}
+
+    if not hasattr(_stages, "stack"):
+        _stages.stack = []
+
+    _stages.stack.append(metrics)
+    started_at = datetime.now()
+    start = time.perf_counter()
+    error = None
+
+    try:
+        yield metrics
+    except BaseException as exception:
+        error = exception
+        raise
+    finally:
+        _stages.stack.pop()
+
+        save_stage_metrics({
+            "run_id": get_run_id(),
+            "stage": stage,
+            "target": target,
+            "status": "success" if error is None else "failed",
+            "started_at": started_at.isoformat(),
+            "elapsed": time.perf_counter() - start,
+            **metrics,
+            "peak_rss": get_peak_rss(),
+            "error": None if error is None else repr(error)
+        })
+
+def add_metric(name, value):
+    """
+    Add to a counter of the innermost stage of the calling thread, for the helpers
+    that read or download data without knowing their stage. Ignored outside a stage
+
+    Params :
+        - name : string, one of METRIC_NAMES
+        - value : int, amount to add
+    """
+
+    stack = getattr(_stages, "stack", None)
+
+    if stack:
+        stack[-1][name] = (stack[-1][name] or 0) + value
+
+def save_stage_metrics(stage_metrics, path=METRICS_LOG_PATH):
+    """
+    Append the metrics of a stage to the JSON lines file and keep them for the run
+
+    Params :
+        - stage_metrics : dict, metrics of the stage
+        - path : string, path of the JSON lines file
+    """
+
+    with _lock:
+        _run_metrics.append(stage_metrics)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        with open(path, "a") as fd:
+            fd.write(json.dumps(stage_metrics) + "\n")
+
+def get_run_metrics():
+    """
+    Get the metrics recorded since the start of the run
+
+    Returns : run_metrics, list of dict, one per stage
+    """
+
+    with _lock:
+        return list(_run_metrics)
+
+def extend_run_metrics(run_metrics):
+    """
+    Add to the run the metrics recorded by another process, they are already inside
+    the JSON lines file
+
+    Params :
+        - run_metrics : list of dict, metrics of the stages, as returned by get_run_metrics
+    """
+
+    with _lock:
+        _run_metrics.extend(run_metrics)
+
+def create_metrics_tables():
+    con = get_connection()
+    with open("data/sql_statements/create_metrics_tables.sql") as fd:
+        statements = fd.read()
+        for statement in statements.split(";"):
+            con.execute(statement)
+
+def save_run_metrics():
+    """
+    Insert the metrics of the run into the PIPELINE_RUN_METRICS table, so that runs
+    can be compared. Called once the run is done, outside of its transactions
+
+    Returns : nb_rows, int, number of stages inserted
+    """
+
+    create_metrics_tables()
+    run_metrics = get_run_metrics()
+
+    if run_metrics:
+        columns = ["run_id", "stage", "target", "status", "started_at", "elapsed", *METRIC_NAMES, "peak_rss", "error"]
+
+        # The columns added after the table was created come last, they are inserted by name
+        get_connection().executemany(
+            f"INSERT INTO PIPELINE_RUN_METRICS ({', '.join(column.upper() for column in columns)}) VALUES ({', '.join('?' for _ in columns)});",
+            [[stage_metrics[column] for column in columns] for stage_metrics in run_metrics]
+        )
+
+    return len(run_metrics)
+
+def format_run_report(run_metrics=None):
+    """
+    Summarize the metrics of a run, one line per stage : number of calls, total and
+    slowest wall time, rows, bytes and peak RSS
+
+    Params :
+        - run_metrics : list of dict, metrics of the stages, those of the current run by default
+
+    Returns : lines, list of strings
+    """
+
+    run_metrics = get_run_metrics() if run_metrics is None else run_metrics
+    stages = {}
+
+    for stage_metrics in run_metrics:
+        summary = stages.setdefault(stage_metrics["stage"], {"calls": 0, "failed": 0, "elapsed": 0.0, "slowest": 0.0, "peak_rss": 0, **{name: 0 for name in METRIC_NAMES}})
+        summary["calls"] += 1
+        summary["failed"] += stage_metrics["status"] != "success"
+        summary["elapsed"] += stage_metrics["elapsed"]
+        summary["slowest"] = max(summary["slowest"], stage_metrics["elapsed"])
+        summary["peak_rss"] = max(summary["peak_rss"], stage_metrics["peak_rss"] or 0)
+
+        for name in METRIC_NAMES:
+            summary[name] += stage_metrics[name] or 0
+
+    lines = []
+
+    for stage, summary in stages.items():
+        lines.append(
+            f"{stage} : {summary['calls']} calls ({summary['failed']} failed), "
+            f"{summary['elapsed']:.2f}s (slowest {summary['slowest']:.2f}s), "
+            f"rows {summary['rows_in']} in / {summary['rows_out']} out / {summary['rows_quarantined']} quarantined, "
+            f"{summary['bytes_downloaded'] / 1e6:.1f} MB downloaded, {summary['bytes_read'] / 1e6:.1f} MB read, "
+            f"peak RSS {summary['peak_rss'] / 1e6:.0f} MB"
+        )
+
+    return lines
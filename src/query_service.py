@@ -0,0 +1,601 @@
+import argparse
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import duckdb
+
+import database
+from data_agregation import get_fact_sql
+from station_search import find_nearest_stations, load_station_index
+
+# Local HTTP/JSON service answering the availability queries from the aggregate tables
+# It only opens read-only connections, that the pipeline can't write through
+QUERY_HOST = "127.0.0.1"
+QUERY_PORT = 8080
+
+# Cursors of the read-only connection, one per query running at once
+QUERY_POOL_SIZE = 4
+
+# The connection is closed after these seconds without query : the pipeline can't open the
+# file for writing while it is read, and a read-only connection doesn't see the new snapshots
+QUERY_IDLE_SECONDS = 5
+
+# Number of responses kept by the LRU cache, emptied when a new snapshot is aggregated
+QUERY_CACHE_SIZE = 256
+
+# Number of latencies kept for each endpoint, to compute their percentiles
+QUERY_LATENCY_WINDOW = 10_000
+
+# Read-only connection and its cursors, opened on the first query missing the cache
+_pool = {"connection": None, "cursors": None, "in_use": 0, "last_used": 0.0}
+_pool_condition = threading.Condition()
+
+# State of the database the cached responses were computed from
+# - token : modification time and size of the file and its WAL, read without opening it
+# - version : aggregated version and latest aggregated snapshot, read from the database
+# - station_index : grid index of the stations, loaded on the first search of a version
+_data_state = {"token": None, "version": None, "station_index": None}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+# Rollup columns of the measures, summed over the periods of a range
+AVAILABILITY_COLUMNS_SQL = """
+    SUM(COUNT_BICYCLE_DOCKS_AVAILABLE) AS nb_statements,
+    SUM(SUM_BICYCLE_DOCKS_AVAILABLE) / SUM(COUNT_BICYCLE_DOCKS_AVAILABLE) AS avg_bicycle_docks_available,
+    MIN(MIN_BICYCLE_DOCKS_AVAILABLE) AS min_bicycle_docks_available,
+    MAX(MAX_BICYCLE_DOCKS_AVAILABLE) AS max_bicycle_docks_available,
+    SUM(SUM_BICYCLE_AVAILABLE) / SUM(COUNT_BICYCLE_AVAILABLE) AS avg_bicycle_available,
+    MIN(MIN_BICYCLE_AVAILABLE) AS min_bicycle_available,
+    MAX(MAX_BICYCLE_AVAILABLE) AS max_bicycle_available
+"""
+
+# Types of the numeric parameters, the others are strings
+NUMERIC_PARAMETERS = {"longitude": float, "latitude": float, "k": int, "radius": float, "min_bicycles": int, "min_docks": int}
+
+# Lowest value of the numeric parameters, and whether this value itself is rejected
+NUMERIC_MINIMUMS = {"k": (1, False), "radius": (0, True), "min_bicycles": (0, False), "min_docks": (0, False)}
+
+# Parameterized queries served, by path : the SQL, or the search over the station index, and the parameters
+# it accepts. {grain} and {facts} are filled by the service, the parameters missing from the request are NULL
+QUERIES = {
+    "/cities/latest": {
+        "parameters": ["city"],
+        "sql": """
+        SELECT dc.ID AS city_id, dc.NAME AS city_name, facts.SNAPSHOT_TIME AS snapshot_time,
+            SUM(facts.BICYCLE_DOCKS_AVAILABLE) AS sum_bicycle_docks_available,
+            SUM(facts.BICYCLE_AVAILABLE) AS sum_bicycle_available
+        FROM ({facts}) AS facts
+        JOIN DIM_CITY dc ON dc.ID = facts.CITY_ID
+        WHERE facts.SNAPSHOT_TIME = $snapshot_time
+            AND ($city IS NULL OR lower(dc.NAME) = lower($city))
+        GROUP BY dc.ID, dc.NAME, facts.SNAPSHOT_TIME
+        ORDER BY dc.NAME;
+        """
+    },
+    "/cities/availability": {
+        "parameters": ["city", "start", "end"],
+        "sql": f"""
+        SELECT rollups.CITY_ID AS city_id, dc.NAME AS city_name, {AVAILABILITY_COLUMNS_SQL}
+        FROM ROLLUP_CITY_STATEMENT rollups
+        LEFT JOIN DIM_CITY dc ON dc.ID = rollups.CITY_ID
+        WHERE rollups.GRAIN = '{{grain}}'
+            AND ($start IS NULL OR rollups.PERIOD_START >= $start)
+            AND ($end IS NULL OR rollups.PERIOD_START < $end)
+            AND ($city IS NULL OR lower(dc.NAME) = lower($city))
+        GROUP BY rollups.CITY_ID, dc.NAME
+        ORDER BY rollups.CITY_ID;
+        """
+    },
+    "/stations/availability": {
+        "parameters": ["station", "city", "start", "end"],
+        "sql": f"""
+        SELECT rollups.STATION_ID AS station_id, ds.NAME AS station_name, dc.NAME AS city_name, {AVAILABILITY_COLUMNS_SQL}
+        FROM ROLLUP_STATION_STATEMENT rollups
+        LEFT JOIN DIM_STATION ds ON ds.ID = rollups.STATION_ID
+        LEFT JOIN DIM_CITY dc ON dc.ID = rollups.CITY_ID
+        WHERE rollups.GRAIN = '{{grain}}'
+            AND ($start IS NULL OR rollups.PERIOD_START >= $start)
+            AND ($end IS NULL OR rollups.PERIOD_START < $end)
+            AND ($station IS NULL OR rollups.STATION_ID = $station)
+            AND ($city IS NULL OR lower(dc.NAME) = lower($city))
+        GROUP BY rollups.STATION_ID, ds.NAME, dc.NAME
+        ORDER BY rollups.STATION_ID;
+        """
+    },
+    "/stations/nearest": {
+        "parameters": ["longitude", "latitude", "k", "radius", "min_bicycles", "min_docks"],
+        "required": ["longitude", "latitude"],
+        "search": find_nearest_stations
+    }
+}
+
+class QueryError(ValueError):
+    """
+    Invalid request, answered with its HTTP status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def handle_request(path, parameters):
+    """
+    Answer a request of the service, from the cache when the database didn't change since it was computed
+
+    Params :
+        - path : string, path of the request
+        - parameters : dict, parameters of the query string, one value each
+
+    Returns : (status, body), HTTP status and JSON response as bytes
+    """
+
+    start = time.perf_counter()
+
+    try:
+        if path == "/metrics":
+            body = get_service_metrics()
+        elif path in QUERIES:
+            body = get_query_result(path, parameters)
+        else:
+            raise QueryError(404, f"Unknown path {path}, expected one of {sorted(QUERIES)} or /metrics")
+
+        status = 200
+    except QueryError as error:
+        status, body = error.status, {"error": str(error)}
+
+    response = body if isinstance(body, bytes) else json.dumps(body, default=str).encode()
+    record_latency(path if path in QUERIES or path == "/metrics" else "other", time.perf_counter() - start)
+
+    return status, response
+
+def get_query_result(path, parameters):
+    """
+    Get the response of a query, from the cache or from the database
+
+    Params :
+        - path : string, path of the query, as found in QUERIES
+        - parameters : dict, parameters of the query string
+
+    Returns : body, bytes, JSON list of the rows
+    """
+
+    unknown_parameters = set(parameters) - set(QUERIES[path]["parameters"])
+
+    if unknown_parameters:
+        raise QueryError(400, f"Unknown parameters {sorted(unknown_parameters)} for {path}, expected {QUERIES[path]['parameters']}")
+
+    missing_parameters = [name for name in QUERIES[path].get("required", []) if name not in parameters]
+
+    if missing_parameters:
+        raise QueryError(400, f"Missing parameters {missing_parameters} for {path}")
+
+    query_parameters = {name: parameters.get(name) for name in QUERIES[path]["parameters"]}
+
+    for name in ["start", "end"]:
+        if name in query_parameters:
+            query_parameters[name] = parse_period_bound(name, query_parameters[name])
+
+    for name, parameter_type in NUMERIC_PARAMETERS.items():
+        if query_parameters.get(name) is not None:
+            try:
+                query_parameters[name] = parameter_type(query_parameters[name])
+            except ValueError:
+                raise QueryError(400, f"Invalid {name} {query_parameters[name]!r}, expected a {parameter_type.__name__}")
+
+    for name, (minimum, excluded) in NUMERIC_MINIMUMS.items():
+        value = query_parameters.get(name)
+
+        # Written so that a NaN is rejected too
+        if value is not None and not (value > minimum if excluded else value >= minimum):
+            raise QueryError(400, f"Invalid {name} {value!r}, expected {'more than' if excluded else 'at least'} {minimum}")
+
+    refresh_data_state()
+
+    # The version the response is computed from, the database can be replaced while the query runs
+    version = _data_state["version"]
+    cache_key = (path, tuple(sorted(query_parameters.items())))
+    body = get_cached_result(cache_key)
+
+    if body is None:
+        body = json.dumps(run_query(path, query_parameters), default=str).encode()
+        store_cached_result(cache_key, body, version)
+
+    return body
+
+def parse_period_bound(name, value):
+    """
+    Parse the bound of a range of time, rounded to the hour : the start down and the end up,
+    the rollups are computed for whole hours
+
+    Params :
+        - name : string, "start" or "end"
+        - value : string, ISO date or datetime, or None
+
+    Returns : bound, datetime or None
+    """
+
+    if value is None:
+        return None
+
+    try:
+        bound = datetime.fromisoformat(value)
+    except ValueError:
+        raise QueryError(400, f"Invalid {name} {value!r}, expected an ISO date or datetime")
+
+    hour = bound.replace(minute=0, second=0, microsecond=0)
+
+    return hour + timedelta(hours=1) if name == "end" and hour != bound else hour
+
+def get_rollup_grain(start, end):
+    """
+    Get the coarsest grain of the rollups whose periods match a range of time exactly
+
+    Params :
+        - start : datetime or None, start of the range, rounded to the hour
+        - end : datetime or None, end of the range, excluded, rounded to the hour
+
+    Returns : grain, string, "month", "day" or "hour"
+    """
+
+    bounds = [bound for bound in [start, end] if bound is not None]
+
+    if all(bound.day == 1 and bound.hour == 0 for bound in bounds):
+        return "month"
+
+    if all(bound.hour == 0 for bound in bounds):
+        return "day"
+
+    return "hour"
+
+def run_query(path, query_parameters):
+    """
+    Run a query on a cursor of the read-only pool
+
+    Params :
+        - path : string, path of the query, as found in QUERIES
+        - query_parameters : dict, value of each parameter of the query, None when not given
+
+    Returns : rows, list of dicts, one per row
+    """
+
+    cursor = acquire_cursor()
+
+    try:
+        if "search" in QUERIES[path]:
+            return QUERIES[path]["search"](
+                get_station_index(cursor),
+                **{name: value for name, value in query_parameters.items() if value is not None}
+            )
+
+        parameters = dict(query_parameters)
+        sql_statement = QUERIES[path]["sql"]
+
+        if "{facts}" in sql_statement:
+            snapshot_time = _data_state["version"][1]
+            parameters["snapshot_time"] = snapshot_time
+            sql_statement = sql_statement.replace("{facts}", get_fact_sql(cursor, snapshot_time, snapshot_time))
+
+        if "{grain}" in sql_statement:
+            sql_statement = sql_statement.replace("{grain}", get_rollup_grain(parameters.get("start"), parameters.get("end")))
+
+        result = cursor.execute(sql_statement, parameters)
+        columns = [description[0] for description in result.description]
+
+        return [dict(zip(columns, row)) for row in result.fetchall()]
+    finally:
+        release_cursor(cursor)
+
+def get_station_index(cursor):
+    """
+    Get the grid index of the stations of the latest aggregated snapshot, loaded once per version
+
+    Params :
+        - cursor : DuckDB connection, of the read-only pool
+
+    Returns : index, dict, as returned by load_station_index
+    """
+
+    if _data_state["station_index"] is None:
+        _data_state["station_index"] = load_station_index(cursor)
+
+    return _data_state["station_index"]
+
+def get_file_token():
+    """
+    Get the modification time and the size of the database file and of its WAL, which change
+    whenever the pipeline writes, without opening the database
+
+    Returns : token, tuple, None if the database doesn't exist
+    """
+
+    token = []
+
+    for path in [database.DATABASE_PATH, f"{database.DATABASE_PATH}.wal"]:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            token.append((stat.st_mtime_ns, stat.st_size))
+        elif path == database.DATABASE_PATH:
+            return None
+
+    return tuple(token)
+
+def refresh_data_state():
+    """
+    Check whether the pipeline wrote the database since the last query. The connection is then
+    opened again, a read-only connection doesn't see the snapshots written after it was opened,
+    and the cache is emptied when the aggregated version changed. While the pipeline writes the
+    file, it can't be opened : the cached responses of the former version are still served
+    """
+
+    token = get_file_token()
+
+    with _pool_condition:
+        if token == _data_state["token"]:
+            return
+
+        close_pool()
+
+        try:
+            cursor = acquire_cursor()
+        except QueryError:
+            return
+
+        try:
+            version = cursor.execute("""
+            SELECT
+                (SELECT MAX(VERSION) FROM AGREGATE_WATERMARK),
+                (SELECT MAX(SNAPSHOT_TIME) FROM FACT_STATION_STATEMENT);
+            """).fetchone()
+        finally:
+            release_cursor(cursor)
+
+        # The cache is emptied and the version changed at once, a response of the former
+        # version can't be stored in between
+        with _cache_lock:
+            if version != _data_state["version"]:
+                _cache.clear()
+                _data_state["station_index"] = None
+                _cache_stats["invalidations"] += 1
+
+            _data_state["version"] = version
+
+        _data_state["token"] = token
+
+def acquire_cursor():
+    """
+    Take a cursor of the read-only pool, the connection is opened if it was closed
+
+    Returns : cursor, DuckDB connection, to give back with release_cursor
+    """
+
+    with _pool_condition:
+        if _pool["connection"] is None:
+            try:
+                connection = database.connect_read_only()
+            except duckdb.IOException as error:
+                raise QueryError(503, f"The database can't be read while the pipeline writes it, retry later ({error})")
+
+            _pool["connection"] = connection
+            _pool["cursors"] = queue.Queue()
+
+            for _ in range(QUERY_POOL_SIZE):
+                _pool["cursors"].put(connection.cursor())
+
+        _pool["in_use"] += 1
+        _pool["last_used"] = time.monotonic()
+        cursors = _pool["cursors"]
+
+    return cursors.get()
+
+def release_cursor(cursor):
+    """
+    Give a cursor back to the read-only pool
+
+    Params :
+        - cursor : DuckDB connection, as returned by acquire_cursor
+    """
+
+    with _pool_condition:
+        _pool["cursors"].put(cursor)
+        _pool["in_use"] -= 1
+        _pool["last_used"] = time.monotonic()
+        _pool_condition.notify_all()
+
+def close_pool():
+    """
+    Close the read-only connection and its cursors, once the queries running are done, so
+    that the file is released for the pipeline
+    """
+
+    with _pool_condition:
+        _pool_condition.wait_for(lambda: _pool["in_use"] == 0)
+
+        if _pool["connection"] is None:
+            return
+
+        while not _pool["cursors"].empty():
+            _pool["cursors"].get().close()
+
+        _pool["connection"].close()
+        _pool["connection"] = None
+        _pool["cursors"] = None
+
+def close_idle_pool():
+    """
+    Close the read-only connection when no query used it for QUERY_IDLE_SECONDS
+    """
+
+    with _pool_condition:
+        if _pool["connection"] is not None and _pool["in_use"] == 0 and time.monotonic() - _pool["last_used"] > QUERY_IDLE_SECONDS:
+            close_pool()
+
+def get_cached_result(cache_key):
+    """
+    Get a response from the LRU cache
+
+    Params :
+        - cache_key : tuple, path and parameters of the query
+
+    Returns : body, bytes, or None when the response isn't cached
+    """
+
+    with _cache_lock:
+        body = _cache.get(cache_key)
+
+        if body is None:
+            _cache_stats["misses"] += 1
+        else:
+            _cache_stats["hits"] += 1
+            _cache.move_to_end(cache_key)
+
+        return body
+
+def store_cached_result(cache_key, body, version):
+    """
+    Keep a response in the LRU cache, the least recently used one is dropped when it is full.
+    The response isn't kept when the aggregated version changed while it was computed
+
+    Params :
+        - cache_key : tuple, path and parameters of the query
+        - body : bytes, JSON response
+        - version : tuple, aggregated version the response was computed from
+    """
+
+    with _cache_lock:
+        if version != _data_state["version"]:
+            return
+
+        _cache[cache_key] = body
+        _cache.move_to_end(cache_key)
+
+        while len(_cache) > QUERY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def record_latency(endpoint, elapsed):
+    """
+    Record the latency of a request, cache hits included
+
+    Params :
+        - endpoint : string, path of the request
+        - elapsed : float, seconds spent to answer it
+    """
+
+    with _latencies_lock:
+        _latencies.setdefault(endpoint, deque(maxlen=QUERY_LATENCY_WINDOW)).append(elapsed)
+
+def get_percentile(values, percentile):
+    """
+    Get a percentile of a list of values, with the nearest-rank method
+
+    Params :
+        - values : list of floats, not empty
+        - percentile : float, between 0 and 100
+
+    Returns : value, float
+    """
+
+    values = sorted(values)
+
+    return values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
+
+def get_service_metrics():
+    """
+    Get the p50 and p99 latencies of each endpoint, over its last QUERY_LATENCY_WINDOW requests, and the use of the cache
+
+    Returns : metrics, dict
+    """
+
+    with _latencies_lock:
+        latencies = {endpoint: list(values) for endpoint, values in _latencies.items()}
+
+    with _cache_lock:
+        cache = {**_cache_stats, "size": len(_cache), "max_size": QUERY_CACHE_SIZE}
+
+    return {
+        "endpoints": {
+            endpoint: {
+                "count": len(values),
+                "p50_ms": round(get_percentile(values, 50) * 1000, 3),
+                "p99_ms": round(get_percentile(values, 99) * 1000, 3)
+            }
+            for endpoint, values in latencies.items()
+        },
+        "cache": cache,
+        "aggregated_version": _data_state["version"]
+    }
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answer the GET requests with handle_request
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        status, body = handle_request(url.path, parameters)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The latencies are exposed by /metrics, every request isn't logged
+        pass
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    HTTP server of the service, a thread per request. The read-only connection is closed
+    between the requests once it is idle, see QUERY_IDLE_SECONDS
+    """
+
+    daemon_threads = True
+
+    def service_actions(self):
+        close_idle_pool()
+
+def create_server(host=QUERY_HOST, port=QUERY_PORT):
+    """
+    Create the HTTP server of the service, to run with serve_forever
+
+    Params :
+        - host : string, address listened to
+        - port : int, port listened to, 0 for any free port
+
+    Returns : server, QueryServer
+    """
+
+    return QueryServer((host, port), QueryRequestHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the availability queries of the aggregate tables over HTTP/JSON")
+    parser.add_argument("--host", default=QUERY_HOST, help="address listened to")
+    parser.add_argument("--port", type=int, default=QUERY_PORT, help="port listened to")
+    parser.add_argument("--pool-size", type=int, default=QUERY_POOL_SIZE, help="number of queries run at once")
+    parser.add_argument("--cache-size", type=int, default=QUERY_CACHE_SIZE, help="number of responses kept by the cache")
+    args = parser.parse_args()
+
+    QUERY_POOL_SIZE = args.pool_size
+    QUERY_CACHE_SIZE = args.cache_size
+
+    server = create_server(args.host, args.port)
+    print(f"Query service listening on http://{args.host}:{server.server_address[1]}, paths {sorted(QUERIES)} and /metrics")
+
+    try:
+        server.serve_forever(poll_interval=1)
+    finally:
+        close_pool()
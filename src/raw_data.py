@@ -0,0 +1,296 @@
+import glob
+import json
+import os
+from datetime import datetime
+
+import duckdb
+
+from metrics import add_metric
+from source_state import get_file_hash
+
+RAW_DATA_DIRECTORY = "data/raw_data"
+
+# Archived days are stored as Parquet files, one per source and per day : source=<source>/date=<date>/data.parquet
+# Each row is a record of the raw data, with the time and the content hash of the snapshot it comes from
+RAW_ARCHIVE_DIRECTORY = "data/raw_archive"
+
+# In-memory DuckDB database used to read the archive, opened once per process
+_archive_connection = None
+
+# Raw files are partitioned by date, hour and source : <date>/<HH>/<source>/<HHMMSS>.json
+# Files of the former layout, <date>/<file_name>, are read as the snapshot of midnight of their day
+SNAPSHOT_DATE_FORMAT = "%Y-%m-%d"
+SNAPSHOT_HOUR_FORMAT = "%H"
+SNAPSHOT_TIME_FORMAT = "%H%M%S"
+
+def get_snapshot_time():
+    """
+    Get the time of a new snapshot, shared by every source ingested in the same run
+
+    Returns : snapshot_time, datetime truncated to the second
+    """
+
+    return datetime.now().replace(microsecond=0)
+
+def get_snapshot_path(source_name, snapshot_time):
+    """
+    Get the path of the raw file of a source for a snapshot
+
+    Params :
+        - source_name : string, name of the source
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : file_path, string
+    """
+
+    return "/".join([
+        RAW_DATA_DIRECTORY,
+        snapshot_time.strftime(SNAPSHOT_DATE_FORMAT),
+        snapshot_time.strftime(SNAPSHOT_HOUR_FORMAT),
+        source_name,
+        f"{snapshot_time.strftime(SNAPSHOT_TIME_FORMAT)}.json"
+    ])
+
+def find_snapshot_file(source_name, file_name, snapshot_time):
+    """
+    Find the raw file of a source for a snapshot, in the snapshot layout first and
+    then in the former one-file-per-day layout
+
+    Params :
+        - source_name : string, name of the source
+        - file_name : string, name of the file of the source in the former layout
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : file_path, string or None if the source has no file for this snapshot
+    """
+
+    file_path = get_snapshot_path(source_name, snapshot_time)
+    if os.path.exists(file_path):
+        return file_path
+
+    snapshot_date = snapshot_time.strftime(SNAPSHOT_DATE_FORMAT)
+    legacy_file_path = f"{RAW_DATA_DIRECTORY}/{snapshot_date}/{file_name}"
+    if snapshot_time.time() == datetime.min.time() and os.path.exists(legacy_file_path):
+        return legacy_file_path
+
+    return None
+
+def list_snapshot_times(snapshot_date):
+    """
+    List the snapshots of a day
+
+    Params :
+        - snapshot_date : string, day formatted as YYYY-MM-DD
+
+    Returns : snapshot_times, sorted list of datetime
+    """
+
+    directory = f"{RAW_DATA_DIRECTORY}/{snapshot_date}"
+    snapshot_times = set()
+
+    if not os.path.isdir(directory):
+        return sorted(list_archived_snapshot_times(snapshot_date))
+
+    for entry in os.scandir(directory):
+        # A file of the former layout is the snapshot of midnight
+        if entry.is_file() and entry.name.endswith(".json"):
+            snapshot_times.add(datetime.strptime(snapshot_date, SNAPSHOT_DATE_FORMAT))
+
+        elif entry.is_dir():
+            for source_entry in os.scandir(entry.path):
+                if not source_entry.is_dir():
+                    continue
+
+                for file_entry in os.scandir(source_entry.path):
+                    if file_entry.name.endswith(".json") and not file_entry.name.startswith("."):
+                        snapshot_times.add(datetime.strptime(
+                            f"{snapshot_date} {file_entry.name[:-len('.json')]}",
+                            f"{SNAPSHOT_DATE_FORMAT} {SNAPSHOT_TIME_FORMAT}"
+                        ))
+
+    snapshot_times.update(list_archived_snapshot_times(snapshot_date))
+
+    return sorted(snapshot_times)
+
+def get_archive_path(source_name, snapshot_date):
+    """
+    Get the path of the archive of a source for a day
+
+    Params :
+        - source_name : string, name of the source
+        - snapshot_date : string, day formatted as YYYY-MM-DD
+
+    Returns : archive_path, string
+    """
+
+    return f"{RAW_ARCHIVE_DIRECTORY}/source={source_name}/date={snapshot_date}/data.parquet"
+
+def get_archive_cursor():
+    """
+    Get a cursor on the in-memory database used to read the archive, a cursor is
+    cheap to create and can be used by one thread at a time
+
+    Returns : cursor, DuckDB connection
+    """
+
+    global _archive_connection
+
+    if _archive_connection is None:
+        _archive_connection = duckdb.connect()
+
+    return _archive_connection.cursor()
+
+def list_archived_snapshot_times(snapshot_date):
+    """
+    List the snapshots of a day found inside the archive
+
+    Params :
+        - snapshot_date : string, day formatted as YYYY-MM-DD
+
+    Returns : snapshot_times, set of datetime
+    """
+
+    archive_paths = glob.glob(get_archive_path("*", snapshot_date))
+
+    if not archive_paths:
+        return set()
+
+    with get_archive_cursor() as con:
+        rows = con.execute("SELECT DISTINCT snapshot_time FROM read_parquet(?, hive_partitioning = false);", [archive_paths]).fetchall()
+
+    return {row[0] for row in rows}
+
+def load_snapshot_data(source_name, file_name, snapshot_time):
+    """
+    Load the raw data of a source for a snapshot, from its JSON file when it is still
+    there and from the archive otherwise
+
+    Params :
+        - source_name : string, name of the source
+        - file_name : string, name of the file of the source in the former layout
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : data, list of records as loaded from the JSON file, or None if the source has no data for this snapshot
+    """
+
+    file_path = find_snapshot_file(source_name, file_name, snapshot_time)
+
+    if file_path is not None:
+        with open(file_path) as fd:
+            data = json.load(fd)
+
+        add_metric("bytes_read", os.path.getsize(file_path))
+        add_metric("rows_in", len(data))
+
+        return data
+
+    archive_path = get_archive_path(source_name, snapshot_time.strftime(SNAPSHOT_DATE_FORMAT))
+
+    if not os.path.exists(archive_path):
+        return None
+
+    with get_archive_cursor() as con:
+        cursor = con.execute("""
+        SELECT * EXCLUDE (snapshot_time, content_hash)
+        FROM read_parquet(?, hive_partitioning = false)
+        WHERE snapshot_time = ?;
+        """, [archive_path, snapshot_time])
+
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+
+    add_metric("rows_in", len(rows))
+
+    return [dict(zip(columns, row)) for row in rows] if rows else None
+
+def get_snapshot_hash(source_name, file_name, snapshot_time):
+    """
+    Get the content hash of the raw data of a source for a snapshot, the archive keeps
+    the hash of the JSON file it was built from
+
+    Params :
+        - source_name : string, name of the source
+        - file_name : string, name of the file of the source in the former layout
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : content_hash, string or None if the source has no data for this snapshot
+    """
+
+    file_path = find_snapshot_file(source_name, file_name, snapshot_time)
+
+    if file_path is not None:
+        return get_file_hash(file_path)
+
+    archive_path = get_archive_path(source_name, snapshot_time.strftime(SNAPSHOT_DATE_FORMAT))
+
+    if not os.path.exists(archive_path):
+        return None
+
+    with get_archive_cursor() as con:
+        content_hash = con.execute("""
+        SELECT content_hash
+        FROM read_parquet(?, hive_partitioning = false)
+        WHERE snapshot_time = ?
+        LIMIT 1;
+        """, [archive_path, snapshot_time]).fetchone()
+
+    return content_hash[0] if content_hash else None
+
+def get_snapshot_relation_sql(source_name, file_name, snapshot_time):
+    """
+    Get the SQL relation reading the raw data of a source for a snapshot, from its JSON
+    file when it is still there and from the archive otherwise
+
+    Params :
+        - source_name : string, name of the source
+        - file_name : string, name of the file of the source in the former layout
+        - snapshot_time : datetime, time of the snapshot
+
+    Returns : relation_sql, string to use inside a FROM clause, or None if the source has no data for this snapshot
+    """
+
+    file_path = find_snapshot_file(source_name, file_name, snapshot_time)
+
+    if file_path is not None:
+        # The file is read by the query using the relation
+        add_metric("bytes_read", os.path.getsize(file_path))
+
+        return f"read_json({quote_sql_string(file_path)})"
+
+    archive_path = get_archive_path(source_name, snapshot_time.strftime(SNAPSHOT_DATE_FORMAT))
+
+    if not os.path.exists(archive_path):
+        return None
+
+    return f"""(
+        SELECT * EXCLUDE (snapshot_time, content_hash)
+        FROM read_parquet({quote_sql_string(archive_path)}, hive_partitioning = false)
+        WHERE snapshot_time = TIMESTAMP {quote_sql_string(snapshot_time.isoformat(sep=" "))}
+    )"""
+
+def quote_sql_string(value):
+    """
+    Quote a string as a SQL literal
+
+    Params :
+        - value : string, value to quote
+
+    Returns : literal, string
+    """
+
+    return "'" + value.replace("'", "''") + "'"
+
+def get_latest_snapshot_time(snapshot_date=None):
+    """
+    Get the latest snapshot of a day
+
+    Params :
+        - snapshot_date : string, day formatted as YYYY-MM-DD, today by default
+
+    Returns : snapshot_time, datetime or None if the day has no snapshot
+    """
+
+    snapshot_date = snapshot_date or datetime.now().strftime(SNAPSHOT_DATE_FORMAT)
+    snapshot_times = list_snapshot_times(snapshot_date)
+
+    return snapshot_times[-1] if snapshot_times else None
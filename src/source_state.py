@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Persisted state of the sources, stored next to data/raw_data
+# - "sources" : for each source, the ETag, Last-Modified, content hash and file of its last download
+# - "consolidated" : for each consolidate table, the file and content hash last consolidated per source
+SOURCE_STATE_PATH = "data/source_state.json"
+
+# Sources are ingested concurrently, updates of the state file are serialized
+_lock = threading.Lock()
+
+def load_source_state(path=SOURCE_STATE_PATH):
+    """
+    Load the source state, an empty state is returned if it was never saved
+
+    Params :
+        - path : string, path of the state file
+
+    Returns : state, dict with the "sources" and "consolidated" sections
+    """
+
+    state = {"sources": {}, "consolidated": {}}
+
+    if os.path.exists(path):
+        with open(path) as fd:
+            state.update(json.load(fd))
+
+    return state
+
+def save_source_state(state, path=SOURCE_STATE_PATH):
+    """
+    Save the source state through a temporary file and a rename, so that the state
+    file is never left half written
+
+    Params :
+        - state : dict, state to save
+        - path : string, path of the state file
+    """
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".source_state.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(state, tmp_file, indent=4)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_source_state(section, key, path=SOURCE_STATE_PATH):
+    """
+    Get one entry of the source state
+
+    Params :
+        - section : string, "sources" or the name of a consolidate table
+        - key : string, name of the source
+        - path : string, path of the state file
+
+    Returns : entry, dict or None if the entry doesn't exist
+    """
+
+    state = load_source_state(path)
+
+    if section == "sources":
+        return state["sources"].get(key)
+
+    return state["consolidated"].get(section, {}).get(key)
+
+def update_source_state(section, key, entry, path=SOURCE_STATE_PATH):
+    """
+    Set one entry of the source state and save it
+
+    Params :
+        - section : string, "sources" or the name of a consolidate table
+        - key : string, name of the source
+        - entry : dict, new value of the entry
+        - path : string, path of the state file
+    """
+
+    with _lock:
+        state = load_source_state(path)
+
+        if section == "sources":
+            state["sources"][key] = entry
+        else:
+            state["consolidated"].setdefault(section, {})[key] = entry
+
+        save_source_state(state, path)
+
+def get_file_hash(file_path):
+    """
+    Compute the content hash of a file
+
+    Params :
+        - file_path : string, path of the file
+
+    Returns : content_hash, string, SHA-256 of the file
+    """
+
+    content_hash = hashlib.sha256()
+
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(64 * 1024), b""):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
@@ -0,0 +1,166 @@
+# Sources fetched by the ingestion engine
+# Each source has its url, its headers, its timeout (in seconds) and the name of its file in
+# the former one-file-per-day raw layout, still read for the days ingested with it
+#
+# The sources of stations also have an "adapter", read by the generic consolidation engine of
+# data_consolidation, so that a new city is an entry of this dict and no new code :
+# - "city_code" : prefix of the station identifiers, formatted as <city code>-<station code>
+# - "station_code" : field of the code of a station
+# - "city" : name of the city whose INSEE code is looked up, for the sources without INSEE code
+# - "station_fields" : field of each column of CONSOLIDATE_STATION, except id, code, address and created_date
+#   city_code can be left out when "city" is set
+# - "statement_fields" : field of bicycle_docks_available, bicycle_available and last_statement_date
+#   for CONSOLIDATE_STATION_STATEMENT
+#
+# A field is the name of a column of the flattened raw data, nested keys joined by ".", or a dict :
+# - "field" : name of the column
+# - "suffix" : number of characters kept at the end of the value
+# - "item" : position of the value inside a list
+# - "open_value" : value of an open station, the status is standardized as "OPEN" or "CLOSED"
+# - "epoch" : True when the value is a Unix timestamp, in seconds
+# - "value" : constant, for the columns the raw data doesn't have, instead of "field"
+SOURCES = {
+    "paris": {
+        "url": "https://opendata.paris.fr/api/explore/v2.1/catalog/datasets/velib-disponibilite-en-temps-reel/exports/json",
+        "headers": {},
+        "timeout": 60,
+        "file_name": "paris_realtime_bicycle_data.json",
+        "adapter": {
+            "city_code": 1,
+            "station_code": "stationcode",
+            "city": None,
+            "station_fields": {
+                "name": "name",
+                "city_name": "nom_arrondissement_communes",
+                "city_code": "code_insee_commune",
+                "longitude": "coordonnees_geo.lon",
+                "latitude": "coordonnees_geo.lat",
+                "status": {"field": "is_installed", "open_value": "OUI"},
+                "capacity": "capacity"
+            },
+            "statement_fields": {
+                "bicycle_docks_available": "numdocksavailable",
+                "bicycle_available": "numbikesavailable",
+                "last_statement_date": "duedate"
+            }
+        }
+    },
+    "nantes": {
+        "url": "https://data.nantesmetropole.fr/api/explore/v2.1/catalog/datasets/244400404_stations-velos-libre-service-nantes-metropole-disponibilites/exports/json",
+        "headers": {},
+        "timeout": 30,
+        "file_name": "nantes_realtime_bicycle_data.json",
+        "adapter": {
+            "city_code": 2,
+            "station_code": "number",
+            "city": "Nantes",
+            "station_fields": {
+                "name": "name",
+                "city_name": "contract_name",
+                "longitude": "position.lon",
+                "latitude": "position.lat",
+                "status": "status",
+                "capacity": "bike_stands"
+            },
+            "statement_fields": {
+                "bicycle_docks_available": "available_bike_stands",
+                "bicycle_available": "available_bikes",
+                "last_statement_date": "last_update"
+            }
+        }
+    },
+    "toulouse": {
+        "url": "https://data.toulouse-metropole.fr/api/explore/v2.1/catalog/datasets/api-velo-toulouse-temps-reel/exports/json",
+        "headers": {},
+        "timeout": 30,
+        "file_name": "toulouse_realtime_bicycle_data.json",
+        "adapter": {
+            "city_code": 3,
+            "station_code": "number",
+            "city": "Toulouse",
+            "station_fields": {
+                "name": "name",
+                "city_name": "contract_name",
+                "longitude": "position.lon",
+                "latitude": "position.lat",
+                "status": "status",
+                "capacity": "bike_stands"
+            },
+            "statement_fields": {
+                "bicycle_docks_available": "available_bike_stands",
+                "bicycle_available": "available_bikes",
+                "last_statement_date": "last_update"
+            }
+        }
+    },
+    "strasbourg": {
+        "url": "https://data.strasbourg.eu/api/explore/v2.1/catalog/datasets/stations-velhop/exports/json",
+        "headers": {},
+        "timeout": 30,
+        "file_name": "strasbourg_realtime_bicycle_data.json",
+        "adapter": {
+            "city_code": 4,
+            "station_code": "id",
+            "city": "Strasbourg",
+            "station_fields": {
+                "name": "na",
+                # There's no information about the name of the city inside the dataset
+                "city_name": {"value": "strasbourg"},
+                "longitude": "lon",
+                "latitude": "lat",
+                # The flag is either a string or an integer depending on the export
+                "status": {"field": "is_installed", "open_value": "1"},
+                "capacity": "to"
+            },
+            "statement_fields": {
+                # "av" is the number of bikes and "to" the capacity of the station
+                "bicycle_docks_available": "num_docks_available",
+                "bicycle_available": "av",
+                "last_statement_date": {"field": "last_reported", "epoch": True}
+            }
+        }
+    },
+    "montpellier": {
+        "url": "https://portail-api-data.montpellier3m.fr/bikestation",
+        "headers": {"accept": "application/json"},
+        "timeout": 30,
+        "file_name": "montpellier_realtime_bicycle_data.json",
+        "adapter": {
+            "city_code": 5,
+            "station_code": {"field": "id", "suffix": 3},
+            "city": "Montpellier",
+            "station_fields": {
+                "name": "address.value.streetAddress",
+                "city_name": "address.value.addressLocality",
+                # The coordinates are formatted inside a list
+                "longitude": {"field": "location.value.coordinates", "item": 0},
+                "latitude": {"field": "location.value.coordinates", "item": 1},
+                "status": {"field": "status.value", "open_value": "working"},
+                "capacity": "totalSlotNumber.value"
+            },
+            "statement_fields": {
+                "bicycle_docks_available": "freeSlotNumber.value",
+                "bicycle_available": "availableBikeNumber.value",
+                "last_statement_date": "availableBikeNumber.metadata.timestamp.value"
+            }
+        }
+    },
+    "commune": {
+        "url": "https://geo.api.gouv.fr/communes",
+        "headers": {},
+        "timeout": 60,
+        "file_name": "commune_data.json"
+    }
+}
+
+def get_station_sources(sources=SOURCES):
+    """
+    Get the sources of stations, those described by an adapter
+
+    Params :
+        - sources : dict, sources as found in SOURCES
+
+    Returns : source_names, list of strings, in the order of SOURCES
+    """
+
+    return [source_name for source_name, source in sources.items() if "adapter" in source]
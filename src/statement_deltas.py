@@ -0,0 +1,327 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# With the delta encoding, a snapshot stores all its statements (keyframe) when its keyframe is older than this
+# interval : rebuilding the statements of a snapshot never reads more than an interval of deltas
+STATEMENT_KEYFRAME_INTERVAL = timedelta(hours=6)
+
+# Columns of the statements compared with the previous snapshot, a statement is stored again when one of them changes
+STATEMENT_VALUE_COLUMNS = ["BICYCLE_DOCKS_AVAILABLE", "BICYCLE_AVAILABLE", "LAST_STATEMENT_DATE"]
+
+# Statements of a set of snapshots, rebuilt from their keyframe : the statements of a keyframe are read as they are,
+# the statements of another snapshot are the latest statement of each station since its keyframe, unless it is
+# a removal or its source wasn't consolidated into the snapshot. {snapshots} is replaced by a SELECT of the
+# SNAPSHOT_TIME of the snapshots
+STATEMENTS_SQL = """
+WITH requested AS (
+    SELECT SNAPSHOT_TIME, KEYFRAME_TIME
+    FROM CONSOLIDATE_SNAPSHOT
+    WHERE SNAPSHOT_TIME IN (SELECT SNAPSHOT_TIME FROM ({snapshots}))
+), latest AS (
+    SELECT requested.SNAPSHOT_TIME, st.STATION_ID, MAX(st.SNAPSHOT_TIME) AS STATEMENT_TIME
+    FROM requested
+    JOIN CONSOLIDATE_STATION_STATEMENT st ON st.SNAPSHOT_TIME BETWEEN requested.KEYFRAME_TIME AND requested.SNAPSHOT_TIME
+    WHERE requested.KEYFRAME_TIME < requested.SNAPSHOT_TIME
+    GROUP BY requested.SNAPSHOT_TIME, st.STATION_ID
+)
+SELECT st.STATION_ID, st.BICYCLE_DOCKS_AVAILABLE, st.BICYCLE_AVAILABLE, st.LAST_STATEMENT_DATE, st.SNAPSHOT_TIME
+FROM requested
+JOIN CONSOLIDATE_STATION_STATEMENT st ON st.SNAPSHOT_TIME = requested.SNAPSHOT_TIME
+WHERE requested.KEYFRAME_TIME = requested.SNAPSHOT_TIME AND st.IS_REMOVED IS NOT TRUE
+UNION ALL
+SELECT st.STATION_ID, st.BICYCLE_DOCKS_AVAILABLE, st.BICYCLE_AVAILABLE, st.LAST_STATEMENT_DATE, latest.SNAPSHOT_TIME
+FROM latest
+JOIN CONSOLIDATE_STATION_STATEMENT_LOAD load ON load.SNAPSHOT_TIME = latest.SNAPSHOT_TIME AND load.ID_PREFIX = split_part(latest.STATION_ID, '-', 1)
+JOIN CONSOLIDATE_STATION_STATEMENT st ON st.STATION_ID = latest.STATION_ID AND st.SNAPSHOT_TIME = latest.STATEMENT_TIME
+WHERE st.IS_REMOVED IS NOT TRUE
+"""
+
+# Latest snapshot a source was consolidated into, by prefix of its station identifiers, and its keyframe
+LATEST_PREFIX_SNAPSHOT_SQL = """
+SELECT load.SNAPSHOT_TIME, snapshot.KEYFRAME_TIME
+FROM CONSOLIDATE_STATION_STATEMENT_LOAD load
+JOIN CONSOLIDATE_SNAPSHOT snapshot ON snapshot.SNAPSHOT_TIME = load.SNAPSHOT_TIME
+WHERE load.ID_PREFIX = ?
+ORDER BY load.SNAPSHOT_TIME DESC
+LIMIT 1;
+"""
+
+# Statements of the latest snapshot each source was consolidated into, by prefix of the station identifiers
+# (the city_code of the adapter), as the sources of a snapshot are written one by one. The values of a prefix
+# are held in a numpy array, NaN for NULL, with a row per station found through a pandas index. connection,
+# and the snapshot_time and keyframe_time of each prefix, tell whether the state is still the one of the database
+_statement_state = {
+    "connection": None,
+    "prefixes": {}
+}
+
+def get_statements_sql(snapshots_sql):
+    """
+    Get the SQL rebuilding the statements of snapshots, whether they are stored in full or as deltas
+
+    Params :
+        - snapshots_sql : string, SELECT of the SNAPSHOT_TIME of the snapshots
+
+    Returns : sql_statement, string, SELECT of the STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE,
+    LAST_STATEMENT_DATE and SNAPSHOT_TIME of the statements
+    """
+
+    return STATEMENTS_SQL.format(snapshots=snapshots_sql)
+
+def reconstruct_station_statements(con, at_time):
+    """
+    Rebuild the statements of the stations as they were at a given time, from the latest snapshot
+    consolidated at or before it
+
+    Params :
+        - con : DuckDB connection
+        - at_time : datetime, time of the statements
+
+    Returns : statements_df, pandas data frame of the statements, ordered by station
+    """
+
+    snapshots_sql = "SELECT MAX(SNAPSHOT_TIME) AS SNAPSHOT_TIME FROM CONSOLIDATE_SNAPSHOT WHERE SNAPSHOT_TIME <= $at_time"
+
+    return con.execute(f"SELECT * FROM ({get_statements_sql(snapshots_sql)}) ORDER BY STATION_ID;", {"at_time": at_time}).df()
+
+def get_statement_values(statements):
+    """
+    Convert the compared columns of statements into a numpy array, NULL values become NaN
+
+    Params :
+        - statements : Arrow table of the statements
+
+    Returns : values, numpy array of a row per statement and a column per column of STATEMENT_VALUE_COLUMNS
+    """
+
+    columns = []
+
+    for column in STATEMENT_VALUE_COLUMNS:
+        values = statements[column]
+
+        # The days of the dates are compared
+        if pa.types.is_date(values.type):
+            values = pc.cast(values, pa.int32())
+
+        columns.append(pc.cast(values, pa.float64()).to_numpy())
+
+    return np.column_stack(columns) if columns[0].size else np.empty((0, len(STATEMENT_VALUE_COLUMNS)))
+
+def get_station_prefixes(statements):
+    """
+    Get the prefix of the identifier of each station of statements, the city_code of its source
+
+    Params :
+        - statements : Arrow table of the statements
+
+    Returns : prefixes, Arrow array of strings
+    """
+
+    return pc.list_element(pc.split_pattern(statements["STATION_ID"], "-", max_splits=1), 0)
+
+def set_statement_state(con, prefix, snapshot_time, keyframe_time, statements):
+    """
+    Replace the state of a prefix by its statements in the latest snapshot its source was consolidated into
+
+    Params :
+        - con : DuckDB connection the snapshot was written with
+        - prefix : string, prefix of the station identifiers of the source
+        - snapshot_time : datetime, latest snapshot of the source, None when there isn't any
+        - keyframe_time : datetime, keyframe of that snapshot
+        - statements : Arrow table of the statements of the source in that snapshot
+    """
+
+    _statement_state["prefixes"][prefix] = {
+        "snapshot_time": snapshot_time,
+        "keyframe_time": keyframe_time,
+        "station_ids": pd.Index(statements["STATION_ID"].to_pylist(), dtype=object),
+        "values": get_statement_values(statements)
+    }
+
+def reset_statement_state():
+    """
+    Forget the state, it is loaded again from the database by the next delta written
+    """
+
+    _statement_state["connection"] = None
+    _statement_state["prefixes"] = {}
+
+def get_statement_state(con, prefix):
+    """
+    Get the statements of a prefix in the latest snapshot its source was consolidated into, loaded from
+    the database when the state was reset, when the connection changed or when the source was written
+    since, or its snapshot became a keyframe
+
+    Params :
+        - con : DuckDB connection
+        - prefix : string, prefix of the station identifiers of the source
+
+    Returns : state, dict of the latest snapshot of the source, its keyframe and the values of its statements
+    """
+
+    if _statement_state["connection"] is not con:
+        reset_statement_state()
+        _statement_state["connection"] = con
+
+    latest_snapshot = con.execute(LATEST_PREFIX_SNAPSHOT_SQL, [prefix]).fetchone() or (None, None)
+    state = _statement_state["prefixes"].get(prefix)
+
+    if state is None or (state["snapshot_time"], state["keyframe_time"]) != latest_snapshot:
+        snapshot_time, keyframe_time = latest_snapshot
+        statements = con.execute(
+            f"SELECT * FROM ({get_statements_sql('SELECT $snapshot_time AS SNAPSHOT_TIME')}) WHERE split_part(STATION_ID, '-', 1) = $prefix;",
+            {"snapshot_time": snapshot_time, "prefix": prefix}
+        ).to_arrow_table()
+
+        set_statement_state(con, prefix, snapshot_time, keyframe_time, statements)
+
+    return _statement_state["prefixes"][prefix]
+
+def materialize_keyframe(con, snapshot_time):
+    """
+    Store every statement of a snapshot written as deltas, which becomes the keyframe of the
+    following snapshots of its keyframe
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot stored as deltas
+    """
+
+    keyframe_time, created_date = con.execute("SELECT KEYFRAME_TIME, CREATED_DATE FROM CONSOLIDATE_SNAPSHOT WHERE SNAPSHOT_TIME = ?;", [snapshot_time]).fetchone()
+
+    # The statements changed in the snapshot are already stored, and the removed stations aren't rebuilt
+    con.execute(f"""
+    INSERT OR IGNORE INTO CONSOLIDATE_STATION_STATEMENT (STATION_ID, {", ".join(STATEMENT_VALUE_COLUMNS)}, CREATED_DATE, SNAPSHOT_TIME)
+    SELECT STATION_ID, {", ".join(STATEMENT_VALUE_COLUMNS)}, CAST($created_date AS VARCHAR), SNAPSHOT_TIME
+    FROM ({get_statements_sql('SELECT $snapshot_time AS SNAPSHOT_TIME')});
+    """, {"snapshot_time": snapshot_time, "created_date": created_date})
+
+    con.execute("""
+    UPDATE CONSOLIDATE_SNAPSHOT
+    SET KEYFRAME_TIME = ?
+    WHERE KEYFRAME_TIME = ? AND SNAPSHOT_TIME >= ?;
+    """, [snapshot_time, keyframe_time, snapshot_time])
+
+def write_statement_keyframe(con, snapshot_time, all_data, columns):
+    """
+    Store all the statements of a snapshot. The statements of a source written again replace its former
+    statements in the snapshot. The following snapshot, and the snapshot itself, are first stored in full
+    when they are deltas, their statements don't depend on the snapshots before them anymore
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the statements come from
+        - all_data : Arrow table, statements of every city, as typed by validate_consolidated_data
+        - columns : string, columns the statements are inserted with
+
+    Returns : nb_rows, int, number of statements inserted
+    """
+
+    next_snapshot = con.execute("""
+    SELECT SNAPSHOT_TIME, KEYFRAME_TIME
+    FROM CONSOLIDATE_SNAPSHOT
+    WHERE SNAPSHOT_TIME > ?
+    ORDER BY SNAPSHOT_TIME
+    LIMIT 1;
+    """, [snapshot_time]).fetchone()
+
+    if next_snapshot is not None and next_snapshot[1] < next_snapshot[0]:
+        materialize_keyframe(con, next_snapshot[0])
+
+    current_snapshot = con.execute("SELECT KEYFRAME_TIME FROM CONSOLIDATE_SNAPSHOT WHERE SNAPSHOT_TIME = ?;", [snapshot_time]).fetchone()
+
+    if current_snapshot is not None and current_snapshot[0] < snapshot_time:
+        materialize_keyframe(con, snapshot_time)
+
+    con.execute("""
+    DELETE FROM CONSOLIDATE_STATION_STATEMENT
+    WHERE SNAPSHOT_TIME = ? AND split_part(STATION_ID, '-', 1) IN (SELECT DISTINCT split_part(STATION_ID, '-', 1) FROM all_data);
+    """, [snapshot_time])
+
+    # The state may hold the former statements of the snapshot
+    reset_statement_state()
+
+    return con.execute(f"INSERT INTO CONSOLIDATE_STATION_STATEMENT ({columns}) SELECT {columns} FROM all_data;").fetchone()[0]
+
+def write_statement_deltas(con, snapshot_time, all_data, columns):
+    """
+    Store the statements of a snapshot that changed since the latest snapshot of their source, and a removal
+    for each station its source doesn't list anymore. The sources of a snapshot are written at once or one by
+    one, each one is compared with its own latest snapshot. A snapshot older than the latest one, a source
+    written again into the same snapshot, a source of a keyframe, or a snapshot whose keyframe would be older
+    than STATEMENT_KEYFRAME_INTERVAL, is stored in full by write_statement_keyframe
+
+    Params :
+        - con : DuckDB connection
+        - snapshot_time : datetime, snapshot the statements come from
+        - all_data : Arrow table, statements of one or several cities, as typed by validate_consolidated_data
+        - columns : string, columns the statements are inserted with
+
+    Returns : nb_rows, int, number of rows inserted, and keyframe_time, datetime, keyframe of the snapshot
+    """
+
+    latest_snapshot_time, keyframe_time = con.execute("""
+    SELECT SNAPSHOT_TIME, KEYFRAME_TIME
+    FROM CONSOLIDATE_SNAPSHOT
+    ORDER BY SNAPSHOT_TIME DESC
+    LIMIT 1;
+    """).fetchone() or (None, None)
+
+    station_prefixes = get_station_prefixes(all_data)
+    prefixes = pc.unique(station_prefixes).to_pylist()
+    states = {prefix: get_statement_state(con, prefix) for prefix in prefixes}
+
+    is_keyframe = (
+        latest_snapshot_time is None
+        or snapshot_time < latest_snapshot_time
+        or keyframe_time == snapshot_time
+        or snapshot_time - keyframe_time >= STATEMENT_KEYFRAME_INTERVAL
+        or any(state["snapshot_time"] is not None and state["snapshot_time"] >= snapshot_time for state in states.values())
+    )
+
+    if is_keyframe:
+        return write_statement_keyframe(con, snapshot_time, all_data, columns), snapshot_time
+
+    changed_data = []
+    removed_ids = []
+
+    for prefix, state in states.items():
+        prefix_data = all_data.filter(pc.equal(station_prefixes, prefix))
+        station_ids = pd.Index(prefix_data["STATION_ID"].to_pylist(), dtype=object)
+        values = get_statement_values(prefix_data)
+
+        # A source missing since the keyframe has no statement to compare with, all its statements are stored
+        if state["snapshot_time"] is None or state["snapshot_time"] < keyframe_time:
+            changed_data.append(prefix_data)
+        else:
+            # Statements of new stations, or whose values differ from the previous ones, NULL being equal to NULL
+            positions = state["station_ids"].get_indexer(station_ids)
+            is_known = positions >= 0
+            previous_values = np.full(values.shape, np.nan)
+            previous_values[is_known] = state["values"][positions[is_known]]
+
+            is_equal = (previous_values == values) | (np.isnan(previous_values) & np.isnan(values))
+            is_changed = ~is_known | ~is_equal.all(axis=1)
+            changed_data.append(prefix_data.filter(pa.array(is_changed)))
+
+            # The stations of the previous snapshot of the source missing from this one aren't rebuilt anymore
+            removed_ids.extend(state["station_ids"][station_ids.get_indexer(state["station_ids"]) < 0].tolist())
+
+        set_statement_state(con, prefix, snapshot_time, keyframe_time, prefix_data)
+
+    changed_data = pa.concat_tables(changed_data) if changed_data else all_data
+    nb_rows = con.execute(f"INSERT INTO CONSOLIDATE_STATION_STATEMENT ({columns}) SELECT {columns} FROM changed_data;").fetchone()[0]
+
+    if removed_ids:
+        removed_data = pa.table({"STATION_ID": pa.array(removed_ids, pa.string())})
+        nb_rows += con.execute("""
+        INSERT INTO CONSOLIDATE_STATION_STATEMENT (STATION_ID, CREATED_DATE, SNAPSHOT_TIME, IS_REMOVED)
+        SELECT STATION_ID, CAST(? AS VARCHAR), ?, TRUE
+        FROM removed_data;
+        """, [snapshot_time.date(), snapshot_time]).fetchone()[0]
+
+    return nb_rows, keyframe_time
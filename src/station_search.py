@@ -0,0 +1,241 @@
+import math
+
+import numpy as np
+
+from data_agregation import FACT_VIEW, GRID_CELL_DEGREES, GRID_CELL_ROW_SIZE, get_fact_sql
+
+# Mean radius of the Earth, for the haversine distance
+EARTH_RADIUS_METERS = 6_371_008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+# Stations of DIM_STATION placed on the grid, with their statement of the latest aggregated snapshot
+# A station missing from that snapshot isn't returned by the searches
+STATION_INDEX_SQL = """
+SELECT
+    ds.ID,
+    ds.NAME,
+    dc.NAME,
+    CAST(ds.LONGITUDE AS DOUBLE),
+    CAST(ds.LATITUDE AS DOUBLE),
+    ds.GRID_CELL,
+    COALESCE(facts.BICYCLE_AVAILABLE, 0),
+    COALESCE(facts.BICYCLE_DOCKS_AVAILABLE, 0)
+FROM DIM_STATION ds
+JOIN ({facts}) AS facts ON facts.STATION_ID = ds.ID
+LEFT JOIN DIM_CITY dc ON dc.ID = facts.CITY_ID
+WHERE facts.SNAPSHOT_TIME = ? AND ds.GRID_CELL IS NOT NULL
+ORDER BY ds.ID;
+"""
+
+def load_station_index(con):
+    """
+    Load the stations of DIM_STATION and their latest statement into an index of their grid cells,
+    searched by find_nearest_stations and find_stations_within. It has to be loaded again once a new
+    snapshot is aggregated
+
+    Params :
+        - con : DuckDB connection
+
+    Returns : index, dict of the stations as numpy arrays, and of their row numbers by grid cell
+    """
+
+    snapshot_time = con.execute(f"SELECT MAX(SNAPSHOT_TIME) FROM {FACT_VIEW};").fetchone()[0]
+    rows = con.execute(
+        STATION_INDEX_SQL.format(facts=get_fact_sql(con, snapshot_time, snapshot_time)),
+        [snapshot_time]
+    ).fetchall()
+
+    columns = list(zip(*rows)) if rows else [()] * 8
+    longitudes = np.array(columns[3], dtype=np.float64)
+    latitudes = np.array(columns[4], dtype=np.float64)
+    grid_cells = np.array(columns[5], dtype=np.int64)
+
+    # Row numbers of the stations of each cell
+    order = np.argsort(grid_cells, kind="stable")
+    cells, starts = np.unique(grid_cells[order], return_index=True)
+    cell_rows = dict(zip(cells.tolist(), np.split(order, starts[1:]) if len(order) else []))
+
+    # Same computation as GRID_CELL_SQL, the grid cells of the stations come from DIM_STATION
+    grid_rows = np.floor(latitudes / GRID_CELL_DEGREES)
+    grid_columns = np.floor(longitudes / GRID_CELL_DEGREES)
+
+    # Smallest width of a cell over the stations, along the parallels close to the pole
+    max_latitude = float(np.abs(latitudes).max()) + GRID_CELL_DEGREES if rows else 0.0
+
+    return {
+        "snapshot_time": snapshot_time,
+        "station_ids": list(columns[0]),
+        "station_names": list(columns[1]),
+        "city_names": list(columns[2]),
+        "longitudes": longitudes,
+        "latitudes": latitudes,
+        "longitudes_radians": np.radians(longitudes),
+        "latitudes_radians": np.radians(latitudes),
+        "cos_latitudes": np.cos(np.radians(latitudes)),
+        "bicycles_available": np.array(columns[6], dtype=np.int64),
+        "bicycle_docks_available": np.array(columns[7], dtype=np.int64),
+        "cells": cell_rows,
+        "grid_bounds": (grid_rows.min(), grid_rows.max(), grid_columns.min(), grid_columns.max()) if rows else None,
+        "cell_meters": GRID_CELL_DEGREES * METERS_PER_DEGREE * math.cos(math.radians(min(max_latitude, 90)))
+    }
+
+def get_distances(index, rows, longitude, latitude):
+    """
+    Compute the haversine distance from a point to stations of the index
+
+    Params :
+        - index : dict, as returned by load_station_index
+        - rows : numpy array, row numbers of the stations
+        - longitude, latitude : float, coordinates of the point in degrees
+
+    Returns : distances, numpy array, in meters
+    """
+
+    latitude_radians = math.radians(latitude)
+    delta_latitudes = index["latitudes_radians"][rows] - latitude_radians
+    delta_longitudes = index["longitudes_radians"][rows] - math.radians(longitude)
+
+    haversines = np.sin(delta_latitudes / 2) ** 2 + math.cos(latitude_radians) * index["cos_latitudes"][rows] * np.sin(delta_longitudes / 2) ** 2
+
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(haversines, 1)))
+
+def get_ring_cells(grid_row, grid_column, ring):
+    """
+    Get the grid cells at a distance of ring cells from a cell, around it
+
+    Params :
+        - grid_row, grid_column : int, cell at the center
+        - ring : int, 0 for the cell itself
+
+    Returns : cells, list of ints, as GRID_CELL
+    """
+
+    if ring == 0:
+        return [grid_row * GRID_CELL_ROW_SIZE + grid_column]
+
+    cells = []
+
+    for column in range(grid_column - ring, grid_column + ring + 1):
+        cells.append((grid_row - ring) * GRID_CELL_ROW_SIZE + column)
+        cells.append((grid_row + ring) * GRID_CELL_ROW_SIZE + column)
+
+    for row in range(grid_row - ring + 1, grid_row + ring):
+        cells.append(row * GRID_CELL_ROW_SIZE + grid_column - ring)
+        cells.append(row * GRID_CELL_ROW_SIZE + grid_column + ring)
+
+    return cells
+
+def search_stations(index, longitude, latitude, k=None, radius=None, min_bicycles=0, min_docks=0):
+    """
+    Search the stations closest to a point, reading the cells of the grid ring after ring around it
+    until no station of the next ring can be closer than the ones found
+
+    Params :
+        - index : dict, as returned by load_station_index
+        - longitude, latitude : float, coordinates of the point in degrees
+        - k : int, maximum number of stations, None for every station within the radius
+        - radius : float, maximum distance in meters, None for no maximum
+        - min_bicycles : int, minimum number of bikes available at the latest snapshot
+        - min_docks : int, minimum number of docks available at the latest snapshot
+
+    Returns : stations, list of dicts, closest first
+    """
+
+    if index["grid_bounds"] is None or k == 0:
+        return []
+
+    grid_row = math.floor(latitude / GRID_CELL_DEGREES)
+    grid_column = math.floor(longitude / GRID_CELL_DEGREES)
+    min_row, max_row, min_column, max_column = index["grid_bounds"]
+    last_ring = int(max(grid_row - min_row, max_row - grid_row, grid_column - min_column, max_column - grid_column))
+
+    found_rows = []
+    found_distances = []
+    nb_found = 0
+
+    for ring in range(last_ring + 1):
+        # Far from the stations, reading them all is cheaper than reading the empty cells around the point
+        if (2 * ring + 1) ** 2 > len(index["cells"]):
+            found_rows, found_distances, nb_found = [], [], 0
+            ring_rows = list(index["cells"].values())
+            ring = last_ring
+        else:
+            ring_rows = [index["cells"][cell] for cell in get_ring_cells(grid_row, grid_column, ring) if cell in index["cells"]]
+
+        if ring_rows:
+            rows = np.concatenate(ring_rows)
+            rows = rows[(index["bicycles_available"][rows] >= min_bicycles) & (index["bicycle_docks_available"][rows] >= min_docks)]
+            distances = get_distances(index, rows, longitude, latitude)
+
+            if radius is not None:
+                rows, distances = rows[distances <= radius], distances[distances <= radius]
+
+            found_rows.append(rows)
+            found_distances.append(distances)
+            nb_found += len(rows)
+
+        # The stations outside the rings read are at least this far
+        min_distance = ring * index["cell_meters"]
+
+        if radius is not None and min_distance > radius:
+            break
+
+        if k is not None and nb_found >= k and np.partition(np.concatenate(found_distances), k - 1)[k - 1] <= min_distance:
+            break
+
+        if ring == last_ring:
+            break
+
+    if not nb_found:
+        return []
+
+    rows = np.concatenate(found_rows)
+    distances = np.concatenate(found_distances)
+
+    # Closest first, the rows of the index are sorted by station
+    order = np.lexsort((rows, distances))[:k]
+
+    return [
+        {
+            "station_id": index["station_ids"][row],
+            "station_name": index["station_names"][row],
+            "city_name": index["city_names"][row],
+            "longitude": float(index["longitudes"][row]),
+            "latitude": float(index["latitudes"][row]),
+            "bicycle_available": int(index["bicycles_available"][row]),
+            "bicycle_docks_available": int(index["bicycle_docks_available"][row]),
+            "distance_meters": round(float(distance), 1)
+        }
+        for row, distance in zip(rows[order].tolist(), distances[order].tolist())
+    ]
+
+def find_nearest_stations(index, longitude, latitude, k=5, radius=None, min_bicycles=0, min_docks=0):
+    """
+    Find the k stations closest to a point, e.g. with free bikes (min_bicycles=1) or free docks (min_docks=1)
+
+    Params :
+        - index : dict, as returned by load_station_index
+        - longitude, latitude : float, coordinates of the point in degrees
+        - k : int, number of stations
+        - radius : float, maximum distance in meters, None for no maximum
+        - min_bicycles, min_docks : int, minimum number of bikes and of docks available
+
+    Returns : stations, list of dicts, closest first
+    """
+
+    return search_stations(index, longitude, latitude, k=k, radius=radius, min_bicycles=min_bicycles, min_docks=min_docks)
+
+def find_stations_within(index, longitude, latitude, radius, min_bicycles=0, min_docks=0):
+    """
+    Find every station within a distance of a point
+
+    Params :
+        - index : dict, as returned by load_station_index
+        - longitude, latitude : float, coordinates of the point in degrees
+        - radius : float, maximum distance in meters
+        - min_bicycles, min_docks : int, minimum number of bikes and of docks available
+
+    Returns : stations, list of dicts, closest first
+    """
+
+    return search_stations(index, longitude, latitude, radius=radius, min_bicycles=min_bicycles, min_docks=min_docks)
@@ -0,0 +1,141 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from metrics import get_peak_rss
+from raw_data import list_snapshot_times
+from sources import SOURCES
+
+RAW_DATA_DIRECTORY = os.path.join(PROJECT_DIRECTORY, "data", "raw_data")
+
+# Snapshot of Paris and Toulouse whose stations are copied, so that the memory of the consolidation stands out of the interpreter
+SNAPSHOT_DATE = "2024-12-04"
+CITY_SOURCES = ["paris", "toulouse"]
+FACTOR = 20
+
+ENGINES = ["pandas", "duckdb", "arrow"]
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "31555", "nom": "Toulouse", "population": 504078}
+]
+
+def copyStation(source_name, record, copy_index):
+    """
+    Copy a raw station record under a new identifier
+    """
+
+    record = dict(record)
+
+    if source_name == "paris":
+        record["stationcode"] = f"{record['stationcode']}{copy_index:04d}"
+    else:
+        record["number"] += copy_index * 10_000_000
+
+    return record
+
+def prepareSnapshot(tmp_dir, factor):
+    """
+    Raw data of the snapshot : the stations of Paris and Toulouse copied factor times, with a commune file
+    """
+
+    directory = os.path.join(tmp_dir, "data", "raw_data", SNAPSHOT_DATE)
+    os.makedirs(directory)
+    os.makedirs(os.path.join(tmp_dir, "data", "duckdb"))
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+    for source_name in CITY_SOURCES:
+        file_name = SOURCES[source_name]["file_name"]
+
+        with open(os.path.join(RAW_DATA_DIRECTORY, SNAPSHOT_DATE, file_name)) as fd:
+            records = json.load(fd)
+
+        scaled_records = records + [
+            copyStation(source_name, record, copy_index)
+            for copy_index in range(1, factor)
+            for record in records
+        ]
+
+        with open(os.path.join(directory, file_name), "w") as fd:
+            json.dump(scaled_records, fd)
+
+    with open(os.path.join(directory, SOURCES["commune"]["file_name"]), "w") as fd:
+        json.dump(COMMUNES, fd)
+
+def measureEngine(engine, tmp_dir):
+    """
+    Transform the snapshot with an engine, inside a process of its own as the peak RSS
+    of a process never goes down. Prints the increase of the peak RSS as JSON
+    """
+
+    os.chdir(tmp_dir)
+    database.configure_database(path=f"data/duckdb/{engine}.duckdb")
+    snapshot_time = list_snapshot_times(SNAPSHOT_DATE)[0]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        data_consolidation.consolidate_city_data(snapshot_time)
+
+        peak_rss_before = get_peak_rss()
+        start = time.perf_counter()
+        transformed = data_consolidation.transform_snapshot(
+            database.get_cursor(),
+            snapshot_time,
+            engine=engine,
+            source_names=CITY_SOURCES,
+            table_names=["CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+        )
+        elapsed = time.perf_counter() - start
+        peak_rss_after = get_peak_rss()
+
+    print(json.dumps({
+        "engine": engine,
+        "rows": sum(len(all_data) for all_data, _, _ in transformed.values()),
+        "elapsed": elapsed,
+        "peak_rss_increase": peak_rss_after - peak_rss_before
+    }))
+
+def testConsolidationMemory(engines, factor):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareSnapshot(tmp_dir, factor)
+
+        for engine in engines:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--measure", engine, "--directory", tmp_dir],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results[engine] = json.loads(output.splitlines()[-1])
+
+    print(f"Paris + Toulouse snapshot of {SNAPSHOT_DATE}, stations x{factor}")
+    for engine, result in results.items():
+        print(f"    {engine} : {result['peak_rss_increase'] / 1e6:.1f} MB of peak RSS, {result['elapsed']:.3f}s, {result['rows']} rows")
+
+    # The arrow engine doesn't build frames of object columns of every field of the raw data
+    if "pandas" in results and "arrow" in results:
+        assert results["arrow"]["peak_rss_increase"] < results["pandas"]["peak_rss_increase"]
+        assert results["arrow"]["rows"] == results["pandas"]["rows"]
+
+parser = argparse.ArgumentParser(description="Benchmark the peak memory of the consolidation engines on the Paris + Toulouse snapshot")
+parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES, help="engines to measure, all by default")
+parser.add_argument("--factor", type=int, default=FACTOR, help="number of copies of the stations")
+parser.add_argument("--measure", choices=ENGINES, help=argparse.SUPPRESS)
+parser.add_argument("--directory", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.measure:
+    measureEngine(args.measure, args.directory)
+else:
+    testConsolidationMemory(args.engines, args.factor)
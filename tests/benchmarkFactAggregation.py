@@ -0,0 +1,179 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import database
+from data_agregation import (
+    create_agregate_tables,
+    agregate_dim_city,
+    agregate_dim_station,
+    agregate_fact_station_statements
+)
+from data_consolidation import STATION_ATTRIBUTES, create_consolidate_tables
+
+# A year of synthetic history : every commune each day, stations and statements of several snapshots a day
+NB_DAYS = 365
+NB_SNAPSHOTS_PER_DAY = 4
+NB_STATIONS = 2000
+NB_COMMUNES = 35000
+NB_STATION_CITIES = 50
+
+# Aggregation before the city key and the latest snapshot pointer : a LOWER(name) join
+# against every commune and MAX(CREATED_DATE) subqueries over the growing tables
+# The facts are now appended into monthly partitions behind a view, the former facts are inserted into a table of their own,
+# and the stations are now versioned, the former daily copies of the stations are kept in a table of their own
+FORMER_SQL_STATEMENTS = [
+    """
+    INSERT OR REPLACE INTO DIM_CITY
+    SELECT ID, NAME, NB_INHABITANTS
+    FROM CONSOLIDATE_CITY
+    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+    """,
+    """
+    INSERT OR REPLACE INTO DIM_STATION (ID, CODE, NAME, ADDRESS, LONGITUDE, LATITUDE, STATUS, CAPACITTY)
+    SELECT ID, CODE, NAME, ADDRESS, LONGITUDE, LATITUDE, STATUS, CAPACITTY
+    FROM FORMER_CONSOLIDATE_STATION
+    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM FORMER_CONSOLIDATE_STATION);
+    """,
+    """
+    INSERT INTO FORMER_FACT_STATION_STATEMENT
+    SELECT STATION_ID, cc.ID as CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, FORMER_CONSOLIDATE_STATION.CREATED_DATE, CONSOLIDATE_STATION_STATEMENT.SNAPSHOT_TIME
+    FROM CONSOLIDATE_STATION_STATEMENT
+    JOIN FORMER_CONSOLIDATE_STATION ON FORMER_CONSOLIDATE_STATION.ID = CONSOLIDATE_STATION_STATEMENT.STATION_ID
+    JOIN CONSOLIDATE_CITY as cc ON LOWER(cc.NAME) = LOWER(FORMER_CONSOLIDATE_STATION.CITY_NAME)
+    WHERE CONSOLIDATE_STATION_STATEMENT.SNAPSHOT_TIME = (SELECT MAX(SNAPSHOT_TIME) FROM CONSOLIDATE_STATION_STATEMENT)
+        AND FORMER_CONSOLIDATE_STATION.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM FORMER_CONSOLIDATE_STATION)
+        AND cc.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+    """
+]
+
+def buildSyntheticHistory(con):
+    """
+    Fill the consolidate tables with a year of synthetic history
+    """
+
+    con.execute(f"""
+    INSERT INTO CONSOLIDATE_CITY
+    SELECT
+        printf('%05d', commune),
+        'Commune ' || commune,
+        1000 + commune,
+        strftime(DATE '2024-01-01' + CAST(day AS INTEGER), '%Y-%m-%d')
+    FROM range({NB_DAYS}) AS days(day), range({NB_COMMUNES}) AS communes(commune);
+    """)
+
+    # The APIs don't share the case of the city names, the city key is the INSEE code of the commune
+    con.execute("""
+    CREATE TABLE FORMER_CONSOLIDATE_STATION (
+        ID VARCHAR, CODE VARCHAR, NAME VARCHAR, CITY_NAME VARCHAR, CITY_CODE VARCHAR, ADDRESS VARCHAR, LONGITUDE FLOAT,
+        LATITUDE FLOAT, STATUS VARCHAR, CREATED_DATE DATE, CAPACITTY INTEGER, CITY_ID VARCHAR, PRIMARY KEY (ID, CREATED_DATE)
+    );
+    """)
+
+    con.execute(f"""
+    INSERT INTO FORMER_CONSOLIDATE_STATION
+    SELECT
+        '1-' || station,
+        CAST(station AS VARCHAR),
+        'Station ' || station,
+        CASE WHEN station % 2 = 0 THEN upper('Commune ' || station % {NB_STATION_CITIES}) ELSE 'Commune ' || station % {NB_STATION_CITIES} END,
+        NULL,
+        NULL,
+        2.3 + station / 10000,
+        48.8 + station / 10000,
+        'OPEN',
+        DATE '2024-01-01' + CAST(day AS INTEGER),
+        20,
+        printf('%05d', station % {NB_STATION_CITIES})
+    FROM range({NB_DAYS}) AS days(day), range({NB_STATIONS}) AS stations(station);
+    """)
+
+    # The stations don't change over the year : a single version each
+    con.execute(f"""
+    INSERT INTO CONSOLIDATE_STATION (ID, {", ".join(STATION_ATTRIBUTES)}, VALID_FROM)
+    SELECT ID, {", ".join(STATION_ATTRIBUTES)}, CREATED_DATE
+    FROM FORMER_CONSOLIDATE_STATION
+    WHERE CREATED_DATE = DATE '2024-01-01';
+    """)
+
+    con.execute(f"""
+    INSERT INTO CONSOLIDATE_STATION_LOAD
+    SELECT '1', DATE '2024-01-01' + CAST(day AS INTEGER)
+    FROM range({NB_DAYS}) AS days(day);
+    """)
+
+    con.execute(f"""
+    INSERT INTO CONSOLIDATE_SNAPSHOT (SNAPSHOT_TIME, CREATED_DATE, VERSION, KEYFRAME_TIME)
+    SELECT
+        TIMESTAMP '2024-01-01' + INTERVAL (day) DAY + INTERVAL (snapshot * 6) HOUR,
+        DATE '2024-01-01' + CAST(day AS INTEGER),
+        nextval('CONSOLIDATE_VERSION'),
+        TIMESTAMP '2024-01-01' + INTERVAL (day) DAY + INTERVAL (snapshot * 6) HOUR
+    FROM range({NB_DAYS}) AS days(day), range({NB_SNAPSHOTS_PER_DAY}) AS snapshots(snapshot);
+    """)
+
+    con.execute(f"""
+    INSERT INTO CONSOLIDATE_STATION_STATEMENT (STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, CREATED_DATE, SNAPSHOT_TIME)
+    SELECT
+        '1-' || station,
+        (station + hour(SNAPSHOT_TIME)) % 20,
+        (station * 7 + hour(SNAPSHOT_TIME)) % 20,
+        CREATED_DATE,
+        CAST(CREATED_DATE AS VARCHAR),
+        SNAPSHOT_TIME
+    FROM CONSOLIDATE_SNAPSHOT, range({NB_STATIONS}) AS stations(station)
+    ORDER BY SNAPSHOT_TIME;
+    """)
+
+    con.execute(f"""
+    INSERT OR REPLACE INTO CONSOLIDATE_LATEST_SNAPSHOT
+    SELECT 1, MAX(SNAPSHOT_TIME), MAX(CREATED_DATE), (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY)
+    FROM CONSOLIDATE_SNAPSHOT;
+    """)
+
+def clearAgregateTables(con):
+    for table in ["DIM_STATION", "DIM_CITY"]:
+        con.execute(f"DELETE FROM {table};")
+
+def measure(function):
+    start = time.perf_counter()
+    function()
+
+    return time.perf_counter() - start
+
+def testBenchmarkFactAggregation():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.configure_database(path=os.path.join(tmp_dir, "benchmark.duckdb"))
+        con = database.get_connection()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_consolidate_tables()
+            create_agregate_tables()
+
+        start = time.perf_counter()
+        buildSyntheticHistory(con)
+        print(f"Synthetic history of {NB_DAYS} days built in {time.perf_counter() - start:.1f}s")
+
+        con.execute("CREATE TABLE FORMER_FACT_STATION_STATEMENT AS SELECT * FROM FACT_STATION_STATEMENT_PARTITION LIMIT 0;")
+
+        former_elapsed = measure(lambda: [con.execute(sql_statement) for sql_statement in FORMER_SQL_STATEMENTS])
+        former_facts = con.execute("SELECT * FROM FORMER_FACT_STATION_STATEMENT ORDER BY ALL").fetchall()
+        clearAgregateTables(con)
+
+        keyed_elapsed = measure(lambda: [agregate_dim_city(), agregate_dim_station(), agregate_fact_station_statements()])
+        keyed_facts = con.execute("SELECT * FROM FACT_STATION_STATEMENT ORDER BY ALL").fetchall()
+
+        assert len(keyed_facts) == NB_STATIONS
+        assert former_facts == keyed_facts
+
+        print(f"LOWER(name) join and MAX subqueries : {former_elapsed:.3f}s")
+        print(f"City key and latest snapshot pointer : {keyed_elapsed:.3f}s, x{former_elapsed / keyed_elapsed:.1f}")
+
+        database.close_connection()
+
+testBenchmarkFactAggregation()
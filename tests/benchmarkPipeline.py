@@ -0,0 +1,341 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import string
+import sys
+import tempfile
+import time
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import database
+from city_codes import clear_city_codes
+from data_agregation import create_agregate_tables, agregate_incremental_data
+from data_consolidation import (
+    create_consolidate_tables,
+    clear_raw_data_cache,
+    consolidate_city_data,
+    consolidate_station_data,
+    consolidate_station_statement_data
+)
+from metrics import get_run_metrics, start_run
+from raw_data import list_snapshot_times
+from sources import SOURCES, get_station_sources
+
+# Results of a reference run, compared with every run : a stage slower than its baseline
+# by more than TOLERANCE, or producing another number of rows, is a regression
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarkBaseline.json")
+TOLERANCE = 0.5
+
+# Stages faster than this (in seconds) are too noisy to be compared
+MIN_COMPARED_ELAPSED = 0.05
+
+RAW_DATA_DIRECTORY = os.path.join(PROJECT_DIRECTORY, "data", "raw_data")
+
+# Day of data/raw_data where every city was ingested, replicated by the scale-up scenarios
+SCALE_UP_DATE = "2024-12-04"
+
+# A year of 5-minute snapshots, consolidated directly in SQL for a subset of the stations
+YEAR_NB_DAYS = 365
+YEAR_SNAPSHOT_MINUTES = 5
+YEAR_NB_STATIONS = 100
+
+CITY_SOURCES = get_station_sources()
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+# Field identifying the stations of each city, changed in the copies of the scale-ups
+STATION_ID_FIELDS = {
+    "paris": "stationcode",
+    "nantes": "number",
+    "toulouse": "number",
+    "strasbourg": "id",
+    "montpellier": "id"
+}
+
+def writeCommunes(directory):
+    with open(os.path.join(directory, SOURCES["commune"]["file_name"]), "w") as fd:
+        json.dump(COMMUNES, fd)
+
+def copyStation(source_name, record, copy_index, position):
+    """
+    Copy a raw station record under a new identifier
+    """
+
+    record = copy.deepcopy(record)
+    field = STATION_ID_FIELDS[source_name]
+
+    if source_name == "montpellier":
+        # Only the last 3 characters identify a station, letters never collide with the original digits
+        number = copy_index * 1000 + position
+        suffix = "".join(string.ascii_lowercase[number // 26 ** power % 26] for power in (2, 1, 0))
+        record[field] = record[field][:-3] + suffix
+    elif isinstance(record[field], int):
+        record[field] += copy_index * 10_000_000
+    else:
+        record[field] = f"{record[field]}{copy_index:04d}"
+
+    return record
+
+def prepareFixtures(tmp_dir):
+    """
+    Raw data of the fixtures : every day of data/raw_data, with a commune file on the first day
+    """
+
+    snapshot_dates = sorted(os.listdir(RAW_DATA_DIRECTORY))
+
+    for snapshot_date in snapshot_dates:
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(os.path.join(RAW_DATA_DIRECTORY, snapshot_date)):
+            os.symlink(os.path.join(RAW_DATA_DIRECTORY, snapshot_date, entry), os.path.join(directory, entry))
+
+    writeCommunes(os.path.join(tmp_dir, "data", "raw_data", snapshot_dates[0]))
+
+    return snapshot_dates
+
+def prepareScaleUp(tmp_dir, factor):
+    """
+    Raw data of a scale-up : the stations of SCALE_UP_DATE copied factor times, with a commune file
+    """
+
+    directory = os.path.join(tmp_dir, "data", "raw_data", SCALE_UP_DATE)
+    os.makedirs(directory)
+
+    for source_name in CITY_SOURCES:
+        file_name = SOURCES[source_name]["file_name"]
+
+        with open(os.path.join(RAW_DATA_DIRECTORY, SCALE_UP_DATE, file_name)) as fd:
+            records = json.load(fd)
+
+        scaled_records = records + [
+            copyStation(source_name, record, copy_index, position)
+            for copy_index in range(1, factor)
+            for position, record in enumerate(records)
+        ]
+
+        with open(os.path.join(directory, file_name), "w") as fd:
+            json.dump(scaled_records, fd)
+
+    writeCommunes(directory)
+
+    return [SCALE_UP_DATE]
+
+def consolidateAndAgregate(snapshot_dates):
+    create_consolidate_tables()
+    create_agregate_tables()
+
+    for snapshot_date in snapshot_dates:
+        for snapshot_time in list_snapshot_times(snapshot_date):
+            consolidate_city_data(snapshot_time)
+            consolidate_station_data(snapshot_time)
+            consolidate_station_statement_data(snapshot_time)
+            clear_raw_data_cache()
+
+    agregate_incremental_data()
+
+def buildSyntheticYear(con):
+    """
+    Consolidate a year of 5-minute snapshots directly in SQL, the raw files would take hours to replay
+    """
+
+    create_consolidate_tables()
+    create_agregate_tables()
+    nb_snapshots_per_day = 24 * 60 // YEAR_SNAPSHOT_MINUTES
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_CITY
+    SELECT code, nom, population, strftime(DATE '2024-01-01' + CAST(day AS INTEGER), '%Y-%m-%d')
+    FROM (SELECT unnest(?, recursive := true)), range(?) AS days(day);
+    """, [COMMUNES, YEAR_NB_DAYS])
+
+    # The stations don't change over the year : a single version each, loaded every day
+    con.execute("""
+    INSERT INTO CONSOLIDATE_STATION (ID, CODE, NAME, CITY_NAME, CITY_CODE, ADDRESS, LONGITUDE, LATITUDE, STATUS, VALID_FROM, CAPACITTY, CITY_ID)
+    SELECT
+        '1-' || station, CAST(station AS VARCHAR), 'Station ' || station, 'Paris', '75056', NULL,
+        2.3 + station / 10000, 48.8 + station / 10000, 'OPEN', DATE '2024-01-01', 20, '75056'
+    FROM range(?) AS stations(station);
+    """, [YEAR_NB_STATIONS])
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_STATION_LOAD
+    SELECT '1', DATE '2024-01-01' + CAST(day AS INTEGER)
+    FROM range(?) AS days(day);
+    """, [YEAR_NB_DAYS])
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_SNAPSHOT (SNAPSHOT_TIME, CREATED_DATE, VERSION, KEYFRAME_TIME)
+    SELECT
+        TIMESTAMP '2024-01-01' + INTERVAL (day) DAY + INTERVAL (snapshot * $minutes) MINUTE,
+        DATE '2024-01-01' + CAST(day AS INTEGER),
+        nextval('CONSOLIDATE_VERSION'),
+        TIMESTAMP '2024-01-01' + INTERVAL (day) DAY + INTERVAL (snapshot * $minutes) MINUTE
+    FROM range($nb_days) AS days(day), range($nb_snapshots) AS snapshots(snapshot)
+    ORDER BY ALL;
+    """, {"minutes": YEAR_SNAPSHOT_MINUTES, "nb_days": YEAR_NB_DAYS, "nb_snapshots": nb_snapshots_per_day})
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_STATION_STATEMENT (STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, CREATED_DATE, SNAPSHOT_TIME)
+    SELECT
+        '1-' || station, (station + minute(SNAPSHOT_TIME)) % 20, (station * 7 + hour(SNAPSHOT_TIME)) % 20,
+        CREATED_DATE, CAST(SNAPSHOT_TIME AS VARCHAR), SNAPSHOT_TIME
+    FROM CONSOLIDATE_SNAPSHOT, range(?) AS stations(station)
+    ORDER BY SNAPSHOT_TIME;
+    """, [YEAR_NB_STATIONS])
+
+    con.execute("""
+    INSERT OR REPLACE INTO CONSOLIDATE_LATEST_SNAPSHOT
+    SELECT 1, MAX(SNAPSHOT_TIME), MAX(CREATED_DATE), (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY)
+    FROM CONSOLIDATE_SNAPSHOT;
+    """)
+
+def prepareSyntheticYear(tmp_dir):
+    buildSyntheticYear(database.get_connection())
+
+def agregateSyntheticYear():
+    """
+    The whole year merged at once, then a new version of the last snapshot merged alone
+    """
+
+    agregate_incremental_data()
+
+    database.get_connection().execute("""
+    UPDATE CONSOLIDATE_SNAPSHOT SET VERSION = nextval('CONSOLIDATE_VERSION')
+    WHERE SNAPSHOT_TIME = (SELECT MAX(SNAPSHOT_TIME) FROM CONSOLIDATE_SNAPSHOT);
+    """)
+    agregate_incremental_data()
+
+def summarizeRun(run_metrics, elapsed):
+    """
+    Latency and throughput of each stage, and of each city for the stages run per source
+    """
+
+    results = {"total": {"elapsed": elapsed, "rows": None, "throughput": None}}
+
+    for stage_metrics in run_metrics:
+        for key in [stage_metrics["stage"], f"{stage_metrics['stage']}/{stage_metrics['target']}"]:
+            if key.endswith("/None"):
+                continue
+
+            result = results.setdefault(key, {"elapsed": 0.0, "rows": 0, "calls": 0})
+            result["elapsed"] += stage_metrics["elapsed"]
+            result["rows"] += stage_metrics["rows_out"] or 0
+            result["calls"] += 1
+
+    for key, result in results.items():
+        if key != "total":
+            result["latency"] = result["elapsed"] / result["calls"]
+            result["throughput"] = result["rows"] / result["elapsed"] if result["elapsed"] else None
+
+    return results
+
+def runScenario(prepare, run):
+    """
+    Prepare a scenario inside a throwaway directory and database, then measure its run
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.makedirs("data")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join("data", "sql_statements"))
+        database.configure_database(path="data/duckdb/benchmark.duckdb")
+        clear_city_codes()
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                snapshot_dates = prepare(tmp_dir)
+
+                start_run()
+                start = time.perf_counter()
+                run(snapshot_dates) if snapshot_dates else run()
+                elapsed = time.perf_counter() - start
+                run_metrics = get_run_metrics()
+        finally:
+            database.close_connection()
+            os.chdir(PROJECT_DIRECTORY)
+
+    return summarizeRun(run_metrics, elapsed)
+
+# Preparation (not measured) and run of each scenario
+SCENARIOS = {
+    "fixtures": (prepareFixtures, consolidateAndAgregate),
+    "stations_x10": (lambda tmp_dir: prepareScaleUp(tmp_dir, 10), consolidateAndAgregate),
+    "stations_x100": (lambda tmp_dir: prepareScaleUp(tmp_dir, 100), consolidateAndAgregate),
+    "year_5_minutes": (prepareSyntheticYear, agregateSyntheticYear)
+}
+
+def compareWithBaseline(results, baseline, tolerance=TOLERANCE):
+    """
+    List the stages slower than their baseline, or producing another number of rows
+    """
+
+    regressions = []
+
+    for scenario, scenario_results in results.items():
+        for key, result in scenario_results.items():
+            reference = baseline.get("results", {}).get(scenario, {}).get(key)
+
+            if reference is None:
+                continue
+
+            if result["rows"] != reference["rows"]:
+                regressions.append(f"{scenario} {key} : {result['rows']} rows instead of {reference['rows']}")
+
+            if reference["elapsed"] >= MIN_COMPARED_ELAPSED and result["elapsed"] > reference["elapsed"] * (1 + tolerance):
+                regressions.append(f"{scenario} {key} : {result['elapsed']:.3f}s instead of {reference['elapsed']:.3f}s (x{result['elapsed'] / reference['elapsed']:.2f})")
+
+    return regressions
+
+def testBenchmarkPipeline(scenarios, update_baseline=False, tolerance=TOLERANCE):
+    results = {}
+
+    for scenario in scenarios:
+        results[scenario] = runScenario(*SCENARIOS[scenario])
+        print(f"{scenario} : {results[scenario]['total']['elapsed']:.2f}s")
+
+        for key, result in results[scenario].items():
+            if key != "total":
+                throughput = f"{result['throughput']:,.0f} rows/s" if result["throughput"] else "-"
+                print(f"    {key} : {result['elapsed']:.3f}s, {result['latency'] * 1000:.1f} ms per call, {result['rows']} rows, {throughput}")
+
+    if update_baseline:
+        machine = f"{platform.machine()} {platform.processor()}".strip()
+        baseline = {"machine": f"{machine}, {os.cpu_count()} cpus, Python {platform.python_version()}", "results": results}
+
+        with open(BASELINE_PATH, "w") as fd:
+            json.dump(baseline, fd, indent=4)
+
+        print(f"Baseline saved into {BASELINE_PATH}")
+        return
+
+    with open(BASELINE_PATH) as fd:
+        baseline = json.load(fd)
+
+    regressions = compareWithBaseline(results, baseline, tolerance)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    assert not regressions, f"{len(regressions)} regressions against the baseline of {baseline['machine']}"
+    print(f"No regression against the baseline of {baseline['machine']}")
+
+parser = argparse.ArgumentParser(description="Benchmark the consolidation and the aggregation against a stored baseline")
+parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS), help="scenarios to run, all by default")
+parser.add_argument("--update-baseline", action="store_true", help="save the results as the new baseline")
+parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="slowdown accepted before a regression, 0.5 for 50%%")
+args = parser.parse_args()
+
+testBenchmarkPipeline(args.scenarios, args.update_baseline, args.tolerance)
@@ -0,0 +1,110 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import database
+from data_agregation import append_facts, create_agregate_tables, update_rollup
+
+# Four months of synthetic facts : a statement of every station every 10 minutes
+NB_DAYS = 120
+NB_STATIONS = 500
+NB_CITIES = 5
+SNAPSHOT_MINUTES = 10
+
+SNAPSHOTS_SQL = f"""
+SELECT TIMESTAMP '2024-09-01' + INTERVAL (minute) MINUTE AS SNAPSHOT_TIME
+FROM range(0, {NB_DAYS * 24 * 60}, {SNAPSHOT_MINUTES}) AS snapshots(minute)
+"""
+
+FACTS_SQL = f"""
+SELECT
+    '1-' || station AS STATION_ID,
+    printf('%05d', station % {NB_CITIES}) AS CITY_ID,
+    CAST((station + hour(SNAPSHOT_TIME)) % 20 AS INTEGER) AS BICYCLE_DOCKS_AVAILABLE,
+    CAST((station * 7 + minute(SNAPSHOT_TIME)) % 20 AS INTEGER) AS BICYCLE_AVAILABLE,
+    SNAPSHOT_TIME AS LAST_STATEMENT_DATE,
+    CAST(SNAPSHOT_TIME AS DATE) AS CREATED_DATE,
+    SNAPSHOT_TIME
+FROM ({SNAPSHOTS_SQL}) AS snapshots, range({NB_STATIONS}) AS stations(station)
+"""
+
+# Dashboard queries, over the facts and over the rollups
+DASHBOARD_QUERIES = {
+    "average bikes per station": (
+        """
+        SELECT STATION_ID, ROUND(AVG(BICYCLE_AVAILABLE), 6)
+        FROM FACT_STATION_STATEMENT
+        GROUP BY STATION_ID
+        ORDER BY STATION_ID;
+        """,
+        """
+        SELECT STATION_ID, ROUND(SUM(SUM_BICYCLE_AVAILABLE) / SUM(COUNT_BICYCLE_AVAILABLE), 6)
+        FROM ROLLUP_STATION_STATEMENT
+        WHERE GRAIN = 'month'
+        GROUP BY STATION_ID
+        ORDER BY STATION_ID;
+        """
+    ),
+    "average docks per city and per day": (
+        """
+        SELECT CITY_ID, date_trunc('day', SNAPSHOT_TIME) AS DAY, ROUND(AVG(DOCKS), 6), MIN(DOCKS), MAX(DOCKS)
+        FROM (
+            SELECT CITY_ID, SNAPSHOT_TIME, SUM(BICYCLE_DOCKS_AVAILABLE) AS DOCKS
+            FROM FACT_STATION_STATEMENT
+            GROUP BY CITY_ID, SNAPSHOT_TIME
+        ) AS totals
+        GROUP BY CITY_ID, DAY
+        ORDER BY CITY_ID, DAY;
+        """,
+        """
+        SELECT CITY_ID, PERIOD_START, ROUND(SUM_BICYCLE_DOCKS_AVAILABLE / COUNT_BICYCLE_DOCKS_AVAILABLE, 6), MIN_BICYCLE_DOCKS_AVAILABLE, MAX_BICYCLE_DOCKS_AVAILABLE
+        FROM ROLLUP_CITY_STATEMENT
+        WHERE GRAIN = 'day'
+        ORDER BY CITY_ID, PERIOD_START;
+        """
+    )
+}
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - start
+
+def testBenchmarkRollups():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.configure_database(path=os.path.join(tmp_dir, "benchmark.duckdb"))
+        con = database.get_connection()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_agregate_tables()
+
+        nb_facts, elapsed = measure(lambda: append_facts(con, SNAPSHOTS_SQL, FACTS_SQL, {}))
+        print(f"{nb_facts} synthetic facts over {NB_DAYS} days appended in {elapsed:.1f}s")
+
+        for table_name in ["ROLLUP_STATION_STATEMENT", "ROLLUP_CITY_STATEMENT"]:
+            (nb_hours, nb_rows), elapsed = measure(lambda: update_rollup(con, table_name, SNAPSHOTS_SQL, {}))
+            print(f"{table_name} : {nb_rows} rows for {nb_hours} hours built in {elapsed:.1f}s")
+
+        # A snapshot landing updates its hour, its day and its month
+        last_snapshot_sql = f"SELECT MAX(SNAPSHOT_TIME) AS SNAPSHOT_TIME FROM ({SNAPSHOTS_SQL})"
+        for table_name in ["ROLLUP_STATION_STATEMENT", "ROLLUP_CITY_STATEMENT"]:
+            _, elapsed = measure(lambda: update_rollup(con, table_name, last_snapshot_sql, {}))
+            print(f"{table_name} : one snapshot rolled up in {elapsed * 1000:.1f} ms")
+
+        for name, (facts_sql, rollup_sql) in DASHBOARD_QUERIES.items():
+            fact_rows, fact_elapsed = measure(lambda: con.execute(facts_sql).fetchall())
+            rollup_rows, rollup_elapsed = measure(lambda: con.execute(rollup_sql).fetchall())
+
+            print(f"{name} : {fact_elapsed * 1000:.1f} ms over the facts, {rollup_elapsed * 1000:.1f} ms over the rollups, x{fact_elapsed / rollup_elapsed:.0f}")
+            assert fact_rows == rollup_rows and len(fact_rows) > 0
+            assert rollup_elapsed < fact_elapsed
+
+        database.close_connection()
+
+testBenchmarkRollups()
@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import data_consolidation
+import database
+from data_agregation import agregate_incremental_data, create_agregate_tables
+from statement_deltas import STATEMENT_KEYFRAME_INTERVAL, get_statements_sql, reconstruct_station_statements
+
+# Synthetic stations of two sources polled every few minutes, a few of them change between two snapshots
+NB_STATIONS = 2000
+NB_DAYS = 2
+SNAPSHOT_MINUTES = 5
+CHANGE_RATE = 0.03
+FIRST_SNAPSHOT_TIME = datetime(2024, 12, 2)
+SOURCE_PREFIXES = ["1", "2"]
+
+# Fingerprint of the statements of each snapshot, rebuilt whatever their encoding
+STATEMENTS_FINGERPRINT_SQL = f"""
+SELECT SNAPSHOT_TIME, COUNT(*), SUM(hash(STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE))
+FROM ({get_statements_sql("SELECT SNAPSHOT_TIME FROM CONSOLIDATE_SNAPSHOT")})
+GROUP BY SNAPSHOT_TIME
+ORDER BY SNAPSHOT_TIME;
+"""
+
+FACTS_FINGERPRINT_SQL = """
+SELECT SNAPSHOT_TIME, COUNT(*), SUM(hash(STATION_ID, CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE))
+FROM FACT_STATION_STATEMENT
+GROUP BY SNAPSHOT_TIME
+ORDER BY SNAPSHOT_TIME;
+"""
+
+def buildSnapshots(nb_stations, nb_days, snapshot_minutes, change_rate):
+    """
+    Generate the typed statements of every snapshot : a station changes with a probability of change_rate,
+    a tenth of the stations are removed halfway, the second source is missing from a few snapshots,
+    and the first station never gives its docks
+    """
+
+    rng = np.random.default_rng(42)
+    nb_snapshots = nb_days * 24 * 60 // snapshot_minutes
+    station_ids = np.array([f"{SOURCE_PREFIXES[station % 2]}-{station}" for station in range(nb_stations)])
+    is_second_source = np.arange(nb_stations) % 2 == 1
+    is_removed = np.arange(nb_stations) % 10 == 9
+
+    bicycles = rng.integers(0, 21, nb_stations)
+    statement_days = np.full(nb_stations, (FIRST_SNAPSHOT_TIME.date() - date(1970, 1, 1)).days)
+    snapshots = []
+
+    for snapshot in range(nb_snapshots):
+        snapshot_time = FIRST_SNAPSHOT_TIME + timedelta(minutes=snapshot * snapshot_minutes)
+
+        is_changed = rng.random(nb_stations) < change_rate
+        bicycles[is_changed] = rng.integers(0, 21, is_changed.sum())
+        statement_days[is_changed] = (snapshot_time.date() - date(1970, 1, 1)).days
+
+        is_listed = np.ones(nb_stations, dtype=bool)
+        if snapshot >= nb_snapshots // 2:
+            is_listed &= ~is_removed
+        if nb_snapshots // 3 <= snapshot < nb_snapshots // 3 + 4:
+            is_listed &= ~is_second_source
+
+        snapshots.append((snapshot_time, buildStatements(snapshot_time, station_ids[is_listed], bicycles[is_listed], statement_days[is_listed])))
+
+    return station_ids, snapshots
+
+def buildStatements(snapshot_time, station_ids, bicycles, statement_days):
+    docks = 20 - bicycles
+
+    return pa.table({
+        "STATION_ID": pa.array(station_ids, pa.string()),
+        "BICYCLE_DOCKS_AVAILABLE": pa.array(docks, pa.int32(), mask=station_ids == station_ids[0]),
+        "BICYCLE_AVAILABLE": pa.array(bicycles, pa.int32()),
+        "LAST_STATEMENT_DATE": pa.array(statement_days.astype(np.int32), pa.int32()).cast(pa.date32()),
+        "CREATED_DATE": pa.array([str(snapshot_time.date())] * len(station_ids), pa.string()),
+        "SNAPSHOT_TIME": pa.array([snapshot_time] * len(station_ids), pa.timestamp("us"))
+    })
+
+def runEncoding(tmp_dir, encoding, station_ids, snapshots, snapshot_minutes):
+    """
+    Write the snapshots with an encoding, then a backfill of the first source into an existing
+    snapshot and a snapshot missed between two others, and aggregate them
+    """
+
+    path = os.path.join(tmp_dir, f"{encoding}.duckdb")
+    database.configure_database(path=path)
+    data_consolidation.STATEMENT_ENCODING = encoding
+    con = database.get_connection()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        create_agregate_tables()
+
+    con.execute("""
+    INSERT INTO CONSOLIDATE_STATION (ID, CODE, NAME, CITY_NAME, CITY_CODE, STATUS, VALID_FROM, CAPACITTY, CITY_ID)
+    SELECT ID, ID, 'Station ' || ID, 'Paris', '75056', 'OPEN', ?, 20, '75056'
+    FROM (SELECT unnest(?) AS ID);
+    """, [FIRST_SNAPSHOT_TIME.date(), station_ids.tolist()])
+    con.execute("INSERT INTO CONSOLIDATE_CITY VALUES ('75056', 'Paris', 2133111, ?);", [str(FIRST_SNAPSHOT_TIME.date())])
+
+    start = time.perf_counter()
+    for snapshot_time, statements in snapshots:
+        data_consolidation.write_station_statement_data(con, snapshot_time, statements)
+    elapsed = time.perf_counter() - start
+
+    nb_rows = con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT;").fetchone()[0]
+    con.execute("CHECKPOINT;")
+    size = os.path.getsize(path)
+
+    # The first source of an older snapshot consolidated again with other values, and a missed snapshot
+    backfill_time, backfill_statements = snapshots[len(snapshots) // 4]
+    backfill_statements = backfill_statements.filter(np.char.startswith(backfill_statements["STATION_ID"].to_numpy(zero_copy_only=False).astype(str), "1-"))
+    backfill_statements = backfill_statements.set_column(2, "BICYCLE_AVAILABLE", pa.array(np.full(len(backfill_statements), 7), pa.int32()))
+    data_consolidation.write_station_statement_data(con, backfill_time, backfill_statements)
+
+    missed_time = snapshots[len(snapshots) // 4 + 10][0] + timedelta(minutes=snapshot_minutes / 2)
+    missed_statements = snapshots[len(snapshots) // 4 + 10][1]
+    missed_statements = missed_statements.set_column(5, "SNAPSHOT_TIME", pa.array([missed_time] * len(missed_statements), pa.timestamp("us")))
+    data_consolidation.write_station_statement_data(con, missed_time, missed_statements)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        agregate_incremental_data()
+
+    result = {
+        "elapsed": elapsed,
+        "rows": nb_rows,
+        "size": size,
+        "keyframes": con.execute("SELECT COUNT(*) FROM CONSOLIDATE_SNAPSHOT WHERE KEYFRAME_TIME = SNAPSHOT_TIME;").fetchone()[0],
+        "statements": con.execute(STATEMENTS_FINGERPRINT_SQL).fetchall(),
+        "facts": con.execute(FACTS_FINGERPRINT_SQL).fetchall(),
+        "at_time": reconstruct_station_statements(con, snapshots[-1][0] - timedelta(minutes=snapshot_minutes * 3 / 2))
+    }
+
+    database.close_connection()
+    data_consolidation.STATEMENT_ENCODING = "full"
+
+    return result
+
+def testStatementDeltas(nb_stations, nb_days, snapshot_minutes, change_rate):
+    station_ids, snapshots = buildSnapshots(nb_stations, nb_days, snapshot_minutes, change_rate)
+    print(f"{len(snapshots)} snapshots of {nb_stations} stations, one every {snapshot_minutes} minutes, {change_rate:.0%} of the stations change each time")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full = runEncoding(tmp_dir, "full", station_ids, snapshots, snapshot_minutes)
+        delta = runEncoding(tmp_dir, "delta", station_ids, snapshots, snapshot_minutes)
+
+    for encoding, result in [("full", full), ("delta", delta)]:
+        print(f"    {encoding} : {result['rows']:,} rows, {result['size'] / 1e6:.1f} MB, written in {result['elapsed']:.2f}s, {result['keyframes']} keyframes")
+
+    print(f"Delta encoding with a keyframe every {STATEMENT_KEYFRAME_INTERVAL} : x{full['rows'] / delta['rows']:.1f} fewer rows, x{full['size'] / delta['size']:.1f} smaller")
+
+    # The statements and the facts of every snapshot are the same, the backfills included
+    assert delta["statements"] == full["statements"] and len(full["statements"]) == len(snapshots) + 1
+    assert delta["facts"] == full["facts"] and len(full["facts"]) == len(snapshots) + 1
+    assert delta["at_time"].equals(full["at_time"]) and len(full["at_time"]) > 0
+
+    assert delta["rows"] * 10 <= full["rows"]
+    assert delta["size"] < full["size"]
+
+parser = argparse.ArgumentParser(description="Compare the storage of the statements of high-frequency snapshots in full and as deltas")
+parser.add_argument("--stations", type=int, default=NB_STATIONS, help="number of synthetic stations")
+parser.add_argument("--days", type=int, default=NB_DAYS, help="number of days of snapshots")
+parser.add_argument("--minutes", type=int, default=SNAPSHOT_MINUTES, help="minutes between two snapshots")
+parser.add_argument("--change-rate", type=float, default=CHANGE_RATE, help="share of the stations changing between two snapshots")
+args = parser.parse_args()
+
+testStatementDeltas(args.stations, args.days, args.minutes, args.change_rate)
@@ -0,0 +1,169 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import database
+from data_agregation import GRID_CELL_SQL, append_facts, create_agregate_tables
+from station_search import find_nearest_stations, find_stations_within, get_distances, load_station_index
+
+# Synthetic stations scattered around the centers of the five cities, Nantes west of the meridian
+CITIES = {
+    "75056": ("Paris", 2.3522, 48.8566),
+    "44109": ("Nantes", -1.5536, 47.2184),
+    "31555": ("Toulouse", 1.4442, 43.6047),
+    "67482": ("Strasbourg", 7.7521, 48.5734),
+    "34172": ("Montpellier", 3.8767, 43.6108)
+}
+CITY_SPREAD_DEGREES = 0.1
+NB_STATIONS = 20_000
+NB_LOOKUPS = 20_000
+NB_SQL_LOOKUPS = 200
+K = 5
+RADIUS_METERS = 500
+SNAPSHOT_TIME = datetime(2024, 12, 4, 10, 0, 0)
+
+SYNTHETIC_STATIONS_SQL = """
+SELECT setseed(0.42);
+CREATE TEMP TABLE SYNTHETIC_STATION AS
+SELECT
+    'S-' || station AS ID,
+    cities.CITY_ID,
+    cities.LONGITUDE + (random() - 0.5) * 2 * {spread} AS LONGITUDE,
+    cities.LATITUDE + (random() - 0.5) * 2 * {spread} AS LATITUDE,
+    CAST(floor(random() * 20) AS INTEGER) AS BICYCLE_AVAILABLE,
+    CAST(floor(random() * 20) AS INTEGER) AS BICYCLE_DOCKS_AVAILABLE
+FROM range({nb_stations}) AS stations(station)
+JOIN (VALUES {cities}) AS cities(NUMBER, CITY_ID, LONGITUDE, LATITUDE) ON cities.NUMBER = station % {nb_cities};
+INSERT INTO DIM_CITY SELECT CITY_ID, NAME, 0 FROM (VALUES {city_names}) AS cities(CITY_ID, NAME);
+INSERT INTO DIM_STATION
+SELECT ID, ID, 'Station ' || ID, NULL, LONGITUDE, LATITUDE, 'OPEN', 40, {grid_cell} AS GRID_CELL
+FROM SYNTHETIC_STATION;
+"""
+
+FACTS_SQL = """
+SELECT ID AS STATION_ID, CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE,
+    $snapshot_time AS LAST_STATEMENT_DATE, CAST($snapshot_time AS DATE) AS CREATED_DATE, $snapshot_time AS SNAPSHOT_TIME
+FROM SYNTHETIC_STATION
+"""
+
+# Search without index : the distance to every station, over the latest facts
+NEAREST_SQL = """
+SELECT ds.ID, 2 * 6371008.8 * asin(sqrt(
+    pow(sin(radians(ds.LATITUDE - $latitude) / 2), 2)
+    + cos(radians($latitude)) * cos(radians(ds.LATITUDE)) * pow(sin(radians(ds.LONGITUDE - $longitude) / 2), 2)
+)) AS DISTANCE
+FROM DIM_STATION ds
+JOIN FACT_STATION_STATEMENT facts ON facts.STATION_ID = ds.ID
+WHERE facts.SNAPSHOT_TIME = (SELECT MAX(SNAPSHOT_TIME) FROM FACT_STATION_STATEMENT)
+    AND facts.BICYCLE_AVAILABLE >= $min_bicycles
+ORDER BY DISTANCE, ds.ID
+LIMIT $k;
+"""
+
+def buildStations(con, nb_stations):
+    cities = list(CITIES.items())
+    con.execute(SYNTHETIC_STATIONS_SQL.format(
+        spread=CITY_SPREAD_DEGREES,
+        nb_stations=nb_stations,
+        nb_cities=len(cities),
+        cities=", ".join(f"({number}, '{city_id}', {longitude}, {latitude})" for number, (city_id, (_, longitude, latitude)) in enumerate(cities)),
+        city_names=", ".join(f"('{city_id}', '{name}')" for city_id, (name, _, _) in cities),
+        grid_cell=GRID_CELL_SQL
+    ))
+    append_facts(con, "SELECT $snapshot_time AS SNAPSHOT_TIME", FACTS_SQL, {"snapshot_time": SNAPSHOT_TIME})
+
+def getLookupPoints(nb_lookups):
+    """
+    Points around the cities, and a few far from every station
+    """
+
+    generator = random.Random(42)
+    points = []
+
+    for lookup in range(nb_lookups):
+        if lookup % 100 == 0:
+            points.append((generator.uniform(-5, 10), generator.uniform(41, 52)))
+        else:
+            _, longitude, latitude = generator.choice(list(CITIES.values()))
+            points.append((longitude + generator.uniform(-0.12, 0.12), latitude + generator.uniform(-0.12, 0.12)))
+
+    return points
+
+def searchAll(index, longitude, latitude, k=None, radius=None, min_bicycles=0):
+    """
+    Reference search, over the distance to every station
+    """
+
+    rows = np.arange(len(index["station_ids"]))
+    rows = rows[index["bicycles_available"] >= min_bicycles]
+    distances = get_distances(index, rows, longitude, latitude)
+
+    if radius is not None:
+        rows, distances = rows[distances <= radius], distances[distances <= radius]
+
+    return [index["station_ids"][row] for row in rows[np.lexsort((rows, distances))][:k].tolist()]
+
+def measure(function, points):
+    start = time.perf_counter()
+    results = [function(longitude, latitude) for longitude, latitude in points]
+
+    return results, len(points) / (time.perf_counter() - start)
+
+def testStationSearch(nb_stations, nb_lookups):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.configure_database(path=os.path.join(tmp_dir, "benchmark.duckdb"))
+        con = database.get_connection()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_agregate_tables()
+        buildStations(con, nb_stations)
+
+        start = time.perf_counter()
+        index = load_station_index(con)
+        print(f"Index of {len(index['station_ids'])} stations in {len(index['cells'])} cells loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        points = getLookupPoints(nb_lookups)
+        sql_points = points[:NB_SQL_LOOKUPS]
+
+        sql_results, sql_rate = measure(
+            lambda longitude, latitude: [row[0] for row in con.execute(NEAREST_SQL, {"longitude": longitude, "latitude": latitude, "k": K, "min_bicycles": 1}).fetchall()],
+            sql_points
+        )
+        nearest_results, nearest_rate = measure(
+            lambda longitude, latitude: [station["station_id"] for station in find_nearest_stations(index, longitude, latitude, k=K, min_bicycles=1)],
+            points
+        )
+        within_results, within_rate = measure(
+            lambda longitude, latitude: [station["station_id"] for station in find_stations_within(index, longitude, latitude, RADIUS_METERS)],
+            points
+        )
+
+        database.close_connection()
+
+    print(f"{K} nearest stations with bikes : {sql_rate:.0f} lookups/s over SQL, {nearest_rate:.0f} lookups/s over the index, x{nearest_rate / sql_rate:.0f}")
+    print(f"Stations within {RADIUS_METERS} m : {within_rate:.0f} lookups/s over the index, {sum(map(len, within_results)) / len(points):.1f} stations on average")
+
+    # The grid returns the same stations as a search over every station
+    assert nearest_results[:NB_SQL_LOOKUPS] == sql_results
+    for (longitude, latitude), nearest, within in zip(points, nearest_results, within_results):
+        assert nearest == searchAll(index, longitude, latitude, k=K, min_bicycles=1)
+        assert within == searchAll(index, longitude, latitude, radius=RADIUS_METERS)
+
+    assert nearest_rate > 1000 and within_rate > 1000
+
+parser = argparse.ArgumentParser(description="Benchmark the nearest station lookups over the grid index against a full scan")
+parser.add_argument("--stations", type=int, default=NB_STATIONS, help="number of synthetic stations")
+parser.add_argument("--lookups", type=int, default=NB_LOOKUPS, help="number of lookups over the index")
+args = parser.parse_args()
+
+testStationSearch(args.stations, args.lookups)
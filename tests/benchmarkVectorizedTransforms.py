@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from data_consolidation import (
+    build_station_id,
+    convert_epoch_to_datetime,
+    normalize_status,
+    split_list_column
+)
+
+NB_STATIONS = 1_000_000
+
+def buildSyntheticStations(nb_stations):
+    """
+    Build a synthetic frame of stations with the raw columns transformed by the consolidation
+    """
+
+    return pd.DataFrame({
+        "stationcode": [str(10000 + i % 90000) for i in range(nb_stations)],
+        "is_installed": ["OUI" if i % 17 else "NON" for i in range(nb_stations)],
+        "coordinates": [[2.3 + (i % 1000) / 10000, 48.8 + (i % 997) / 10000] for i in range(nb_stations)],
+        "last_reported": [str(1733348127 + i % 3600) for i in range(nb_stations)]
+    })
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - start
+
+def testBenchmarkVectorizedTransforms():
+    df = buildSyntheticStations(NB_STATIONS)
+
+    # Row by row lambdas formerly used by the consolidation, against the column transforms
+    transforms = {
+        "station id": (
+            lambda: df["stationcode"].apply(lambda x: f"1-{x}"),
+            lambda: build_station_id(df["stationcode"], 1)
+        ),
+        "status": (
+            lambda: df["is_installed"].apply(lambda x: "OPEN" if x == "OUI" else "CLOSED"),
+            lambda: normalize_status(df["is_installed"], "OUI")
+        ),
+        "list columns": (
+            lambda: pd.DataFrame({
+                "longitude": df["coordinates"].apply(lambda x: x[0]),
+                "latitude": df["coordinates"].apply(lambda x: x[1])
+            }),
+            lambda: split_list_column(df["coordinates"], ["longitude", "latitude"])
+        ),
+        "epoch to datetime": (
+            lambda: df["last_reported"].apply(lambda x: datetime.fromtimestamp(int(x))),
+            lambda: convert_epoch_to_datetime(df["last_reported"])
+        )
+    }
+
+    print(f"Synthetic frame of {NB_STATIONS} stations")
+
+    for name, (row_transform, column_transform) in transforms.items():
+        row_result, row_elapsed = measure(row_transform)
+        column_result, column_elapsed = measure(column_transform)
+
+        assert row_result.equals(column_result) if isinstance(row_result, pd.DataFrame) else row_result.tolist() == column_result.tolist()
+
+        print(f"{name} : lambda {row_elapsed:.3f}s, vectorized {column_elapsed:.3f}s, x{row_elapsed / column_elapsed:.1f}")
+
+testBenchmarkVectorizedTransforms()
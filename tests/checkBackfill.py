@@ -0,0 +1,93 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from data_backfill import backfill_data
+from raw_data import list_snapshot_times
+
+# Every day of data/raw_data, some of them miss cities and none has a commune file
+RAW_DATA_DIRECTORY = os.path.join(PROJECT_DIRECTORY, "data", "raw_data")
+BACKFILL_DATES = sorted(os.listdir(RAW_DATA_DIRECTORY))
+
+# A commune file is added to the last day only
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+CONSOLIDATE_TABLES = ["CONSOLIDATE_CITY", "CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT", "CONSOLIDATE_SNAPSHOT"]
+
+def prepareRawData(tmp_dir):
+    for snapshot_date in BACKFILL_DATES:
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(os.path.join(RAW_DATA_DIRECTORY, snapshot_date)):
+            os.symlink(os.path.join(RAW_DATA_DIRECTORY, snapshot_date, entry), os.path.join(directory, entry))
+
+    with open(os.path.join(tmp_dir, "data", "raw_data", BACKFILL_DATES[-1], "commune_data.json"), "w") as fd:
+        json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def readConsolidateTables():
+    con = database.get_cursor()
+
+    # The versions depend on the order of the writes, only the snapshots are compared
+    return {
+        table: con.execute(f"SELECT * {'EXCLUDE (VERSION)' if table == 'CONSOLIDATE_SNAPSHOT' else ''} FROM {table} ORDER BY ALL").fetchall()
+        for table in CONSOLIDATE_TABLES
+    }
+
+def openDatabase(name):
+    database.configure_database(path=f"data/duckdb/{name}.duckdb")
+    clear_city_codes()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+def testBackfill():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Reference : the former manual loop over the days, newest first so that the cities are known
+            openDatabase("loop")
+            data_consolidation.create_consolidate_tables()
+            for snapshot_date in reversed(BACKFILL_DATES):
+                for snapshot_time in list_snapshot_times(snapshot_date):
+                    data_consolidation.consolidate_city_data(snapshot_time)
+                    data_consolidation.consolidate_station_data(snapshot_time)
+                    data_consolidation.consolidate_station_statement_data(snapshot_time)
+                    data_consolidation.clear_raw_data_cache()
+            loop_tables = readConsolidateTables()
+
+            openDatabase("backfill")
+            backfilled_days = backfill_data(BACKFILL_DATES[0], BACKFILL_DATES[-1], max_workers=4)
+            backfill_tables = readConsolidateTables()
+
+        database.close_connection()
+        os.chdir(PROJECT_DIRECTORY)
+
+    assert list(backfilled_days) == BACKFILL_DATES
+
+    for table in CONSOLIDATE_TABLES:
+        print(f"{table} : {len(loop_tables[table])} rows with the loop, {len(backfill_tables[table])} rows with the backfill")
+        assert loop_tables[table] == backfill_tables[table]
+
+# The backfill workers are spawned and import this script again
+if __name__ == "__main__":
+    testBackfill()
@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import database
+from city_codes import clear_city_codes, get_city_code, load_city_lookup, normalize_city_name, resolve_city_codes
+
+# Two snapshots of the communes, the homonyms of the latest one differ by their population
+CITIES = [
+    ("75056", "Paris", 2133111, "2024-12-03"),
+    ("75056", "Paris", 2133111, "2024-12-04"),
+    ("44109", "Nantes", 320732, "2024-12-04"),
+    ("34172", "Montpellier", 302454, "2024-12-04"),
+    ("93066", "Saint-Denis", 113942, "2024-12-04"),
+    ("97411", "Saint-Denis", 153810, "2024-12-04"),
+    ("11340", "Saint-Denis", 484, "2024-12-04"),
+    ("31555", "Toulouse", None, "2024-12-04"),
+    ("82182", "Toulouse", None, "2024-12-03"),
+    ("95018", "L'Isle-Adam", 12426, "2024-12-04")
+]
+
+def testNormalizeCityName():
+    assert normalize_city_name("Montpellier") == normalize_city_name("MONTPELLIER") == "montpellier"
+    assert normalize_city_name("Sète") == normalize_city_name("SETE") == "sete"
+    assert normalize_city_name("Saint-Étienne") == normalize_city_name("saint etienne") == "saint etienne"
+    assert normalize_city_name("L'Isle-Adam") == normalize_city_name("l’isle  adam ") == "l isle adam"
+    assert normalize_city_name(None) is None
+    assert normalize_city_name(float("nan")) is None
+
+def testCityLookup():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.configure_database(path=os.path.join(tmp_dir, "cities.duckdb"))
+        clear_city_codes()
+
+        con = database.get_connection()
+        con.execute("CREATE TABLE CONSOLIDATE_CITY (ID VARCHAR, NAME VARCHAR, NB_INHABITANTS INTEGER, CREATED_DATE VARCHAR);")
+        con.executemany("INSERT INTO CONSOLIDATE_CITY VALUES (?, ?, ?, ?);", CITIES)
+
+        city_lookup = load_city_lookup()
+
+        # Only the latest snapshot is read, the most populated homonym is kept
+        assert city_lookup["codes"] == {city[0] for city in CITIES if city[3] == "2024-12-04"}
+        assert city_lookup["names"]["saint denis"] == "97411"
+        assert get_city_code("SAINT DENIS") == "97411"
+        assert get_city_code("l'isle adam") == "95018"
+        assert get_city_code("Lyon") is None
+
+        # A known code given by the API is kept even for a homonym, an unknown one is replaced by the code of the name
+        city_names = pd.Series(["Saint-Denis", "Saint-Denis", "nantes", "Montpellier", "Lyon", None])
+        city_codes = pd.Series(["93066", "93000", "44109", None, "69123", "75056"])
+
+        assert resolve_city_codes(city_names, city_codes).tolist() == ["93066", "97411", "44109", "34172", None, "75056"]
+        assert resolve_city_codes(city_names).tolist() == ["97411", "97411", "44109", "34172", None, None]
+
+        database.close_connection()
+        clear_city_codes()
+
+testNormalizeCityName()
+testCityLookup()
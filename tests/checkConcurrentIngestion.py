@@ -0,0 +1,167 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import data_ingestion
+
+# Delay (in seconds) of each stub source
+STUB_DELAYS = {"/slow": 0.6, "/medium": 0.4, "/fast": 0.2, "/flaky": 0.1}
+
+class StubHandler(BaseHTTPRequestHandler):
+    flaky_calls = 0
+    not_modified_calls = 0
+
+    def do_GET(self):
+        # The truncated source announces more bytes than it sends, as a dropped connection would
+        if self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b'[{"path": "/trunc')
+            return
+
+        # The versioned source answers 304 when the client already has its current version
+        if self.path == "/versioned" and self.headers.get("If-None-Match") == '"v1"':
+            StubHandler.not_modified_calls += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        time.sleep(STUB_DELAYS.get(self.path, 0))
+
+        # The flaky source fails on its first call to exercise the retry
+        if self.path == "/flaky":
+            StubHandler.flaky_calls += 1
+            if StubHandler.flaky_calls == 1:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        body = f'[{{"path": "{self.path}"}}]'.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startStubServer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def testConcurrentIngestion():
+    server, base_url = startStubServer()
+
+    sources = {
+        path.strip("/"): {
+            "url": f"{base_url}{path}",
+            "headers": {},
+            "timeout": 5,
+            "file_name": f"{path.strip('/')}_data.json"
+        }
+        for path in STUB_DELAYS
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+
+        start = time.perf_counter()
+        elapsed_times = data_ingestion.ingest_all_data(sources=sources)
+        wall_time = time.perf_counter() - start
+
+        # Every source is written in its own directory of the same snapshot
+        written_sources = [os.path.basename(root) for root, _, files in os.walk("data/raw_data") if files]
+
+    server.shutdown()
+
+    serial_time = sum(STUB_DELAYS.values())
+
+    print(elapsed_times)
+    print(f"Wall time : {wall_time:.2f}s, serial time would be at least {serial_time:.2f}s")
+
+    assert sorted(written_sources) == sorted(sources)
+    assert StubHandler.flaky_calls == 2
+    assert wall_time < serial_time
+
+def testInterruptedDownload():
+    server, base_url = startStubServer()
+
+    source = {
+        "url": f"{base_url}/truncated",
+        "headers": {},
+        "timeout": 5,
+        "file_name": "truncated_data.json"
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+
+        try:
+            data_ingestion.download_source(source, "data/raw_data/truncated_data.json", max_retries=1, backoff_factor=0)
+            raised = False
+        except Exception as exception:
+            print(f"Interrupted download raised : {exception!r}")
+            raised = True
+
+        left_files = [name for _, _, files in os.walk("data/raw_data") for name in files]
+
+    server.shutdown()
+
+    print(f"Files left after the interrupted download : {left_files}")
+
+    assert raised
+    assert left_files == []
+
+def testConditionalFetch():
+    server, base_url = startStubServer()
+
+    sources = {
+        "versioned": {
+            "url": f"{base_url}/versioned",
+            "headers": {},
+            "timeout": 5,
+            "file_name": "versioned_data.json"
+        }
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+
+        data_ingestion.ingest_all_data(sources=sources)
+        first_state = data_ingestion.get_source_state("sources", "versioned")
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            data_ingestion.ingest_all_data(sources=sources)
+        second_state = data_ingestion.get_source_state("sources", "versioned")
+
+        with open(second_state["file_path"]) as fd:
+            content = fd.read()
+
+    server.shutdown()
+
+    print(f"State after the first download : {first_state}")
+    print(f"State after the second download : {second_state}")
+
+    # The flag of an unchanged download isn't saved with the state
+    assert first_state["etag"] == '"v1"' and "unchanged" not in first_state
+    assert "unchanged" not in second_state and StubHandler.not_modified_calls == 1
+    assert "Source versioned unchanged since its last download." in output.getvalue()
+    assert second_state["content_hash"] == first_state["content_hash"]
+    assert content == '[{"path": "/versioned"}]'
+
+testConcurrentIngestion()
+testInterruptedDownload()
+testConditionalFetch()
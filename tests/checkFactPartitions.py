@@ -0,0 +1,170 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_agregation
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+
+# Days of data/raw_data where every city was ingested, over November and December 2024
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03", "2024-12-04"]
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+# Average number of bikes of each station in December, as tests/getAvgDockAvailablePerStation.py over a period
+DECEMBER_START = datetime(2024, 12, 1)
+DECEMBER_END = datetime(2024, 12, 31, 23, 59, 59)
+AVG_BICYCLE_AVAILABLE_SQL = """
+SELECT STATION_ID, AVG(BICYCLE_AVAILABLE)
+FROM ({facts}) AS facts
+WHERE SNAPSHOT_TIME BETWEEN ? AND ?
+GROUP BY STATION_ID
+ORDER BY STATION_ID;
+"""
+
+# FACT_STATION_STATEMENT as it was created before the monthly partitions
+FORMER_FACT_TABLE_SQL = """
+CREATE TABLE FACT_STATION_STATEMENT (
+    STATION_ID VARCHAR NOT NULL,
+    CITY_ID VARCHAR NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE INTEGER,
+    BICYCLE_AVAILABLE INTEGER,
+    LAST_STATEMENT_DATE DATETIME,
+    CREATED_DATE DATE DEFAULT current_date,
+    SNAPSHOT_TIME TIMESTAMP NOT NULL,
+    PRIMARY KEY (STATION_ID, CITY_ID, SNAPSHOT_TIME)
+);
+"""
+
+# FACT_STATION_STATEMENT as it was created before the snapshots, a fact per station and per day
+BASELINE_FACT_TABLE_SQL = """
+CREATE TABLE FACT_STATION_STATEMENT (
+    STATION_ID VARCHAR NOT NULL,
+    CITY_ID VARCHAR NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE INTEGER,
+    BICYCLE_AVAILABLE INTEGER,
+    LAST_STATEMENT_DATE DATETIME,
+    CREATED_DATE DATE DEFAULT current_date,
+    PRIMARY KEY (STATION_ID, CITY_ID, CREATED_DATE),
+    FOREIGN KEY (STATION_ID) REFERENCES DIM_STATION (ID),
+    FOREIGN KEY (CITY_ID) REFERENCES DIM_CITY (ID)
+);
+"""
+
+def prepareRawData(tmp_dir):
+    for snapshot_date in FIXTURE_DATES:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            os.symlink(os.path.join(source_directory, entry), os.path.join(directory, entry))
+
+        with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+            json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def consolidateAndAgregate():
+    for snapshot_date in FIXTURE_DATES:
+        for snapshot_time in list_snapshot_times(snapshot_date):
+            data_consolidation.consolidate_city_data(snapshot_time)
+            data_consolidation.consolidate_station_data(snapshot_time)
+            data_consolidation.consolidate_station_statement_data(snapshot_time)
+            data_consolidation.clear_raw_data_cache()
+
+        data_agregation.agregate_incremental_data()
+
+def readFacts(con):
+    return con.execute("SELECT * FROM FACT_STATION_STATEMENT ORDER BY ALL").fetchall()
+
+def migrateFormerFactTable(con, table_sql, facts):
+    """
+    Replace the partitions by a former FACT_STATION_STATEMENT table, then create the aggregate tables again
+    """
+
+    con.execute("DROP VIEW FACT_STATION_STATEMENT;")
+    for partition in data_agregation.get_fact_partitions(con):
+        con.execute(f"DROP TABLE {partition};")
+
+    con.execute(table_sql)
+    con.executemany(f"INSERT INTO FACT_STATION_STATEMENT VALUES ({', '.join('?' * len(facts[0]))});", facts)
+
+    data_agregation.create_agregate_tables()
+
+def testFactPartitions():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+        database.configure_database(path="data/duckdb/partitions.duckdb")
+        clear_city_codes()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_consolidation.create_consolidate_tables()
+            data_agregation.create_agregate_tables()
+            consolidateAndAgregate()
+
+        con = database.get_connection()
+        partitions = data_agregation.get_fact_partitions(con)
+        facts = readFacts(con)
+        nb_partition_rows = {partition: con.execute(f"SELECT COUNT(*) FROM {partition}").fetchone()[0] for partition in partitions}
+        nb_keys = con.execute("SELECT COUNT(DISTINCT (STATION_ID, CITY_ID, SNAPSHOT_TIME)) FROM FACT_STATION_STATEMENT").fetchone()[0]
+
+        # The latest snapshot is written again by the full aggregation, its former facts are replaced
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_agregation.agregate_fact_station_statements()
+        rewritten_facts = readFacts(con)
+
+        # A query over December only reads the partition of December
+        december_sql = data_agregation.get_fact_sql(con, DECEMBER_START, DECEMBER_END)
+        december_averages = con.execute(AVG_BICYCLE_AVAILABLE_SQL.format(facts=december_sql), [DECEMBER_START, DECEMBER_END]).fetchall()
+        view_averages = con.execute(AVG_BICYCLE_AVAILABLE_SQL.format(facts="SELECT * FROM FACT_STATION_STATEMENT"), [DECEMBER_START, DECEMBER_END]).fetchall()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrateFormerFactTable(con, FORMER_FACT_TABLE_SQL, facts)
+        migrated_partitions = data_agregation.get_fact_partitions(con)
+        migrated_facts = readFacts(con)
+
+        # The days of data/raw_data are snapshots of midnight, the baseline facts come back with their SNAPSHOT_TIME
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrateFormerFactTable(con, BASELINE_FACT_TABLE_SQL, [fact[:6] for fact in facts])
+        baseline_partitions = data_agregation.get_fact_partitions(con)
+        baseline_facts = readFacts(con)
+
+        database.close_connection()
+        os.chdir(PROJECT_DIRECTORY)
+
+    print(f"Partitions : {nb_partition_rows}")
+    assert partitions == ["FACT_STATION_STATEMENT_202411", "FACT_STATION_STATEMENT_202412"]
+    assert sum(nb_partition_rows.values()) == len(facts) == nb_keys > 0
+
+    assert rewritten_facts == facts
+
+    print(f"December : {december_sql}, {len(december_averages)} stations")
+    assert december_sql == "SELECT * FROM FACT_STATION_STATEMENT_202412"
+    assert december_averages == view_averages and len(december_averages) > 0
+
+    print(f"Former table migrated into {migrated_partitions}")
+    assert migrated_partitions == partitions
+    assert migrated_facts == facts
+
+    print(f"Baseline table migrated into {baseline_partitions}")
+    assert baseline_partitions == partitions
+    assert baseline_facts == facts
+
+testFactPartitions()
@@ -0,0 +1,115 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_agregation
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+
+# Days of data/raw_data where every city was ingested
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03", "2024-12-04"]
+
+# The fixture days have no commune file, the cities of the stations are enough
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+AGREGATE_TABLES = ["DIM_CITY", "DIM_STATION", "FACT_STATION_STATEMENT", "ROLLUP_STATION_STATEMENT", "ROLLUP_CITY_STATEMENT"]
+
+def prepareRawData(tmp_dir):
+    """
+    Build a raw data directory with the fixture days and a commune file for each of them
+    """
+
+    for snapshot_date in FIXTURE_DATES:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            os.symlink(os.path.join(source_directory, entry), os.path.join(directory, entry))
+
+        with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+            json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def consolidateDays(snapshot_dates):
+    for snapshot_date in snapshot_dates:
+        for snapshot_time in list_snapshot_times(snapshot_date):
+            data_consolidation.consolidate_city_data(snapshot_time)
+            data_consolidation.consolidate_station_data(snapshot_time)
+            data_consolidation.consolidate_station_statement_data(snapshot_time)
+            data_consolidation.clear_raw_data_cache()
+
+def readAgregateTables():
+    con = database.get_cursor()
+
+    return {table: con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall() for table in AGREGATE_TABLES}
+
+def openDatabase(name):
+    database.configure_database(path=f"data/duckdb/{name}.duckdb")
+    clear_city_codes()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        data_agregation.create_agregate_tables()
+
+def testIncrementalAggregation():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Reference : the days in order, with a full aggregation after each of them
+            openDatabase("full")
+            for snapshot_date in FIXTURE_DATES:
+                consolidateDays([snapshot_date])
+                data_agregation.agregate_dim_city()
+                data_agregation.agregate_dim_station()
+                data_agregation.agregate_fact_station_statements()
+                data_agregation.agregate_rollups()
+            full_tables = readAgregateTables()
+
+            # Incremental : the first day is consolidated last, as a backfill
+            openDatabase("incremental")
+            for snapshot_date in FIXTURE_DATES[1:]:
+                consolidateDays([snapshot_date])
+                data_agregation.agregate_incremental_data()
+
+            latest_facts = readAgregateTables()["FACT_STATION_STATEMENT"]
+
+            consolidateDays(FIXTURE_DATES[:1])
+            backfill_merged = data_agregation.agregate_incremental_data()
+            incremental_tables = readAgregateTables()
+
+            # Nothing was consolidated since, nothing is merged again
+            nothing_merged = data_agregation.agregate_incremental_data()
+
+        database.close_connection()
+        os.chdir(PROJECT_DIRECTORY)
+
+    for table in AGREGATE_TABLES:
+        print(f"{table} : {len(full_tables[table])} rows with the full aggregation, {len(incremental_tables[table])} rows with the incremental one")
+        assert full_tables[table] == incremental_tables[table]
+
+    print(f"Backfill of {FIXTURE_DATES[0]} merged : {backfill_merged}")
+    assert backfill_merged["FACT_STATION_STATEMENT"] == len(list_snapshot_times(FIXTURE_DATES[0]))
+    assert len(incremental_tables["FACT_STATION_STATEMENT"]) > len(latest_facts)
+
+    print(f"Second run merged : {nothing_merged}")
+    assert nothing_merged == {table: 0 for table in AGREGATE_TABLES}
+
+testIncrementalAggregation()
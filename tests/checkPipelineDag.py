@@ -0,0 +1,121 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_pipeline
+import database
+from city_codes import clear_city_codes
+from data_consolidation import clear_raw_data_cache
+from data_ingestion import SOURCES
+from raw_data import get_snapshot_path
+
+# The sources are "downloaded" from a day of data/raw_data, the commune file is written below
+FIXTURE_DATE = "2024-12-04"
+SNAPSHOT_TIME = datetime(2024, 12, 5, 10, 0, 0)
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+TABLES = [
+    "CONSOLIDATE_CITY",
+    "CONSOLIDATE_STATION",
+    "CONSOLIDATE_STATION_STATEMENT",
+    "DIM_CITY",
+    "DIM_STATION",
+    "FACT_STATION_STATEMENT"
+]
+
+# Sources whose ingestion fails, and sources ingested since the start of the run
+failing_sources = set()
+ingested_sources = []
+
+def fakeIngestSource(source_name, sources=SOURCES, snapshot_time=None):
+    if source_name in failing_sources:
+        raise ConnectionError(f"{source_name} API unavailable")
+
+    file_path = get_snapshot_path(source_name, snapshot_time)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    if source_name == "commune":
+        with open(file_path, "w") as fd:
+            json.dump(COMMUNES, fd)
+    else:
+        shutil.copyfile(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE, sources[source_name]["file_name"]), file_path)
+
+    ingested_sources.append(source_name)
+
+def readTables():
+    con = database.get_cursor()
+
+    return {table: con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall() for table in TABLES}
+
+def openDatabase(name):
+    database.configure_database(path=f"data/duckdb/{name}.duckdb")
+    clear_city_codes()
+    clear_raw_data_cache()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+def testPipelineDag():
+    data_pipeline.ingest_source = fakeIngestSource
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.makedirs("data")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Reference : a run where every source is ingested
+            openDatabase("reference")
+            reference_state = data_pipeline.run_pipeline(SNAPSHOT_TIME, path="data/reference_state.json")
+            reference_tables = readTables()
+
+            # Toulouse fails, the other cities are consolidated and aggregated
+            openDatabase("resumed")
+            failing_sources.add("toulouse")
+            failed_state = data_pipeline.run_pipeline(SNAPSHOT_TIME)
+            failed_tables = readTables()
+
+            # The rerun starts again from the failed ingestion, in the same snapshot
+            failing_sources.clear()
+            ingested_sources.clear()
+            resumed_state = data_pipeline.run_pipeline(resume=True)
+            resumed_tables = readTables()
+
+        database.close_connection()
+        os.chdir(PROJECT_DIRECTORY)
+
+    assert all(status["status"] == "success" for status in reference_state["nodes"].values())
+
+    failed_statuses = {node_name: status["status"] for node_name, status in failed_state["nodes"].items()}
+    print(f"Run with a failed city : {failed_statuses}")
+    assert failed_statuses["ingest:toulouse"] == "failed"
+    assert failed_statuses["consolidate:toulouse"] == "blocked"
+    assert failed_statuses["consolidate:nantes"] == "success"
+    assert failed_statuses["agregate"] == "success"
+    assert 0 < len(failed_tables["FACT_STATION_STATEMENT"]) < len(reference_tables["FACT_STATION_STATEMENT"])
+
+    print(f"Sources ingested again by the resumed run : {ingested_sources}")
+    assert ingested_sources == ["toulouse"]
+    assert resumed_state["snapshot_time"] == SNAPSHOT_TIME.isoformat()
+    assert all(status["status"] == "success" for status in resumed_state["nodes"].values())
+
+    for table in TABLES:
+        print(f"{table} : {len(reference_tables[table])} rows with one run, {len(resumed_tables[table])} rows with the resumed run")
+        assert reference_tables[table] == resumed_tables[table]
+
+testPipelineDag()
@@ -0,0 +1,184 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_agregation
+import data_consolidation
+import database
+import query_service
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+
+# Days of data/raw_data where every city was ingested, the last one lands while the service runs
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03"]
+NEW_FIXTURE_DATE = "2024-12-04"
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+# Averages of the bikes of each station of a city over a range, computed over the facts
+STATION_AVERAGES_SQL = """
+SELECT STATION_ID, round(AVG(BICYCLE_AVAILABLE), 6)
+FROM FACT_STATION_STATEMENT
+WHERE CITY_ID = (SELECT ID FROM DIM_CITY WHERE NAME = ?)
+    AND SNAPSHOT_TIME >= ? AND SNAPSHOT_TIME < ?
+GROUP BY STATION_ID
+ORDER BY STATION_ID;
+"""
+
+LATEST_SQL = """
+SELECT SNAPSHOT_TIME, SUM(BICYCLE_AVAILABLE)
+FROM FACT_STATION_STATEMENT
+WHERE CITY_ID = (SELECT ID FROM DIM_CITY WHERE NAME = ?)
+    AND SNAPSHOT_TIME = (SELECT MAX(SNAPSHOT_TIME) FROM FACT_STATION_STATEMENT)
+GROUP BY SNAPSHOT_TIME;
+"""
+
+def prepareRawData(tmp_dir):
+    for snapshot_date in FIXTURE_DATES + [NEW_FIXTURE_DATE]:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            os.symlink(os.path.join(source_directory, entry), os.path.join(directory, entry))
+
+        with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+            json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def ingestDates(snapshot_dates):
+    """
+    Consolidate and aggregate days of raw data with the write connection, closed afterwards
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for snapshot_date in snapshot_dates:
+            for snapshot_time in list_snapshot_times(snapshot_date):
+                data_consolidation.consolidate_city_data(snapshot_time)
+                data_consolidation.consolidate_station_data(snapshot_time)
+                data_consolidation.consolidate_station_statement_data(snapshot_time)
+                data_consolidation.clear_raw_data_cache()
+
+            data_agregation.agregate_incremental_data()
+
+    database.close_connection()
+
+def readDirectly(sql_statement, parameters):
+    con = database.connect_read_only()
+    rows = con.execute(sql_statement, parameters).fetchall()
+    con.close()
+
+    return rows
+
+def request(base_url, path, **parameters):
+    try:
+        with urlopen(f"{base_url}{path}?{urlencode(parameters)}") as response:
+            return response.status, json.load(response)
+    except HTTPError as error:
+        return error.code, json.load(error)
+
+def testQueryService():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+        database.configure_database(path="data/duckdb/service.duckdb")
+        clear_city_codes()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_consolidation.create_consolidate_tables()
+            data_agregation.create_agregate_tables()
+        ingestDates(FIXTURE_DATES)
+
+        server = query_service.create_server(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        # The availability of the stations over a range of days, answered from the daily rollups
+        parameters = {"city": "Paris", "start": "2024-11-29", "end": "2024-12-01"}
+        status, stations = request(base_url, "/stations/availability", **parameters)
+        _, cached_stations = request(base_url, "/stations/availability", **parameters)
+        expected_stations = readDirectly(STATION_AVERAGES_SQL, ["Paris", "2024-11-29", "2024-12-01"])
+
+        status_latest, latest = request(base_url, "/cities/latest", city="Toulouse")
+        _, cities = request(base_url, "/cities/availability")
+        status_nearest, nearest = request(base_url, "/stations/nearest", longitude=2.3522, latitude=48.8566, k=3, min_bicycles=1)
+        status_missing, _ = request(base_url, "/stations/nearest", longitude=2.3522)
+        status_invalid, invalid = request(base_url, "/stations/availability", start="yesterday")
+        status_unknown, _ = request(base_url, "/stations/unknown")
+        out_of_range = [
+            request(base_url, "/stations/nearest", longitude=2.3522, latitude=48.8566, **parameter)
+            for parameter in [{"k": 0}, {"k": -3}, {"radius": 0}, {"radius": -500}, {"radius": "nan"}, {"min_bicycles": -1}, {"min_docks": -1}]
+        ]
+        metrics_before = request(base_url, "/metrics")[1]
+        former_version = query_service._data_state["version"]
+
+        # A new day lands : the pipeline writes once the service released the file
+        query_service.close_pool()
+        ingestDates([NEW_FIXTURE_DATE])
+
+        _, new_latest = request(base_url, "/cities/latest", city="Toulouse")
+        expected_new_latest = readDirectly(LATEST_SQL, ["Toulouse"])
+        _, stations_again = request(base_url, "/stations/availability", **parameters)
+        metrics_after = request(base_url, "/metrics")[1]
+
+        # A response computed from the former version while the new one was loaded isn't cached
+        query_service.store_cached_result(("/cities/latest", (("city", "Nantes"),)), b"[]", former_version)
+        stale_cached = ("/cities/latest", (("city", "Nantes"),)) in query_service._cache
+
+        server.shutdown()
+        server.server_close()
+        query_service.close_pool()
+        os.chdir(PROJECT_DIRECTORY)
+
+    print(f"{len(stations)} stations of Paris, e.g. {stations[0]}")
+    assert status == 200 and stations == cached_stations
+    assert [(row["station_id"], round(row["avg_bicycle_available"], 6)) for row in stations] == expected_stations
+    assert len(expected_stations) > 0
+
+    print(f"Latest snapshot of Toulouse : {latest}, then {new_latest}")
+    assert status_latest == 200 and len(latest) == 1
+    assert [(row["snapshot_time"], row["sum_bicycle_available"]) for row in new_latest] == [(str(snapshot_time), total) for snapshot_time, total in expected_new_latest]
+    assert new_latest[0]["snapshot_time"] > latest[0]["snapshot_time"]
+    assert len(cities) == len(COMMUNES)
+
+    print(f"Nearest stations with bikes from the center of Paris : {[(row['station_name'], row['distance_meters']) for row in nearest]}")
+    assert status_nearest == 200 and len(nearest) == 3
+    assert [row["distance_meters"] for row in nearest] == sorted(row["distance_meters"] for row in nearest)
+    assert all(row["city_name"] == "Paris" and row["bicycle_available"] >= 1 for row in nearest)
+    assert status_missing == 400
+
+    assert status_invalid == 400 and "start" in invalid["error"]
+    assert status_unknown == 404
+
+    # The numeric parameters out of their range are rejected before any query
+    print(f"Out of range parameters : {[invalid['error'] for _, invalid in out_of_range]}")
+    assert all(status_range == 400 for status_range, _ in out_of_range)
+
+    # The responses were cached until the new snapshot was aggregated
+    print(f"Cache before the new day : {metrics_before['cache']}, after : {metrics_after['cache']}")
+    assert metrics_before["cache"]["hits"] == 1 and metrics_before["cache"]["misses"] == 4
+    assert metrics_after["cache"]["invalidations"] == metrics_before["cache"]["invalidations"] + 1
+    assert metrics_after["cache"]["hits"] == 1 and stations_again == stations
+    assert former_version != query_service._data_state["version"] and not stale_cached
+
+    for endpoint, latency in metrics_after["endpoints"].items():
+        print(f"    {endpoint} : {latency['count']} requests, p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms")
+
+testQueryService()
@@ -0,0 +1,104 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+
+# Days of data/raw_data where every city was ingested
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03", "2024-12-04"]
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+TABLES = ["CONSOLIDATE_CITY", "CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+
+ENGINES = ["pandas", "duckdb", "arrow"]
+
+def prepareRawData(tmp_dir):
+    """
+    Copy the fixture days, the JSON files are deleted by the archive
+    """
+
+    for snapshot_date in FIXTURE_DATES:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            with open(os.path.join(source_directory, entry), "rb") as source_fd, open(os.path.join(directory, entry), "wb") as fd:
+                fd.write(source_fd.read())
+
+        with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+            json.dump(COMMUNES, fd)
+
+    os.makedirs(os.path.join(tmp_dir, "data", "duckdb"))
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def consolidateDays(name, engine):
+    database.configure_database(path=f"data/duckdb/{name}_{engine}.duckdb")
+    clear_city_codes()
+    data_consolidation.clear_raw_data_cache()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+
+        for snapshot_date in FIXTURE_DATES:
+            for snapshot_time in list_snapshot_times(snapshot_date):
+                data_consolidation.consolidate_city_data(snapshot_time)
+                data_consolidation.consolidate_station_data(snapshot_time, engine=engine)
+                data_consolidation.consolidate_station_statement_data(snapshot_time, engine=engine)
+                data_consolidation.clear_raw_data_cache()
+
+    con = database.get_cursor()
+    tables = {table: con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall() for table in TABLES}
+    database.close_connection()
+
+    return tables
+
+def testRawArchive():
+    # The quote inside the directory name goes through the paths of the COPY and of the readers
+    with tempfile.TemporaryDirectory(prefix="raw'archive_") as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+
+        json_tables = {engine: consolidateDays("json", engine) for engine in ENGINES}
+
+        subprocess.run([sys.executable, os.path.join(PROJECT_DIRECTORY, "src", "data_archive.py"), *FIXTURE_DATES, "--delete-json"], check=True)
+        json_files = [name for _, _, files in os.walk("data/raw_data") for name in files if name.endswith(".json")]
+        archive_files = sorted(os.path.relpath(os.path.join(root, name), "data/raw_archive") for root, _, files in os.walk("data/raw_archive") for name in files)
+
+        parquet_tables = {engine: consolidateDays("parquet", engine) for engine in ENGINES}
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    print(f"{len(archive_files)} archives, {len(json_files)} JSON files left")
+    assert json_files == []
+    assert len(archive_files) == len(FIXTURE_DATES) * 6 and all(name.endswith(".parquet") for name in archive_files)
+
+    # Every engine gives the same tables from the archive as from the JSON files
+    for engine in ENGINES:
+        print(f"{engine} : {({table: len(rows) for table, rows in parquet_tables[engine].items()})}")
+
+        for table in TABLES:
+            assert parquet_tables[engine][table] == json_tables[engine][table] and len(json_tables[engine][table]) > 0
+            assert parquet_tables[engine][table] == parquet_tables[ENGINES[0]][table]
+
+testRawArchive()
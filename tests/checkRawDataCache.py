@@ -0,0 +1,130 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from collections import Counter
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+from sources import get_station_sources
+
+FIXTURE_DATE = "2024-12-04"
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+CITY_SOURCES = get_station_sources()
+
+def prepareRawData(tmp_dir):
+    directory = os.path.join(tmp_dir, "data", "raw_data", FIXTURE_DATE)
+    os.makedirs(directory)
+
+    for entry in os.listdir(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE)):
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE, entry), os.path.join(directory, entry))
+
+    with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+        json.dump(COMMUNES, fd)
+
+    os.makedirs(os.path.join(tmp_dir, "data", "duckdb"))
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def countRawDataLoads(engine):
+    """
+    Consolidate the stations then the statements of the snapshot, and count the raw
+    data loaded and normalized for each city
+    """
+
+    database.configure_database(path=f"data/duckdb/{engine}.duckdb")
+    clear_city_codes()
+    data_consolidation.clear_raw_data_cache()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    snapshot_time = list_snapshot_times(FIXTURE_DATE)[0]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        data_consolidation.consolidate_city_data(snapshot_time)
+
+    loads = Counter()
+    nb_normalizations = Counter()
+    load_raw_data = data_consolidation.load_raw_data
+    json_normalize = data_consolidation.pd.json_normalize
+
+    def countedLoadRawData(source_name, snapshot_time):
+        loads[source_name] += 1
+        return load_raw_data(source_name, snapshot_time)
+
+    def countedJsonNormalize(*args, **kwargs):
+        nb_normalizations["calls"] += 1
+        return json_normalize(*args, **kwargs)
+
+    data_consolidation.load_raw_data = countedLoadRawData
+    data_consolidation.pd.json_normalize = countedJsonNormalize
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_consolidation.consolidate_station_data(snapshot_time, engine=engine)
+            data_consolidation.consolidate_station_statement_data(snapshot_time, engine=engine)
+    finally:
+        data_consolidation.load_raw_data = load_raw_data
+        data_consolidation.pd.json_normalize = json_normalize
+
+    con = database.get_cursor()
+    nb_statements = con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT;").fetchone()[0]
+    database.close_connection()
+
+    return snapshot_time, loads, nb_normalizations["calls"], nb_statements
+
+def testRawDataCache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+
+        pandas_loads = countRawDataLoads("pandas")
+        arrow_loads = countRawDataLoads("arrow")
+
+        # The caller modifies its copy of the frame, the cached one is untouched
+        snapshot_time = pandas_loads[0]
+        data_consolidation.clear_raw_data_cache()
+        raw_data_df = data_consolidation.load_raw_data_frame(CITY_SOURCES[0], snapshot_time)
+        cached_df = raw_data_df.copy()
+
+        modified_df = data_consolidation.load_raw_data_frame(CITY_SOURCES[0], snapshot_time)
+        modified_df[modified_df.columns[0]] = None
+        modified_df.iloc[0, 1] = None
+        modified_df["added_column"] = 1
+        modified_df.rename(columns={modified_df.columns[2]: "renamed_column"}, inplace=True)
+
+        reloaded_df = data_consolidation.load_raw_data_frame(CITY_SOURCES[0], snapshot_time)
+        nb_cached_frames = len(data_consolidation._raw_data_cache)
+        data_consolidation.clear_raw_data_cache()
+        nb_cleared_frames = len(data_consolidation._raw_data_cache)
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    # Each city is loaded and normalized once for both the station and the statement consolidations
+    for engine, (_, loads, nb_normalizations, nb_statements) in [("pandas", pandas_loads), ("arrow", arrow_loads)]:
+        print(f"{engine} : {dict(loads)} loads, {nb_normalizations} normalizations, {nb_statements} statements")
+        assert loads == Counter(CITY_SOURCES) and nb_statements > 0
+
+    assert pandas_loads[2] == len(CITY_SOURCES)
+    assert arrow_loads[2] == 0
+
+    assert reloaded_df.equals(cached_df) and list(reloaded_df.columns) == list(cached_df.columns)
+    assert nb_cached_frames == 1 and nb_cleared_frames == 0
+
+testRawDataCache()
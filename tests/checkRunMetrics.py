@@ -0,0 +1,97 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import database
+from data_backfill import backfill_data
+from metrics import METRICS_LOG_PATH, format_run_report, get_run_id
+
+# Days of data/raw_data where every city was ingested, a commune file is added to the last one
+FIXTURE_DATES = ["2024-12-03", "2024-12-04"]
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+def prepareRawData(tmp_dir):
+    for snapshot_date in FIXTURE_DATES:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            os.symlink(os.path.join(source_directory, entry), os.path.join(directory, entry))
+
+    with open(os.path.join(tmp_dir, "data", "raw_data", FIXTURE_DATES[-1], "commune_data.json"), "w") as fd:
+        json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def testRunMetrics():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+        database.configure_database(path="data/duckdb/metrics.duckdb")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            backfill_data(FIXTURE_DATES[0], FIXTURE_DATES[-1], max_workers=2, agregate=True)
+
+        run_id = get_run_id()
+        con = database.get_cursor()
+
+        stages = {
+            stage: (nb_stages, rows_in, rows_out, bytes_read, peak_rss)
+            for stage, nb_stages, rows_in, rows_out, bytes_read, peak_rss in con.execute("""
+            SELECT STAGE, COUNT(*), SUM(ROWS_IN), SUM(ROWS_OUT), SUM(BYTES_READ), MAX(PEAK_RSS)
+            FROM PIPELINE_RUN_METRICS
+            WHERE RUN_ID = ? AND STATUS = 'success'
+            GROUP BY STAGE;
+            """, [run_id]).fetchall()
+        }
+        nb_stations = con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION;").fetchone()[0]
+        nb_observations = con.execute("""
+        SELECT COUNT(*)
+        FROM CONSOLIDATE_STATION cs
+        JOIN CONSOLIDATE_STATION_LOAD load ON load.ID_PREFIX = split_part(cs.ID, '-', 1)
+            AND load.CREATED_DATE >= cs.VALID_FROM
+            AND (cs.VALID_TO IS NULL OR load.CREATED_DATE < cs.VALID_TO);
+        """).fetchone()[0]
+        nb_facts = con.execute("SELECT COUNT(*) FROM FACT_STATION_STATEMENT;").fetchone()[0]
+
+        with open(METRICS_LOG_PATH) as fd:
+            logged_stages = [json.loads(line) for line in fd]
+
+        database.close_connection()
+        os.chdir(PROJECT_DIRECTORY)
+
+    for line in format_run_report(logged_stages):
+        print(line)
+
+    # The stages of the workers are recorded with the run of the main process
+    assert {stage_metrics["run_id"] for stage_metrics in logged_stages} == {run_id}
+    assert sum(nb_stages for nb_stages, *_ in stages.values()) == len(logged_stages)
+
+    # The raw files are read once per city and per snapshot, by the station consolidation
+    _, rows_in, rows_out, bytes_read, peak_rss = stages["consolidate:CONSOLIDATE_STATION"]
+    assert rows_in == rows_out == nb_observations
+    assert bytes_read > 0 and peak_rss > 0
+
+    # The stations of every day are written, only their changes are kept
+    _, rows_in, rows_out, _, _ = stages["write:CONSOLIDATE_STATION"]
+    assert rows_in == nb_observations
+    assert nb_stations <= rows_out < nb_observations
+    assert stages["agregate:FACT_STATION_STATEMENT"][2] == nb_facts > 0
+
+# The backfill workers are spawned and import this script again
+if __name__ == "__main__":
+    testRunMetrics()
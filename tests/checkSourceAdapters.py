@@ -0,0 +1,121 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import get_snapshot_path
+from sources import SOURCES
+
+SNAPSHOT_TIME = datetime(2024, 12, 5, 10, 0, 0)
+
+# A new city is a new entry of SOURCES, the consolidation has no code of its own for it
+LYON_SOURCE = {
+    "url": "https://download.data.grandlyon.com/files/rdata/jcd_jcdecaux.jcdvelov/station_information.json",
+    "headers": {},
+    "timeout": 30,
+    "file_name": "lyon_realtime_bicycle_data.json",
+    "adapter": {
+        "city_code": 6,
+        "station_code": "station_id",
+        "city": "Lyon",
+        "station_fields": {
+            "name": "name",
+            "city_name": {"value": "lyon"},
+            "longitude": "position.lon",
+            "latitude": "position.lat",
+            "status": {"field": "is_renting", "open_value": "1"},
+            "capacity": "capacity"
+        },
+        "statement_fields": {
+            "bicycle_docks_available": "num_docks_available",
+            "bicycle_available": "num_bikes_available",
+            "last_statement_date": {"field": "last_reported", "epoch": True}
+        }
+    }
+}
+
+LYON_STATIONS = [
+    {"station_id": "10001", "name": "Bellecour", "position": {"lat": 45.7578, "lon": 4.832}, "is_renting": 1, "capacity": 30, "num_docks_available": 12, "num_bikes_available": 18, "last_reported": 1733392800},
+    {"station_id": "10002", "name": "Terreaux", "position": {"lat": 45.7674, "lon": 4.8336}, "is_renting": 0, "capacity": 20, "num_docks_available": 20, "num_bikes_available": 0, "last_reported": 1733392740}
+]
+
+COMMUNES = [
+    {"code": "69123", "nom": "Lyon", "population": 522250}
+]
+
+def writeRawData(source_name, data):
+    file_path = get_snapshot_path(source_name, SNAPSHOT_TIME)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    with open(file_path, "w") as fd:
+        json.dump(data, fd)
+
+def runConsolidation(engine):
+    database.configure_database(path=f"data/duckdb/{engine}.duckdb")
+    clear_city_codes()
+    data_consolidation.clear_raw_data_cache()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        data_consolidation.consolidate_city_data(SNAPSHOT_TIME)
+        data_consolidation.consolidate_station_data(SNAPSHOT_TIME, engine=engine)
+        data_consolidation.consolidate_station_statement_data(SNAPSHOT_TIME, engine=engine)
+
+    con = database.get_cursor()
+    tables = {
+        table: con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall()
+        for table in ["CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+    }
+    database.close_connection()
+
+    return tables
+
+def testSourceAdapters():
+    SOURCES["lyon"] = LYON_SOURCE
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            os.makedirs("data")
+            os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+            # Only Lyon and the communes were ingested in this snapshot
+            writeRawData("lyon", LYON_STATIONS)
+            writeRawData("commune", COMMUNES)
+
+            pandas_tables = runConsolidation("pandas")
+            duckdb_tables = runConsolidation("duckdb")
+            arrow_tables = runConsolidation("arrow")
+
+            os.chdir(PROJECT_DIRECTORY)
+    finally:
+        del SOURCES["lyon"]
+
+    for table in pandas_tables:
+        print(f"{table} : {pandas_tables[table]}")
+        assert pandas_tables[table] == duckdb_tables[table]
+        assert pandas_tables[table] == arrow_tables[table]
+
+    stations = pandas_tables["CONSOLIDATE_STATION"]
+    assert [(row[0], row[1], row[3], row[4], row[8]) for row in stations] == [
+        ("6-10001", "10001", "lyon", "69123", "OPEN"),
+        ("6-10002", "10002", "lyon", "69123", "CLOSED")
+    ]
+
+    statements = pandas_tables["CONSOLIDATE_STATION_STATEMENT"]
+    assert [row[:3] for row in statements] == [("6-10001", 12, 18), ("6-10002", 20, 0)]
+    assert statements[0][3] == datetime.fromtimestamp(1733392800).date()
+
+testSourceAdapters()
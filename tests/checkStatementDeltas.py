@@ -0,0 +1,143 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import data_pipeline
+import database
+from city_codes import clear_city_codes
+from raw_data import get_snapshot_path
+from sources import SOURCES
+from statement_deltas import get_statements_sql
+
+# Two sources polled every 5 minutes, a few stations of each one change between two snapshots
+FIXTURE_DATE = "2024-12-04"
+FIRST_SNAPSHOT_TIME = datetime(2024, 12, 5, 10, 0, 0)
+NB_SNAPSHOTS = 40
+SNAPSHOT_MINUTES = 5
+NB_CHANGES = 3
+SOURCE_NAMES = ["nantes", "toulouse"]
+
+# The second source misses a snapshot, the first one stops listing its first station halfway,
+# and neither of them changes over the last snapshots
+MISSING_SNAPSHOT = 10
+REMOVED_SNAPSHOT = 20
+UNCHANGED_SNAPSHOT = 35
+
+STATEMENTS_FINGERPRINT_SQL = f"""
+SELECT SNAPSHOT_TIME, COUNT(*), SUM(hash(STATION_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE))
+FROM ({get_statements_sql("SELECT SNAPSHOT_TIME FROM CONSOLIDATE_SNAPSHOT")})
+GROUP BY SNAPSHOT_TIME
+ORDER BY SNAPSHOT_TIME;
+"""
+
+def writeRawData():
+    """
+    Write the raw file of each source for each snapshot, and return the number of statements
+    changed since the previous snapshot of their source
+    """
+
+    nb_changes = 0
+
+    for source_name in SOURCE_NAMES:
+        with open(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE, SOURCES[source_name]["file_name"])) as fd:
+            stations = json.load(fd)
+
+        for snapshot in range(NB_SNAPSHOTS):
+            if source_name == SOURCE_NAMES[1] and snapshot == MISSING_SNAPSHOT:
+                continue
+
+            # Stations other than the removed one, a different one each time
+            if 0 < snapshot < UNCHANGED_SNAPSHOT:
+                for change in range(NB_CHANGES):
+                    station = stations[1 + (snapshot * NB_CHANGES + change) % (len(stations) - 1)]
+                    station["available_bikes"] += 1
+                    nb_changes += 1
+
+            listed_stations = stations[1:] if source_name == SOURCE_NAMES[0] and snapshot >= REMOVED_SNAPSHOT else stations
+
+            file_path = get_snapshot_path(source_name, FIRST_SNAPSHOT_TIME + timedelta(minutes=snapshot * SNAPSHOT_MINUTES))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            with open(file_path, "w") as fd:
+                json.dump(listed_stations, fd)
+
+    return nb_changes
+
+def consolidateSnapshots(encoding):
+    """
+    Consolidate each source of each snapshot on its own, as the pipeline does
+    """
+
+    database.configure_database(path=f"data/duckdb/{encoding}.duckdb")
+    data_consolidation.STATEMENT_ENCODING = encoding
+    clear_city_codes()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        data_pipeline.create_tables()
+
+        for snapshot in range(NB_SNAPSHOTS):
+            snapshot_time = FIRST_SNAPSHOT_TIME + timedelta(minutes=snapshot * SNAPSHOT_MINUTES)
+
+            for source_name in SOURCE_NAMES:
+                if os.path.exists(get_snapshot_path(source_name, snapshot_time)):
+                    data_pipeline.consolidate_source(source_name, snapshot_time)
+
+            data_consolidation.clear_raw_data_cache()
+
+    con = database.get_cursor()
+    result = {
+        "rows": con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT;").fetchone()[0],
+        "removals": con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT WHERE IS_REMOVED;").fetchone()[0],
+        "first_rows": con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT WHERE SNAPSHOT_TIME = ?;", [FIRST_SNAPSHOT_TIME]).fetchone()[0],
+        "keyframes": con.execute("SELECT COUNT(*) FROM CONSOLIDATE_SNAPSHOT WHERE KEYFRAME_TIME = SNAPSHOT_TIME;").fetchone()[0],
+        "statements": con.execute(STATEMENTS_FINGERPRINT_SQL).fetchall(),
+        "nb_copies": output.getvalue().count("its rows are copied")
+    }
+
+    database.close_connection()
+    data_consolidation.STATEMENT_ENCODING = "full"
+
+    return result
+
+def testStatementDeltas():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.makedirs("data/duckdb")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+        nb_changes = writeRawData()
+        full = consolidateSnapshots("full")
+        delta = consolidateSnapshots("delta")
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    for encoding, result in [("full", full), ("delta", delta)]:
+        print(f"{encoding} : {result['rows']} rows, {result['removals']} removals, {result['keyframes']} keyframes, {result['nb_copies']} sources copied")
+
+    # The statements of every snapshot are the same, the missing source included
+    assert delta["statements"] == full["statements"] and len(full["statements"]) == NB_SNAPSHOTS
+
+    # Each source written on its own keeps the keyframe of the snapshot : the first snapshot is stored
+    # in full, then only the changed statements and the removed station
+    assert full["keyframes"] == NB_SNAPSHOTS
+    assert delta["keyframes"] == 1
+    assert delta["removals"] == 1
+    assert delta["rows"] == delta["first_rows"] + nb_changes + 1
+
+    # The sources unchanged since their previous snapshot aren't parsed again, their statements are copied
+    for result in [full, delta]:
+        assert result["nb_copies"] == len(SOURCE_NAMES) * (NB_SNAPSHOTS - UNCHANGED_SNAPSHOT)
+        assert [statements[1:] for statements in result["statements"][UNCHANGED_SNAPSHOT - 1:]] == [result["statements"][UNCHANGED_SNAPSHOT - 1][1:]] * (NB_SNAPSHOTS - UNCHANGED_SNAPSHOT + 1)
+
+testStatementDeltas()
@@ -0,0 +1,181 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import list_snapshot_times
+from sources import SOURCES
+
+# Days of data/raw_data where every city was ingested
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03", "2024-12-04"]
+
+COMMUNES = [
+    {"code": "75056", "nom": "Paris", "population": 2133111},
+    {"code": "44109", "nom": "Nantes", "population": 320732},
+    {"code": "31555", "nom": "Toulouse", "population": 504078},
+    {"code": "67482", "nom": "Strasbourg", "population": 291313},
+    {"code": "34172", "nom": "Montpellier", "population": 302454}
+]
+
+# A station of Paris renamed on the third day only, and another one missing from the last day
+RENAMED_STATION_CODE = "16107"
+REMOVED_STATION_CODE = "6015"
+
+# Stations valid on a day of their source, as the former daily copies of CONSOLIDATE_STATION
+STATIONS_OF_DAY_SQL = f"""
+SELECT ID, {", ".join(data_consolidation.STATION_ATTRIBUTES)}
+FROM CONSOLIDATE_STATION
+WHERE VALID_FROM <= $created_date AND (VALID_TO IS NULL OR VALID_TO > $created_date)
+    AND split_part(ID, '-', 1) IN (SELECT ID_PREFIX FROM CONSOLIDATE_STATION_LOAD WHERE CREATED_DATE = $created_date)
+ORDER BY ALL;
+"""
+
+# CONSOLIDATE_STATION as it was created before the versions
+FORMER_STATION_TABLE_SQL = """
+CREATE TABLE CONSOLIDATE_STATION (
+    ID VARCHAR NOT NULL,
+    CODE VARCHAR NOT NULL,
+    NAME VARCHAR,
+    CITY_NAME VARCHAR,
+    CITY_CODE VARCHAR,
+    ADDRESS VARCHAR,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT,
+    STATUS VARCHAR,
+    CREATED_DATE DATE,
+    CAPACITTY INTEGER,
+    CITY_ID VARCHAR,
+    PRIMARY KEY (ID, CREATED_DATE)
+);
+"""
+
+def prepareRawData(tmp_dir):
+    paris_file_name = SOURCES["paris"]["file_name"]
+
+    for snapshot_date in FIXTURE_DATES:
+        source_directory = os.path.join(PROJECT_DIRECTORY, "data", "raw_data", snapshot_date)
+        directory = os.path.join(tmp_dir, "data", "raw_data", snapshot_date)
+        os.makedirs(directory)
+
+        for entry in os.listdir(source_directory):
+            if entry != paris_file_name:
+                os.symlink(os.path.join(source_directory, entry), os.path.join(directory, entry))
+
+        with open(os.path.join(source_directory, paris_file_name)) as fd:
+            stations = json.load(fd)
+
+        if snapshot_date == FIXTURE_DATES[2]:
+            for station in stations:
+                if station["stationcode"] == RENAMED_STATION_CODE:
+                    station["name"] = "Renamed station"
+
+        if snapshot_date == FIXTURE_DATES[3]:
+            stations = [station for station in stations if station["stationcode"] != REMOVED_STATION_CODE]
+
+        with open(os.path.join(directory, paris_file_name), "w") as fd:
+            json.dump(stations, fd)
+
+        with open(os.path.join(directory, "commune_data.json"), "w") as fd:
+            json.dump(COMMUNES, fd)
+
+    os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+def consolidateDays(name, snapshot_dates):
+    database.configure_database(path=f"data/duckdb/{name}.duckdb")
+    clear_city_codes()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+
+        for snapshot_date in snapshot_dates:
+            for snapshot_time in list_snapshot_times(snapshot_date):
+                data_consolidation.consolidate_city_data(snapshot_time)
+                data_consolidation.consolidate_station_data(snapshot_time)
+                data_consolidation.clear_raw_data_cache()
+
+def readStationsOfDays(con):
+    return {
+        snapshot_date: con.execute(STATIONS_OF_DAY_SQL, {"created_date": snapshot_date}).fetchall()
+        for snapshot_date in FIXTURE_DATES
+    }
+
+def readVersions(con):
+    return con.execute("SELECT * FROM CONSOLIDATE_STATION ORDER BY ALL").fetchall()
+
+def testStationHistory():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepareRawData(tmp_dir)
+        os.chdir(tmp_dir)
+
+        # Reference : each day alone, as a daily copy
+        daily_copies = {}
+        for snapshot_date in FIXTURE_DATES:
+            consolidateDays(f"day_{snapshot_date}", [snapshot_date])
+            daily_copies[snapshot_date] = readStationsOfDays(database.get_cursor())[snapshot_date]
+            database.close_connection()
+
+        consolidateDays("history", FIXTURE_DATES)
+        con = database.get_cursor()
+        stations_of_days = readStationsOfDays(con)
+        versions = readVersions(con)
+        renamed_versions = con.execute("""
+        SELECT NAME, VALID_FROM, VALID_TO, IS_CURRENT
+        FROM CONSOLIDATE_STATION
+        WHERE ID = ?
+        ORDER BY VALID_FROM;
+        """, [f"1-{RENAMED_STATION_CODE}"]).fetchall()
+        removed_versions = con.execute("SELECT VALID_TO, IS_CURRENT FROM CONSOLIDATE_STATION WHERE ID = ?;", [f"1-{REMOVED_STATION_CODE}"]).fetchall()
+        database.close_connection()
+
+        # The days consolidated out of order, the first one last as a backfill
+        consolidateDays("shuffled", [FIXTURE_DATES[2], FIXTURE_DATES[3], FIXTURE_DATES[1], FIXTURE_DATES[0]])
+        shuffled_versions = readVersions(database.get_cursor())
+        database.close_connection()
+
+        # A database holding the daily copies is migrated to versions
+        database.configure_database(path="data/duckdb/migrated.duckdb")
+        con = database.get_connection()
+        con.execute(FORMER_STATION_TABLE_SQL)
+        for snapshot_date, stations in daily_copies.items():
+            con.executemany(
+                "INSERT INTO CONSOLIDATE_STATION VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                [station[:9] + (snapshot_date, station[9], station[10]) for station in stations]
+            )
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_consolidation.create_consolidate_tables()
+        migrated_versions = readVersions(con)
+        database.close_connection()
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    nb_copies = sum(len(stations) for stations in daily_copies.values())
+    print(f"{nb_copies} daily copies of the stations over {len(FIXTURE_DATES)} days, {len(versions)} versions")
+    assert len(versions) < nb_copies
+
+    # The stations valid on each day are the stations of that day
+    for snapshot_date in FIXTURE_DATES:
+        assert stations_of_days[snapshot_date] == daily_copies[snapshot_date] and len(daily_copies[snapshot_date]) > 0
+
+    print(f"Renamed station : {renamed_versions}")
+    assert [name for name, *_ in renamed_versions] == ["Benjamin Godard - Victor Hugo", "Renamed station", "Benjamin Godard - Victor Hugo"]
+    assert [is_current for *_, is_current in renamed_versions] == [False, False, True]
+
+    print(f"Removed station : {removed_versions}")
+    assert len(removed_versions) == 1 and removed_versions[0][1] is False
+    assert str(removed_versions[0][0]) == FIXTURE_DATES[3]
+
+    assert shuffled_versions == versions
+    assert migrated_versions == versions
+
+testStationHistory()
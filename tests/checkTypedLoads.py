@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+import database
+from city_codes import clear_city_codes
+from raw_data import get_snapshot_path
+from sources import SOURCES
+
+# Raw data of Paris from a day of data/raw_data, where malformed rows are injected
+FIXTURE_DATE = "2024-12-04"
+SNAPSHOT_TIME = datetime(2024, 12, 5, 10, 0, 0)
+
+def writeMalformedRawData():
+    with open(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE, SOURCES["paris"]["file_name"])) as fd:
+        stations = json.load(fd)
+
+    # A capacity that isn't a number, a station without code and a statement without number of bikes
+    stations[0]["capacity"] = "unknown"
+    stations[1]["stationcode"] = None
+    stations[2]["numbikesavailable"] = "n/a"
+
+    file_path = get_snapshot_path("paris", SNAPSHOT_TIME)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    with open(file_path, "w") as fd:
+        json.dump(stations, fd)
+
+    return stations
+
+def writeMalformedEpochs():
+    with open(os.path.join(PROJECT_DIRECTORY, "data", "raw_data", FIXTURE_DATE, SOURCES["strasbourg"]["file_name"])) as fd:
+        stations = json.load(fd)
+
+    # A report time that isn't a timestamp, and a station without report time
+    stations[0]["last_reported"] = "n/a"
+    stations[1]["last_reported"] = None
+
+    file_path = get_snapshot_path("strasbourg", SNAPSHOT_TIME)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    with open(file_path, "w") as fd:
+        json.dump(stations, fd)
+
+    return stations
+
+def runConsolidation(engine):
+    database.configure_database(path=f"data/duckdb/{engine}.duckdb")
+    clear_city_codes()
+    data_consolidation.clear_raw_data_cache()
+
+    if os.path.exists("data/source_state.json"):
+        os.remove("data/source_state.json")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_consolidation.create_consolidate_tables()
+        data_consolidation.consolidate_station_data(SNAPSHOT_TIME, engine=engine)
+        data_consolidation.consolidate_station_statement_data(SNAPSHOT_TIME, engine=engine)
+
+    con = database.get_cursor()
+    nb_rows = {
+        table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ["CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+    }
+    nb_missing_dates = con.execute("SELECT COUNT(*) FROM CONSOLIDATE_STATION_STATEMENT WHERE LAST_STATEMENT_DATE IS NULL").fetchone()[0]
+    quarantined = con.execute("""
+    SELECT TABLE_NAME, SOURCE_NAME, SNAPSHOT_TIME, REASON, RECORD
+    FROM CONSOLIDATE_QUARANTINE
+    ORDER BY TABLE_NAME, REASON;
+    """).fetchall()
+    database.close_connection()
+
+    return nb_rows, nb_missing_dates, quarantined
+
+def testTypedLoads():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.makedirs("data")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), os.path.join(tmp_dir, "data", "sql_statements"))
+
+        stations = writeMalformedRawData()
+        epoch_stations = writeMalformedEpochs()
+        results = {engine: runConsolidation(engine) for engine in ["pandas", "duckdb", "arrow"]}
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    for engine, (nb_rows, nb_missing_dates, quarantined) in results.items():
+        print(f"{engine} : {nb_rows}")
+        for row in quarantined:
+            print(f"    {row[0]} {row[3]} : {row[4][:80]}...")
+
+        # The malformed rows are set aside, the other stations of Paris and Strasbourg are still written
+        assert nb_rows == {
+            "CONSOLIDATE_STATION": len(stations) - 2 + len(epoch_stations),
+            "CONSOLIDATE_STATION_STATEMENT": len(stations) - 2 + len(epoch_stations) - 1
+        }
+        assert [(table_name, source_name, snapshot_time, reason) for table_name, source_name, snapshot_time, reason, _ in quarantined] == [
+            ("CONSOLIDATE_STATION", "paris", SNAPSHOT_TIME, "invalid CAPACITTY"),
+            ("CONSOLIDATE_STATION", "paris", SNAPSHOT_TIME, "missing ID"),
+            ("CONSOLIDATE_STATION_STATEMENT", "paris", SNAPSHOT_TIME, "invalid BICYCLE_AVAILABLE"),
+            ("CONSOLIDATE_STATION_STATEMENT", "strasbourg", SNAPSHOT_TIME, "invalid LAST_STATEMENT_DATE"),
+            ("CONSOLIDATE_STATION_STATEMENT", "paris", SNAPSHOT_TIME, "missing STATION_ID")
+        ]
+        assert json.loads(quarantined[0][4])["capacity"] == "unknown"
+        assert json.loads(quarantined[3][4])["last_statement_date"] == "n/a"
+
+        # A statement without report time is still written, without date
+        assert nb_missing_dates == 1
+
+testTypedLoads()
@@ -0,0 +1,72 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import duckdb
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(PROJECT_DIRECTORY, "src"))
+
+import data_consolidation
+from database import close_connection
+from raw_data import list_snapshot_times
+
+# Days of data/raw_data where every city was ingested
+FIXTURE_DATES = ["2024-11-29", "2024-11-30", "2024-12-03", "2024-12-04"]
+
+def runConsolidation(engine):
+    """
+    Consolidate the fixture days with an engine into a throwaway database
+
+    Returns : (tables, elapsed), the content of the consolidate tables and the time spent
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        os.makedirs("data/duckdb")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "raw_data"), "data/raw_data")
+        os.symlink(os.path.join(PROJECT_DIRECTORY, "data", "sql_statements"), "data/sql_statements")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_consolidation.create_consolidate_tables()
+
+            start = time.perf_counter()
+            for snapshot_date in FIXTURE_DATES:
+                for snapshot_time in list_snapshot_times(snapshot_date):
+                    data_consolidation.consolidate_station_data(snapshot_time, engine=engine)
+                    data_consolidation.consolidate_station_statement_data(snapshot_time, engine=engine)
+                    data_consolidation.clear_raw_data_cache()
+            elapsed = time.perf_counter() - start
+
+        # The shared connection keeps the database of this directory open
+        close_connection()
+
+        con = duckdb.connect(database = "data/duckdb/mobility_analysis.duckdb", read_only = True)
+        tables = {
+            table: con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall()
+            for table in ["CONSOLIDATE_STATION", "CONSOLIDATE_STATION_STATEMENT"]
+        }
+        con.close()
+
+        os.chdir(PROJECT_DIRECTORY)
+
+    return tables, elapsed
+
+def testCompareConsolidationEngines():
+    pandas_tables, pandas_elapsed = runConsolidation("pandas")
+    duckdb_tables, duckdb_elapsed = runConsolidation("duckdb")
+    arrow_tables, arrow_elapsed = runConsolidation("arrow")
+
+    for table in pandas_tables:
+        print(f"{table} : {len(pandas_tables[table])} rows with pandas, {len(duckdb_tables[table])} rows with duckdb, {len(arrow_tables[table])} rows with arrow")
+        assert pandas_tables[table] == duckdb_tables[table]
+        assert pandas_tables[table] == arrow_tables[table]
+
+    print(f"pandas engine : {pandas_elapsed:.3f}s")
+    print(f"duckdb engine : {duckdb_elapsed:.3f}s")
+    print(f"arrow engine : {arrow_elapsed:.3f}s")
+
+testCompareConsolidationEngines()
@@ -6,8 +6,9 @@ def testGetAvgDockAvailablePerStation():
     sql_statement = """
     SELECT ds.name, ds.code, ds.address, tmp.avg_dock_available
     FROM DIM_STATION ds JOIN (
-        SELECT station_id, AVG(BICYCLE_AVAILABLE) AS avg_dock_available
-        FROM FACT_STATION_STATEMENT
+        SELECT station_id, SUM(SUM_BICYCLE_AVAILABLE) / SUM(COUNT_BICYCLE_AVAILABLE) AS avg_dock_available
+        FROM ROLLUP_STATION_STATEMENT
+        WHERE GRAIN = 'month'
         GROUP BY station_id
     ) AS tmp ON ds.id = tmp.station_id;
     """
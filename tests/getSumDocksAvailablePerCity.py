@@ -8,7 +8,7 @@ def testGetSumDocksAvailablePerCity():
     FROM DIM_CITY dm INNER JOIN (
         SELECT CITY_ID, SUM(BICYCLE_DOCKS_AVAILABLE) AS SUM_BICYCLE_DOCKS_AVAILABLE
         FROM FACT_STATION_STATEMENT
-        WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION)
+        WHERE SNAPSHOT_TIME = (SELECT MAX(SNAPSHOT_TIME) FROM CONSOLIDATE_SNAPSHOT)
         GROUP BY CITY_ID
     ) tmp ON dm.ID = tmp.CITY_ID
     WHERE lower(dm.NAME) in ('paris', 'nantes', 'vincennes', 'toulouse', 'strasbourg', 'montpellier');